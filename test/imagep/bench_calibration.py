@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Measure correct-ff1 calibration memory / init time as workers are added
+-per worker: every plugin instance derives and keeps its own gain map
+-shared: plugin instances use the memory mapped calibration cache
+    cold (cache files removed first) and warm (files from the cold run)
+Each mode runs in its own process against a temporary data directory
+Reports init ms per worker and PSS (shared pages split between users)
+
+Ex:
+./test/imagep/bench_calibration.py --width 5440 --height 3648 --workers 8
+"""
+
+import argparse
+import multiprocessing
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+from PIL import Image
+
+
+def pss_mb():
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            if line.startswith("Pss:"):
+                return int(line.split()[1]) / 1024
+    raise Exception("Pss not found")
+
+
+def synthetic_ff(width, height):
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    r2 = ((xs - width / 2) / width)**2 + ((ys - height / 2) / height)**2
+    band = np.clip(240 * (1 - 1.5 * r2), 80, 255).astype(np.uint8)
+    return np.dstack([band, band, band])
+
+
+def child(args, mode, conn):
+    # Keep the calibration and cache out of the real data directory
+    os.environ["PYUSCOPE_DATA_DIR"] = args.data_dir
+    from uscope.imagep.plugins import CorrectFF1Plugin
+    from uscope.imagep import calibration
+    from uscope.microscope import get_virtual_microscope
+
+    microscope = get_virtual_microscope(mconfig={"name": args.microscope})
+    fn = microscope.usc.imager.ff_cal_fn()
+    if not os.path.exists(fn):
+        Image.fromarray(synthetic_ff(args.width, args.height)).save(fn)
+
+    def log(s):
+        pass
+
+    if mode == "cold":
+        shutil.rmtree(calibration.calibration_cache_dir(), ignore_errors=True)
+
+    base = pss_mb()
+    plugins = []
+    dts = []
+    for _i in range(args.workers):
+        tstart = time.time()
+        if mode == "legacy":
+            calibration.clear()
+        plugin = CorrectFF1Plugin(log=log, microscope=microscope)
+        if mode == "legacy":
+            # Private copy like the original per instance load
+            plugin.ff_gain = plugin.ff_derive(fn)[0]
+        # Touch every page like a first correction would
+        int(plugin.ff_gain.sum())
+        dts.append(time.time() - tstart)
+        plugins.append(plugin)
+    conn.send((dts, pss_mb() - base))
+
+
+def run(args, mode):
+    ctx = multiprocessing.get_context("fork")
+    parent_conn, child_conn = ctx.Pipe()
+    process = ctx.Process(target=child, args=(args, mode, child_conn))
+    process.start()
+    ret = parent_conn.recv()
+    process.join()
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark shared calibration cache vs per worker")
+    parser.add_argument("--microscope", default="mock")
+    parser.add_argument("--width", type=int, default=5440)
+    parser.add_argument("--height", type=int, default=3648)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        args.data_dir = data_dir
+        print("Calibration: %uw x %uh, %u workers" %
+              (args.width, args.height, args.workers))
+        print("%-12s %12s %12s %10s" %
+              ("mode", "first ms", "next ms", "PSS MB"))
+        # Warm: cache files left by the previous (cold) run, new process
+        for name, mode in (("per worker", "legacy"), ("shared cold", "cold"),
+                           ("shared warm", "warm")):
+            dts, pss = run(args, mode)
+            nexts = dts[1:] or dts
+            print("%-12s %12.1f %12.1f %10.0f" %
+                  (name, dts[0] * 1000, 1000 * sum(nexts) / len(nexts), pss))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+cs_auto batch mode: find scans in the scan dir that need uploading
+-crawl: look for cloud_stitch.json in every scan (original behavior)
+-catalog cold: first sync of a catalog that doesn't know any scans
+-catalog warm: later runs, only new scans need a look
+Files are empty: only the directory layout matters
+
+Ex:
+./test/imagep/bench_catalog.py --scans 200 --images 2000
+"""
+
+from uscope.imagep.pipeline import already_uploaded
+from uscope.scan_catalog import ScanCatalog
+import argparse
+import os
+import tempfile
+import time
+
+
+def make_scans(scan_dir, args):
+    for scani in range(args.scans):
+        directory = os.path.join(scan_dir, "scan_%04u" % scani)
+        # Raw captures + a couple processing stages
+        for sub in ("", "hdr", "hdr/stack"):
+            this_dir = os.path.join(directory, sub)
+            os.makedirs(this_dir, exist_ok=True)
+            for imagei in range(args.images // 3):
+                basename = "c%03u_r%03u.jpg" % divmod(imagei, 1000)
+                open(os.path.join(this_dir, basename), "w").close()
+        # Most scans in a long lived data dir are already uploaded
+        if scani % 10:
+            open(os.path.join(directory, "hdr/stack/cloud_stitch.json"),
+                 "w").close()
+
+
+def crawl(scan_dir):
+    ret = []
+    for basename in sorted(os.listdir(scan_dir)):
+        directory = os.path.join(scan_dir, basename)
+        if not already_uploaded(directory):
+            ret.append(directory)
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark finding scans to upload")
+    parser.add_argument("--scans", type=int, default=200)
+    parser.add_argument("--images", type=int, default=1500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scan_dir = os.path.join(tmp_dir, "scan")
+        os.mkdir(scan_dir)
+        make_scans(scan_dir, args)
+        catalog = ScanCatalog(os.path.join(tmp_dir, "scan_catalog.sqlite"))
+
+        def run_catalog():
+            catalog.sync(scan_dir)
+            return catalog.pending_uploads(scan_dir)
+
+        results = {}
+        print("%u scans, %u images each" % (args.scans, args.images))
+        print("%-16s %10s %10s" % ("mode", "ms", "pending"))
+        modes = (
+            ("crawl", lambda: crawl(scan_dir)),
+            ("catalog cold", run_catalog),
+            ("catalog warm", run_catalog),
+        )
+        for name, f in modes:
+            tstart = time.time()
+            results[name] = f()
+            dt = time.time() - tstart
+            print("%-16s %10.1f %10u" % (name, 1000 * dt, len(results[name])))
+        assert [os.path.realpath(directory)
+                for directory in results["crawl"]] == results["catalog warm"]
+
+
+if __name__ == "__main__":
+    main()
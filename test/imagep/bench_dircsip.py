@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+DirCSIP throughput benchmark
+Processes a synthetic (or given) scan and reports images / sec
+per stage and end to end from the processing.json metrics
+
+Stage images / sec is input images / (busy time / workers)
+ie the rate the stage would sustain with every worker on it
+
+Save a baseline and compare later runs against it
+to catch regressions in uscope/imagep
+
+Ex:
+./test/imagep/bench_dircsip.py --cols 6 --rows 4 --stack 3 --hdr 2 --json base.json
+./test/imagep/bench_dircsip.py --cols 6 --rows 4 --stack 3 --hdr 2 --baseline base.json
+./test/imagep/bench_dircsip.py --dir /path/to/real/scan
+"""
+
+from uscope.imagep.synthetic import add_scan_args, scan_from_args
+from uscope.imagep.pipeline import CSImageProcessor
+from uscope.microscope import get_virtual_microscope
+from uscope.scan_util import index_scan_images
+from uscope.util import add_bool_arg, readj, writej
+import argparse
+import glob
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+def copy_scan(src, dst):
+    """
+    Raw images + metadata only so every run starts from scratch
+    """
+    fns = glob.glob(os.path.join(src, "*.jpg")) + glob.glob(
+        os.path.join(src, "*.tif")) + [os.path.join(src, "uscan.json")]
+    for fn in fns:
+        if not os.path.exists(fn):
+            continue
+        fn_out = os.path.join(dst, os.path.basename(fn))
+        try:
+            os.link(fn, fn_out)
+        except OSError:
+            shutil.copy(fn, fn_out)
+
+
+def images_per_task(task_name, iindex):
+    if task_name.startswith("hdr-"):
+        return max(1, iindex["hdrs"])
+    if task_name.startswith("stack-"):
+        return max(1, iindex["stacks"])
+    if task_name == "stabilization":
+        return max(1, iindex["stabilization"])
+    return 1
+
+
+def run_once(args, microscope, scan_dir, configj):
+    with tempfile.TemporaryDirectory() as directory:
+        copy_scan(scan_dir, directory)
+        iindex = index_scan_images(directory)
+
+        def log(s):
+            pass
+
+        ip = CSImageProcessor(nthreads=args.threads,
+                              microscope=microscope,
+                              log=log)
+        ip.start()
+        ip.ready.wait(1.0)
+        try:
+            tstart = time.time()
+            ip.process_dir(directory,
+                           upload=False,
+                           lazy=False,
+                           configj=configj,
+                           verbose=False)
+            wall = time.time() - tstart
+        finally:
+            ip.shutdown()
+        metrics = readj(os.path.join(directory, "processing.json"))["metrics"]
+
+    nworkers = max(1, len(metrics["workers"]))
+    stages = {}
+    for task_name, plugin in metrics["plugins"].items():
+        phases = plugin["phases"]
+        busy = sum(phases[phase]["total"]
+                   for phase in ("decode", "compute", "encode", "write"))
+        images = plugin["count"] * images_per_task(task_name, iindex)
+        stages[task_name] = {
+            "tasks": plugin["count"],
+            "images": images,
+            "busy": busy,
+            "images_per_sec": images / (busy / nworkers) if busy else 0.0,
+            "phases": {
+                phase: phases[phase]["total"]
+                for phase in phases
+            },
+        }
+    return {
+        "images": len(iindex["images"]),
+        "wall": wall,
+        "images_per_sec": len(iindex["images"]) / wall,
+        "workers": nworkers,
+        "stages": stages,
+    }
+
+
+def print_results(results, baseline=None):
+    def delta(new, old):
+        if not old:
+            return ""
+        return "%+6.1f%%" % (100.0 * (new - old) / old)
+
+    print("%-18s %6s %7s %9s %9s %8s %8s %8s %8s %8s" %
+          ("stage", "tasks", "images", "busy s", "img/s", "decode", "compute",
+           "encode", "write", "vs base"))
+    for task_name, stage in results["stages"].items():
+        phases = stage["phases"]
+        busy = stage["busy"] or 1.0
+        old = None
+        if baseline:
+            old = baseline["stages"].get(task_name, {}).get("images_per_sec")
+        shares = tuple(100 * phases[phase] / busy
+                       for phase in ("decode", "compute", "encode", "write"))
+        print(
+            "%-18s %6u %7u %9.2f %9.1f" %
+            (task_name, stage["tasks"], stage["images"], stage["busy"],
+             stage["images_per_sec"]),
+            "%7.0f%% %7.0f%% %7.0f%% %7.0f%%" % shares,
+            "%8s" % delta(stage["images_per_sec"], old))
+    old = baseline["images_per_sec"] if baseline else None
+    print("%-18s %6s %7u %9.2f %9.1f %44s" %
+          ("end to end", "", results["images"], results["wall"],
+           results["images_per_sec"], delta(results["images_per_sec"], old)))
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Return list of (name, new, old) rates that dropped by more than tolerance
+    """
+    ret = []
+    pairs = [("end to end", results["images_per_sec"],
+              baseline["images_per_sec"])]
+    for task_name, stage in results["stages"].items():
+        old = baseline["stages"].get(task_name)
+        if old:
+            pairs.append(
+                (task_name, stage["images_per_sec"], old["images_per_sec"]))
+    for name, new, old in pairs:
+        if old and new < old * (1 - tolerance):
+            ret.append((name, new, old))
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DirCSIP")
+    # Something for the stages to do by default
+    add_scan_args(parser, stack=3, hdr=2)
+    parser.add_argument("--dir", help="Benchmark this scan instead")
+    parser.add_argument("--microscope", default="mock")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--hdr-plugin", default="hdr-mertens")
+    parser.add_argument("--stack-plugin", default="stack-native")
+    add_bool_arg(parser, "--dag-schedule", default=True)
+    add_bool_arg(parser, "--fuse-corrections", default=False)
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=1,
+                        help="Keep the fastest of N runs")
+    parser.add_argument("--json", help="Save results (ex: as a baseline)")
+    parser.add_argument("--baseline", help="Compare against saved results")
+    parser.add_argument("--tolerance",
+                        type=float,
+                        default=0.15,
+                        help="Fail if a rate drops by more than this fraction")
+    args = parser.parse_args()
+
+    microscope = get_virtual_microscope(mconfig={"name": args.microscope})
+    configj = {
+        "hdr_plugin": args.hdr_plugin,
+        "stack_plugin": args.stack_plugin,
+        "dag_schedule": args.dag_schedule,
+        "fuse_corrections": args.fuse_corrections,
+        "cloud_stitch": False,
+        "write_html_viewer": False,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scan_dir = args.dir
+        if not scan_dir:
+            scan_dir = os.path.join(tmp_dir, "scan")
+            scan = scan_from_args(args, microscope=args.microscope)
+            n = scan.write(scan_dir)
+            print("Scan: %u x %u tiles, %u stack x %u hdr, %uw x %uh" %
+                  (args.cols, args.rows, args.stack, args.hdr, args.width,
+                   args.height))
+            print("Images: %u" % n)
+        print("Workers: %u" % (args.threads or multiprocessing.cpu_count()))
+        results = None
+        for _i in range(args.repeat):
+            this = run_once(args, microscope, scan_dir, configj)
+            if results is None or this["wall"] < results["wall"]:
+                results = this
+
+    if not results["stages"]:
+        print("ERROR: no processing stages ran (scan needs stacking / HDR)")
+        sys.exit(1)
+    baseline = readj(args.baseline) if args.baseline else None
+    print_results(results, baseline)
+    if args.json:
+        writej(args.json, results)
+    if baseline:
+        bad = regressions(results, baseline, args.tolerance)
+        for name, new, old in bad:
+            print("REGRESSION: %s %0.1f => %0.1f images / sec" %
+                  (name, old, new))
+        if bad:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
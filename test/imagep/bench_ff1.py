@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Compare the fixed point correct-ff1 kernel against the original
+per band float64 implementation
+Reports ms / image and how far the outputs differ (expect +/- 1 at most)
+
+Ex:
+./test/imagep/bench_ff1.py --width 5440 --height 3648
+./test/imagep/bench_ff1.py --ff cal/ff.tif --image scan/c000_r000.jpg
+"""
+
+from uscope.imagep.plugins import ff_gain_map, ff_apply_gain
+import argparse
+import numpy as np
+import time
+from PIL import Image
+
+
+def synthetic_ff(width, height):
+    """
+    Vignetted flat field: bright center falling off towards the corners
+    Corners bottom out at a third of the peak like a typical objective
+    """
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float64)
+    r2 = ((xs - width / 2) / width)**2 + ((ys - height / 2) / height)**2
+    ret = np.empty((height, width, 3), dtype=np.uint8)
+    for band, (peak, falloff) in enumerate(
+        ((235, 1.6), (245, 1.2), (225, 2.0))):
+        ret[:, :, band] = np.clip(peak * (1 - falloff * r2), peak / 3, 255)
+    return ret
+
+
+def bounds_close_band(band, thresh=0.01):
+    """
+    Same as CorrectFF1Plugin.ff_minmax() high bound
+    """
+    hist = np.bincount(band.ravel(), minlength=256)
+    cum = np.cumsum(hist) / band.size
+    return int(np.argmax(cum >= (1.0 - thresh)))
+
+
+def legacy_ff(im_np, scalars):
+    """
+    The original CorrectFF1Plugin._run() band math
+    """
+    bands = []
+    for band, scalar in enumerate(scalars):
+        band_np = np.multiply(im_np[:, :, band], scalar)
+        band_np = np.round(band_np)
+        band_np = np.minimum(band_np, 255)
+        bands.append(Image.fromarray(band_np.astype(np.uint8), "L"))
+    return np.asarray(Image.merge("RGB", bands))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark correct-ff1 fixed point vs float kernel")
+    parser.add_argument("--width", type=int, default=5440)
+    parser.add_argument("--height", type=int, default=3648)
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--ff", help="Flat field calibration image")
+    parser.add_argument("--image", help="Image to correct")
+    args = parser.parse_args()
+
+    if args.ff:
+        ff_np = np.asarray(Image.open(args.ff).convert("RGB"))
+    else:
+        ff_np = synthetic_ff(args.width, args.height)
+    height, width = ff_np.shape[0:2]
+    if args.image:
+        im_np = np.asarray(Image.open(args.image).convert("RGB"))
+    else:
+        rng = np.random.default_rng(0)
+        # Uncorrected image: scene times vignetting
+        scene = rng.integers(0, 256, size=ff_np.shape, dtype=np.uint8)
+        im_np = (scene.astype(np.uint16) * ff_np // 255).astype(np.uint8)
+
+    maxes = [bounds_close_band(ff_np[:, :, band]) for band in range(3)]
+    scalars = [maxes[band] / ff_np[:, :, band] for band in range(3)]
+    gain, shift = ff_gain_map(ff_np, maxes)
+    print("Image: %uw x %uh, gain shift %u" % (width, height, shift))
+
+    def report(name, fn):
+        dts = []
+        for _i in range(args.iterations):
+            tstart = time.time()
+            out = fn()
+            dts.append(time.time() - tstart)
+        print("%-12s %10.1f ms" % (name, min(dts) * 1000))
+        return out
+
+    ref = report("float64", lambda: legacy_ff(im_np, scalars))
+    out = report("fixed", lambda: ff_apply_gain(im_np, gain, shift))
+
+    diff = np.abs(ref.astype(np.int16) - out.astype(np.int16))
+    print("max abs diff: %u" % diff.max())
+    print("pixels differing: %u / %u (%0.4f%%)" %
+          (np.count_nonzero(diff), diff.size,
+           100.0 * np.count_nonzero(diff) / diff.size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Measure index_scan_images() on a large scan directory
+Files are empty: only the names matter
+-cold: nothing cached (ex: first call in a process)
+-warm: directory unchanged since the last call
+-incremental: one image added since the last call
+-handoff: a stage builds its output index from what it wrote
+
+Ex:
+./test/imagep/bench_index.py --cols 50 --rows 40 --stack 5 --hdr 4
+"""
+
+from uscope.scan_util import index_scan_images, iindex_cache, iindex_from_images
+import argparse
+import os
+import tempfile
+import time
+
+
+def timeit(f, repeat):
+    ret = None
+    for _i in range(repeat):
+        tstart = time.time()
+        f()
+        dt = time.time() - tstart
+        ret = dt if ret is None else min(ret, dt)
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scan indexing")
+    parser.add_argument("--cols", type=int, default=50)
+    parser.add_argument("--rows", type=int, default=40)
+    parser.add_argument("--stack", type=int, default=5)
+    parser.add_argument("--hdr", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for col in range(args.cols):
+            for row in range(args.rows):
+                for stacki in range(args.stack):
+                    for hdri in range(args.hdr):
+                        fn = "c%03u_r%03u_z%02u_h%02u.jpg" % (col, row, stacki,
+                                                              hdri)
+                        open(os.path.join(directory, fn), "w").close()
+        # Make the directory look settled so warm lookups can skip listing
+        os.utime(directory, (time.time() - 60, time.time() - 60))
+
+        def cold():
+            iindex_cache.clear()
+            index_scan_images(directory)
+
+        def incremental():
+            fn = os.path.join(directory, "c999_r000_z00_h00.jpg")
+            open(fn, "w").close()
+            os.utime(directory, (time.time() - 60, time.time() - 60))
+            tstart = time.time()
+            index_scan_images(directory)
+            os.unlink(fn)
+            return time.time() - tstart
+
+        def warm():
+            index_scan_images(directory)
+
+        iindex = index_scan_images(directory)
+        images = dict(iindex["images"])
+
+        def handoff():
+            iindex_from_images(directory, images)
+
+        print("Images: %u" % len(images))
+        print("%-12s %10s" % ("mode", "ms"))
+        print("%-12s %10.1f" % ("cold", 1000 * timeit(cold, args.repeat)))
+        print("%-12s %10.1f" % ("warm", 1000 * timeit(warm, args.repeat)))
+        print("%-12s %10.1f" % ("incremental", 1000 * incremental()))
+        print("%-12s %10.1f" %
+              ("handoff", 1000 * timeit(handoff, args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
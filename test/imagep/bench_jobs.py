@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Two scans on one CSImageProcessor
+-sequential: the small scan is started after the large scan is done
+    (ie one cs_auto after another)
+-concurrent: the small scan is started while the large one is running
+    each scan is its own job and workers are shared fairly
+Reports when each scan finishes relative to the start of the large scan
+
+Ex:
+./test/imagep/bench_jobs.py --threads 4
+"""
+
+from uscope.imagep.synthetic import add_scan_args, scan_from_args
+from uscope.imagep.pipeline import CSImageProcessor
+from uscope.microscope import get_virtual_microscope
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+def run(args, microscope, scan_dirs, concurrent):
+    configj = {
+        "hdr_plugin": "hdr-mertens",
+        "stack_plugin": "stack-native",
+        "cloud_stitch": False,
+        "write_html_viewer": False,
+    }
+
+    def log(s):
+        pass
+
+    ip = CSImageProcessor(nthreads=args.threads,
+                          microscope=microscope,
+                          log=log)
+    ip.start()
+    ip.ready.wait(1.0)
+    done = {}
+    tstart = time.time()
+
+    def process(name):
+        ip.process_dir(scan_dirs[name],
+                       upload=False,
+                       lazy=False,
+                       configj=configj,
+                       verbose=False)
+        done[name] = time.time() - tstart
+
+    try:
+        if concurrent:
+            thread = threading.Thread(target=process, args=("large", ))
+            thread.start()
+            time.sleep(args.delay)
+            process("small")
+            thread.join()
+        else:
+            process("large")
+            process("small")
+    finally:
+        ip.shutdown()
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark concurrent jobs on one worker pool")
+    # Stacked HDR so both scans have real work to share the workers with
+    add_scan_args(parser, stack=3, hdr=2)
+    parser.add_argument("--microscope", default="mock")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--small",
+                        type=int,
+                        default=1,
+                        help="Rows in the small scan")
+    parser.add_argument("--delay",
+                        type=float,
+                        default=0.2,
+                        help="Start the small scan this long after the large")
+    args = parser.parse_args()
+    if args.stack == 1 and args.hdr == 1:
+        parser.error("no stages would run: use --stack and / or --hdr > 1")
+
+    microscope = get_virtual_microscope(mconfig={"name": args.microscope})
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scans = {}
+        small_args = argparse.Namespace(**vars(args))
+        small_args.rows = args.small
+        for name, scan_args in (("large", args), ("small", small_args)):
+            scan = scan_from_args(scan_args, microscope=args.microscope)
+            scan.write(os.path.join(tmp_dir, name))
+
+        print("%-12s %10s %10s" % ("mode", "large s", "small s"))
+        for name, concurrent in (("sequential", False), ("concurrent", True)):
+            for scan in ("large", "small"):
+                scans[scan] = os.path.join(tmp_dir, name + "_" + scan)
+                shutil.copytree(os.path.join(tmp_dir, scan), scans[scan])
+            done = run(args, microscope, scans, concurrent)
+            print("%-12s %10.2f %10.2f" % (name, done["large"], done["small"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Measure snapshot latency while the engine is busy with bulk work
+Floods CSImageProcessor with bulk tasks and then takes snapshots
+-bulk: snapshots queued as bulk ie behind everything (original FIFO behavior)
+-interactive: snapshots use the interactive lane
+Reports snapshot latency and queue wait per priority class
+
+Ex:
+./test/imagep/bench_priority.py --threads 4 --bulk 200
+"""
+
+from uscope.imagep.pipeline import CSImageProcessor
+from uscope.imagep.util import TaskBarrier
+from uscope.microscope import get_virtual_microscope
+import argparse
+import numpy as np
+import time
+from PIL import Image
+
+
+def run(args, microscope, priority):
+    def log(s):
+        pass
+
+    rng = np.random.default_rng(0)
+    shape = (args.height, args.width, 3)
+    im = Image.fromarray(rng.integers(0, 255, shape, dtype=np.uint8))
+    ip = CSImageProcessor(nthreads=args.threads,
+                          microscope=microscope,
+                          log=log)
+    ip.start()
+    ip.ready.wait(1.0)
+    try:
+        tb = TaskBarrier()
+        for _i in range(args.bulk):
+            ip.queue_1_to_1_plugin(plugin="correct-sharp1",
+                                   im_in=im,
+                                   want_im_out=True,
+                                   tb=tb,
+                                   priority="bulk")
+        latencies = []
+        for _i in range(args.snapshots):
+            tstart = time.time()
+            ip.process_snapshots([im],
+                                 options={"plugins": ["correct-sharp1"]},
+                                 priority=priority)
+            latencies.append(time.time() - tstart)
+        tb.wait()
+        return latencies, ip.queue_wait_stats()
+    finally:
+        ip.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark snapshot latency under bulk load")
+    parser.add_argument("--microscope", default="mock")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--bulk", type=int, default=100)
+    parser.add_argument("--snapshots", type=int, default=5)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=768)
+    args = parser.parse_args()
+
+    microscope = get_virtual_microscope(mconfig={"name": args.microscope})
+    print("%u bulk tasks, %u snapshots" % (args.bulk, args.snapshots))
+    print("%-12s %12s %12s %16s %14s" %
+          ("snapshot", "mean ms", "max ms", "snap wait ms", "bulk wait ms"))
+    for priority in ("bulk", "interactive"):
+        latencies, waits = run(args, microscope, priority)
+        snap_wait = waits.get(priority, {}).get("max", 0.0)
+        # Snapshots counted in the bulk class when they run as bulk
+        bulk_wait = waits.get("bulk", {}).get("mean", 0.0)
+        print("%-12s %12.1f %12.1f %16.1f %14.1f" %
+              (priority, 1000 * sum(latencies) / len(latencies),
+               1000 * max(latencies), 1000 * snap_wait, 1000 * bulk_wait))
+
+
+if __name__ == "__main__":
+    main()
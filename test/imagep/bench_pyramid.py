@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Tile pyramid: time, peak memory and tile count
+Runs in its own process so peak RSS is its own
+Also checks every level has the expected size
+
+Ex:
+./test/imagep/bench_pyramid.py --cols 10 --rows 8 --width 2048 --height 1536
+"""
+
+from uscope.imagep.synthetic import add_scan_args, scan_from_args
+from uscope.imagep.pyramid import write_pyramid
+from uscope.scan_util import index_scan_images
+import argparse
+import glob
+import math
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from PIL import Image
+
+
+def check_level(files_dir, level, width, height, tile_size):
+    cols = int(math.ceil(width / tile_size))
+    rows = int(math.ceil(height / tile_size))
+    fns = glob.glob(os.path.join(files_dir, str(level), "*.jpg"))
+    assert len(fns) == cols * rows, (level, len(fns), cols, rows)
+    with Image.open(
+            os.path.join(files_dir, str(level),
+                         "%u_%u.jpg" % (cols - 1, rows - 1))) as im:
+        assert im.size == (width - (cols - 1) * tile_size,
+                           height - (rows - 1) * tile_size), (level, im.size)
+    return len(fns)
+
+
+def run(scan_dir, out_dir, threads, queue):
+    iindex = index_scan_images(scan_dir)
+    tstart = time.time()
+    write_pyramid(iindex, out_dir, threads=threads, verbose=False)
+    dt = time.time() - tstart
+    # KiB on Linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((dt, rss))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tile pyramid")
+    add_scan_args(parser)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scan_dir = os.path.join(tmp_dir, "scan")
+        scan_from_args(args).write(scan_dir)
+        out_dir = os.path.join(tmp_dir, "out")
+        os.mkdir(out_dir)
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run,
+                                          args=(scan_dir, out_dir,
+                                                args.threads, queue))
+        process.start()
+        dt, rss = queue.get()
+        process.join()
+
+        with open(os.path.join(out_dir, "pyramid.dzi")) as f:
+            dzi = f.read()
+        width = int(dzi.split('Width="')[1].split('"')[0])
+        height = int(dzi.split('Height="')[1].split('"')[0])
+        max_level = int(math.ceil(math.log2(max(width, height))))
+        tiles = 0
+        for level in range(max_level, -1, -1):
+            scale = 2**(max_level - level)
+            tiles += check_level(os.path.join(out_dir, "pyramid_files"), level,
+                                 int(math.ceil(width / scale)),
+                                 int(math.ceil(height / scale)), 256)
+        print("%ux%u, %u levels, %u tiles" %
+              (width, height, max_level + 1, tiles))
+        print("%10s %10s" % ("sec", "peak MB"))
+        print("%10.2f %10.1f" % (dt, rss / 1024))
+
+
+if __name__ == "__main__":
+    main()
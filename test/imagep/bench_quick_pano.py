@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Quick pano: time and peak memory at a few output scales
+--rotation makes the scan look like the camera is rotated
+which is the slow case (every tile is warped and trimmed)
+Each scale runs in its own process so peak RSS is its own
+
+Ex:
+./test/imagep/bench_quick_pano.py --cols 10 --rows 8 --width 2048 --height 1536 --rotation -1.5
+"""
+
+from uscope.imagep.synthetic import add_scan_args, scan_from_args
+from uscope.imagep.summary import write_quick_pano
+from uscope.scan_util import index_scan_images
+from uscope.util import readj, writej
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from PIL import Image
+
+
+def run_scale(scan_dir, out_dir, scale, threads, queue):
+    iindex = index_scan_images(scan_dir)
+    tstart = time.time()
+    fn = write_quick_pano(iindex,
+                          os.path.join(out_dir, "quick_pano_%u.jpg" % scale),
+                          scale=scale,
+                          threads=threads)
+    dt = time.time() - tstart
+    # KiB on Linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with Image.open(fn) as im:
+        size = im.size
+    queue.put((dt, rss, size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark quick pano")
+    add_scan_args(parser)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--rotation",
+                        type=float,
+                        default=0.0,
+                        help="Camera rotation (degrees) to record in uscan")
+    parser.add_argument("--scales", default="1,4,16")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scan_dir = os.path.join(tmp_dir, "scan")
+        scan_from_args(args).write(scan_dir)
+        if args.rotation:
+            fn = os.path.join(scan_dir, "uscan.json")
+            uscan = readj(fn)
+            uscan["pconfig"]["calibration"] = {
+                "optics": {
+                    "rotation_cw": args.rotation
+                }
+            }
+            writej(fn, uscan)
+        print("%-8s %10s %10s %16s" % ("scale", "sec", "peak MB", "size"))
+        for scale in [int(scale) for scale in args.scales.split(",")]:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_scale,
+                                              args=(scan_dir, tmp_dir, scale,
+                                                    args.threads, queue))
+            process.start()
+            dt, rss, size = queue.get()
+            process.join()
+            print("%-8u %10.2f %10.1f %16s" %
+                  (scale, dt, rss / 1024, "%ux%u" % size))
+
+
+if __name__ == "__main__":
+    main()
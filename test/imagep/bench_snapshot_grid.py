@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Snapshot grid: time and peak memory
+-original: whole canvas in memory, tiles decoded one after another
+-stream: band at a time, tiles decoded in parallel
+-stream/N: same with tiles shrunk N times (JPEG DCT scaling)
+-bigtiff: stream writing the tiled BigTIFF used for huge grids
+Each mode runs in its own process so peak RSS is its own
+
+Ex:
+./test/imagep/bench_snapshot_grid.py --cols 10 --rows 8 --width 2048 --height 1536
+"""
+
+from uscope.imagep.synthetic import add_scan_args, scan_from_args
+from uscope.imagep.summary import write_snapshot_grid
+from uscope.scan_util import index_scan_images
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from PIL import Image
+
+
+def original(iindex, output_filename):
+    this0 = iindex["crs"][(0, 0)]
+    im0 = Image.open(os.path.join(iindex["dir"], this0["basename"]))
+    spacing = int(im0.height * 0.05)
+    w = im0.size[0] * iindex["cols"] + spacing * (iindex["cols"] - 1)
+    h = im0.size[1] * iindex["rows"] + spacing * (iindex["rows"] - 1)
+    dst = Image.new(im0.mode, (w, h))
+    for this in iindex["images"].values():
+        x = im0.width * this["col"] + spacing * this["col"]
+        row0 = iindex["rows"] - this["row"] - 1
+        y = im0.height * row0 + spacing * row0
+        im = Image.open(os.path.join(iindex["dir"], this["basename"]))
+        dst.paste(im, (x, y))
+    dst.save(output_filename, quality=95)
+
+
+def run_mode(scan_dir, out_dir, mode, threads, queue):
+    iindex = index_scan_images(scan_dir)
+    tstart = time.time()
+    if mode == "original":
+        fn = os.path.join(out_dir, "original.jpg")
+        original(iindex, fn)
+    elif mode == "bigtiff":
+        fn = write_snapshot_grid(iindex,
+                                 os.path.join(out_dir, "bigtiff.tif"),
+                                 threads=threads,
+                                 verbose=False)
+    else:
+        scale = int(mode.split("/")[1]) if "/" in mode else 1
+        fn = write_snapshot_grid(iindex,
+                                 os.path.join(out_dir,
+                                              "stream_%u.jpg" % scale),
+                                 scale=scale,
+                                 threads=threads,
+                                 verbose=False)
+    dt = time.time() - tstart
+    # KiB on Linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with Image.open(fn) as im:
+        size = im.size
+    queue.put((dt, rss, size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark snapshot grid")
+    add_scan_args(parser)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scan_dir = os.path.join(tmp_dir, "scan")
+        scan_from_args(args).write(scan_dir)
+        print("%-12s %10s %10s %16s" % ("mode", "sec", "peak MB", "size"))
+        for mode in ("original", "stream", "stream/4", "bigtiff"):
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_mode,
+                                              args=(scan_dir, tmp_dir, mode,
+                                                    args.threads, queue))
+            process.start()
+            dt, rss, size = queue.get()
+            process.join()
+            print("%-12s %10.2f %10.1f %16s" %
+                  (mode, dt, rss / 1024, "%ux%u" % size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Measure GUI style snapshot latency through CSImageProcessor.process_snapshots
+Uses a persistent engine like Argus does and reports p50 / p99
+
+Ex:
+./test/imagep/bench_snapshot_latency.py --plugins correct-sharp1,correct-vm1v1
+"""
+
+from uscope.imagep.pipeline import CSImageProcessor
+from uscope.microscope import get_virtual_microscope
+import argparse
+import numpy as np
+import time
+from PIL import Image
+
+
+def percentile(vals, p):
+    vals = sorted(vals)
+    i = min(len(vals) - 1, int(round(p / 100 * (len(vals) - 1))))
+    return vals[i]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark snapshot processing latency")
+    parser.add_argument("--microscope", default="mock")
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--plugins", default="correct-sharp1,correct-vm1v1")
+    args = parser.parse_args()
+
+    microscope = get_virtual_microscope(mconfig={"name": args.microscope})
+    plugins = [plugin for plugin in args.plugins.split(",") if plugin]
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(
+        rng.integers(0, 256, size=(args.height, args.width, 3),
+                     dtype=np.uint8))
+
+    def log(s):
+        pass
+
+    ip = CSImageProcessor(nthreads=args.threads,
+                          microscope=microscope,
+                          log=log)
+    ip.start()
+    ip.ready.wait(1.0)
+    try:
+        # Warm up
+        ip.process_snapshots([image], options={"plugins": plugins})
+        dts = []
+        for _i in range(args.iterations):
+            tstart = time.time()
+            ip.process_snapshots([image], options={"plugins": plugins})
+            dts.append(time.time() - tstart)
+    finally:
+        ip.shutdown()
+
+    print("Stages: %u (%s + FF if calibrated)" %
+          (len(plugins), ",".join(plugins)))
+    print("Iterations: %u" % len(dts))
+    print("p50: %0.1f ms" % (percentile(dts, 50) * 1000))
+    print("p99: %0.1f ms" % (percentile(dts, 99) * 1000))
+    print("max: %0.1f ms" % (max(dts) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Compare the strip based stabilization median against the original
+full stack np.median implementation
+Each method runs in its own process so peak RSS is measured independently
+Reports frames / sec, peak RSS above the decoded frames, and max abs diff
+
+Ex:
+./test/imagep/bench_stabilization.py --width 5440 --height 3648 --frames 8
+"""
+
+from uscope.imagep.plugins import stabilize_frames
+import argparse
+import multiprocessing
+import numpy as np
+import resource
+import time
+
+
+def make_frames(width, height, nframes, seed=0):
+    rng = np.random.default_rng(seed)
+    base = rng.integers(16, 240, size=(height, width, 3), dtype=np.uint8)
+    ret = []
+    for _i in range(nframes):
+        noise = rng.integers(-12, 13, size=base.shape, dtype=np.int16)
+        ret.append(np.clip(base + noise, 0, 255).astype(np.uint8))
+    return ret
+
+
+def legacy_median(arrays):
+    """
+    The original StabilizationPlugin._run() math
+    """
+    image_stack = np.concatenate([im[..., None] for im in arrays], axis=3)
+    median_array = np.median(image_stack, axis=3)
+    return median_array.astype(np.uint8)
+
+
+def maxrss_mb():
+    # Linux reports kB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def child(args, method, conn):
+    frames = make_frames(args.width, args.height, args.frames)
+    base_rss = maxrss_mb()
+    tstart = time.time()
+    if method == "legacy":
+        out = legacy_median(frames)
+    else:
+        out = stabilize_frames(frames,
+                               method=method,
+                               strip_rows=args.strip_rows)
+    dt = time.time() - tstart
+    conn.send((dt, maxrss_mb() - base_rss, out))
+
+
+def run(args, method):
+    ctx = multiprocessing.get_context("fork")
+    parent_conn, child_conn = ctx.Pipe()
+    process = ctx.Process(target=child, args=(args, method, child_conn))
+    process.start()
+    ret = parent_conn.recv()
+    process.join()
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark stabilization median memory / throughput")
+    parser.add_argument("--width", type=int, default=5440)
+    parser.add_argument("--height", type=int, default=3648)
+    parser.add_argument("--frames", type=int, default=8)
+    parser.add_argument("--strip-rows", type=int, default=64)
+    args = parser.parse_args()
+
+    frame_mb = args.width * args.height * 3 / 1e6
+    print("Frames: %u x %uw x %uh (%0.0f MB decoded)" %
+          (args.frames, args.width, args.height, frame_mb * args.frames))
+    print("%-14s %10s %14s %10s" %
+          ("method", "frames/s", "extra RSS MB", "max diff"))
+    ref = None
+    for method in ("legacy", "median", "trimmed-mean"):
+        dt, rss, out = run(args, method)
+        if ref is None:
+            ref = out
+        diff = np.abs(ref.astype(np.int16) - out.astype(np.int16)).max()
+        print("%-14s %10.2f %14.0f %10u" %
+              (method, args.frames / dt, rss, diff))
+
+
+if __name__ == "__main__":
+    main()
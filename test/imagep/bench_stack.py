@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Compare stack-native against stack-enfuse on a synthetic focus stack
+Each slice has a different band of the image in focus
+Reports slices / sec and PSNR against the all in focus source
+--jitter shifts each slice randomly to mimic stage z jitter
+and adds the in process aligner (stack_align.py) to the comparison
+
+Ex:
+./test/imagep/bench_stack.py --width 2048 --height 1536 --slices 8
+./test/imagep/bench_stack.py --jitter 12
+"""
+
+from uscope.imagep.focus_stack import PyramidFocusStacker
+from uscope.imagep.stack_align import StackAligner
+from uscope import config
+import argparse
+import cv2
+import numpy as np
+import os
+import subprocess
+import tempfile
+import time
+
+
+def synthetic_stack(width, height, slices, seed=0):
+    """
+    Return (sharp image, list of slices)
+    Focus plane sweeps left to right across the slices
+    """
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0,
+                         256,
+                         size=(height // 4, width // 4, 3),
+                         dtype=np.uint8)
+    sharp = cv2.resize(small, (width, height), interpolation=cv2.INTER_NEAREST)
+    sharp = cv2.GaussianBlur(sharp, (3, 3), 0)
+    blurred = [sharp] + [
+        cv2.GaussianBlur(sharp, (0, 0), sigma) for sigma in (1, 2, 4, 8)
+    ]
+    xs = np.arange(width, dtype=np.float32)
+    ret = []
+    for slicei in range(slices):
+        center = (slicei + 0.5) * width / slices
+        # Blur grows with distance from the focal band
+        dist = np.abs(xs - center) / (width / slices)
+        im = np.empty_like(sharp)
+        level = np.clip(dist.astype(int), 0, len(blurred) - 1)
+        for i, b in enumerate(blurred):
+            cols = level == i
+            im[:, cols] = b[:, cols]
+        ret.append(im)
+    return sharp, ret
+
+
+def jitter_slices(slices, jitter, seed=1):
+    """
+    Shift all but the middle slice by up to jitter pixels
+    Return (shifted slices, true (dx, dy) per slice)
+    """
+    rng = np.random.default_rng(seed)
+    ret = []
+    shifts = []
+    for i, im in enumerate(slices):
+        if i == len(slices) // 2:
+            dx, dy = 0, 0
+        else:
+            dx, dy = rng.integers(-jitter, jitter + 1, size=2)
+        m = np.float32([[1, 0, dx], [0, 1, dy]])
+        ret.append(
+            cv2.warpAffine(im,
+                           m, (im.shape[1], im.shape[0]),
+                           borderMode=cv2.BORDER_REPLICATE))
+        shifts.append((dx, dy))
+    return ret, shifts
+
+
+def crop_border(im, border):
+    if not border:
+        return im
+    return im[border:-border, border:-border]
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float32) - b.astype(np.float32))**2)
+    if mse == 0:
+        return float("inf")
+    return 10 * np.log10(255**2 / mse)
+
+
+def run_native(slices, hard_mask, align_method=None):
+    if align_method:
+        slices = StackAligner(method=align_method).align(slices)
+    stacker = PyramidFocusStacker(hard_mask=hard_mask)
+    for im in slices:
+        stacker.add(im)
+    return stacker.result()
+
+
+def run_enfuse(enfuse, slices, tmp_dir):
+    """
+    Mimic StackEnfusePlugin: .jpg slices => .tif => enfuse
+    """
+    fns = []
+    for i, im in enumerate(slices):
+        fn_jpg = os.path.join(tmp_dir, "slice_%04u.jpg" % i)
+        cv2.imwrite(fn_jpg, im[:, :, ::-1])
+        fn_tif = os.path.join(tmp_dir, "aligned_%04u.tif" % i)
+        subprocess.check_call(["convert", fn_jpg, fn_tif])
+        fns.append(fn_tif)
+    fn_out = os.path.join(tmp_dir, "out.jpg")
+    subprocess.check_call(list(enfuse) + [
+        "--exposure-weight=0", "--saturation-weight=0", "--contrast-weight=1",
+        "--hard-mask", "--output=" + fn_out
+    ] + fns,
+                          stdout=subprocess.DEVNULL)
+    return cv2.imread(fn_out)[:, :, ::-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark native focus stacking vs enfuse")
+    parser.add_argument("--width", type=int, default=2048)
+    parser.add_argument("--height", type=int, default=1536)
+    parser.add_argument("--slices", type=int, default=8)
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--no-enfuse", action="store_true")
+    parser.add_argument("--jitter",
+                        type=int,
+                        default=0,
+                        help="Max random slice shift in pixels")
+    args = parser.parse_args()
+
+    sharp, slices = synthetic_stack(args.width, args.height, args.slices)
+    print("Stack: %u slices of %uw x %uh" %
+          (args.slices, args.width, args.height))
+    if args.jitter:
+        slices, shifts = jitter_slices(slices, args.jitter)
+        tstart = time.time()
+        transforms = StackAligner().estimate(slices)
+        dt = time.time() - tstart
+        # Transform maps slice => reference so undoes the shift
+        err = max(
+            max(abs(transform[0, 2] + dx), abs(transform[1, 2] + dy))
+            for transform, (dx, dy) in zip(transforms, shifts))
+        print("Jitter: +/- %u px, phase estimate %0.3f s, max error %0.2f px" %
+              (args.jitter, dt, err))
+    print("%-16s %10s %10s %8s" % ("engine", "s / stack", "slices/s", "PSNR"))
+
+    def report(name, fn):
+        dts = []
+        for _i in range(args.iterations):
+            tstart = time.time()
+            out = fn()
+            dts.append(time.time() - tstart)
+        dt = min(dts)
+        # Shifted slices smear the replicated border
+        print("%-16s %10.3f %10.2f %8.2f" %
+              (name, dt, args.slices / dt,
+               psnr(crop_border(out, args.jitter),
+                    crop_border(sharp, args.jitter))))
+
+    report("native hard", lambda: run_native(slices, True))
+    report("native soft", lambda: run_native(slices, False))
+    if args.jitter:
+        report("native phase",
+               lambda: run_native(slices, True, align_method="phase"))
+        report("native ecc",
+               lambda: run_native(slices, True, align_method="ecc"))
+
+    enfuse = config.get_bc().enfuse_cli()
+    if args.no_enfuse:
+        pass
+    elif not enfuse:
+        print("enfuse: skip (not found)")
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report("enfuse", lambda: run_enfuse(enfuse, slices, tmp_dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Measure CSImageProcessor(nthreads=N) startup
+-lazy: plugins constructed on first use (default)
+-eager: every worker constructs every plugin up front (original behavior)
+Reports time until the engine is ready, time to the first completed task
+and shutdown time
+Each mode runs in its own process so one-time costs (imports, calibration
+cache) are paid the same way by both
+
+Ex:
+./test/imagep/bench_startup.py --threads 8
+"""
+
+import argparse
+import multiprocessing
+import numpy as np
+import time
+from PIL import Image
+
+
+def child(args, eager, conn):
+    from uscope.imagep.pipeline import CSImageProcessor
+    from uscope.microscope import get_virtual_microscope
+
+    microscope = get_virtual_microscope(mconfig={"name": args.microscope})
+
+    def log(s):
+        pass
+
+    im = Image.fromarray(np.zeros((args.height, args.width, 3),
+                                  dtype=np.uint8))
+    tstart = time.time()
+    ip = CSImageProcessor(nthreads=args.threads,
+                          microscope=microscope,
+                          log=log)
+    if eager:
+        for worker in ip.workers.values():
+            for task_name in list(worker.plugins.keys()):
+                worker.plugins[task_name]
+    ip.start()
+    ip.ready.wait(1.0)
+    tready = time.time()
+    ip.process_snapshots([im], options={"plugins": ["correct-sharp1"]})
+    tfirst = time.time()
+    ip.shutdown()
+    tshutdown = time.time()
+    conn.send((tready - tstart, tfirst - tstart, tshutdown - tfirst))
+
+
+def run(args, eager):
+    ctx = multiprocessing.get_context("fork")
+    parent_conn, child_conn = ctx.Pipe()
+    process = ctx.Process(target=child, args=(args, eager, child_conn))
+    process.start()
+    ret = parent_conn.recv()
+    process.join()
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark CSImageProcessor startup")
+    parser.add_argument("--microscope", default="mock")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    args = parser.parse_args()
+
+    print("CSImageProcessor: %u workers" % args.threads)
+    print("%-8s %10s %12s %12s" %
+          ("plugins", "ready ms", "first ms", "shutdown ms"))
+    for name, eager in (("eager", True), ("lazy", False)):
+        tready, tfirst, tshutdown = run(args, eager)
+        print("%-8s %10.1f %12.1f %12.1f" %
+              (name, tready * 1000, tfirst * 1000, tshutdown * 1000))
+
+
+if __name__ == "__main__":
+    main()
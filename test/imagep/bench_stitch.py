@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Local stitcher: time, peak memory and placement error
+-stitch: full run on a synthetic scan with stage error (--jitter)
+    error is vs the synthetic ground truth, prior is the stage position alone
+-solve: layout solve alone on a --solve-cols x --solve-rows grid
+    (no images) to see how it scales to thousands of tiles
+The stitch runs in its own process so peak RSS is its own
+
+Ex:
+./test/imagep/bench_stitch.py --cols 10 --rows 8 --width 2048 --height 1536 --jitter 40
+"""
+
+from uscope.imagep.synthetic import add_scan_args, scan_from_args
+from uscope.imagep.stitch import Stitcher, solve_layout
+from uscope.scan_util import index_scan_images
+import argparse
+import multiprocessing
+import numpy as np
+import os
+import resource
+import tempfile
+import time
+
+
+def max_error(scan, stitcher, positions):
+    truth = np.array([scan.tile_origin(*tile) for tile in stitcher.tiles],
+                     dtype=np.float64)
+    positions = np.array([positions[tile] for tile in stitcher.tiles],
+                         dtype=np.float64)
+    return np.abs((positions - positions[0]) - (truth - truth[0])).max()
+
+
+def run(args, scan_dir, out_dir, queue):
+    scan = scan_from_args(args)
+    stitcher = Stitcher(index_scan_images(scan_dir),
+                        os.path.join(out_dir, "stitch.jpg"),
+                        threads=args.threads,
+                        verbose=False)
+    tstart = time.time()
+    stitcher.run()
+    dt = time.time() - tstart
+    # KiB on Linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((dt, rss, max_error(scan, stitcher, stitcher.priors),
+               max_error(scan, stitcher, stitcher.layout),
+               "%ux%u" % (stitcher.width, stitcher.height)))
+
+
+def bench_solve(cols, rows, jitter):
+    rng = np.random.default_rng(0)
+    index = np.arange(cols * rows).reshape(rows, cols)
+    truth = np.stack(np.meshgrid(np.arange(cols), np.arange(rows)),
+                     axis=-1).reshape(-1, 2) * 1000.0
+    truth += rng.uniform(-jitter, jitter, truth.shape)
+    ia = np.concatenate([index[:, :-1].ravel(), index[:-1, :].ravel()])
+    ib = np.concatenate([index[:, 1:].ravel(), index[1:, :].ravel()])
+    offsets = truth[ib] - truth[ia] + rng.normal(0, 0.3, (len(ia), 2))
+    priors = np.stack(np.meshgrid(np.arange(cols), np.arange(rows)),
+                      axis=-1).reshape(-1, 2) * 1000.0
+    tstart = time.time()
+    positions = solve_layout(ia, ib, offsets, np.ones(len(ia)), priors)
+    dt = time.time() - tstart
+    error = np.abs((positions - positions[0]) - (truth - truth[0])).max()
+    return dt, error
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark local stitcher")
+    add_scan_args(parser)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--solve-cols", type=int, default=60)
+    parser.add_argument("--solve-rows", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scan_dir = os.path.join(tmp_dir, "scan")
+        scan_from_args(args).write(scan_dir)
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run,
+                                          args=(args, scan_dir, tmp_dir,
+                                                queue))
+        process.start()
+        dt, rss, prior_error, error, size = queue.get()
+        process.join()
+    print("%-8s %10s %10s %12s %12s %16s" %
+          ("mode", "sec", "peak MB", "prior err", "max err", "size"))
+    print("%-8s %10.2f %10.1f %12.1f %12.1f %16s" %
+          ("stitch", dt, rss / 1024, prior_error, error, size))
+    dt, error = bench_solve(args.solve_cols, args.solve_rows, args.jitter)
+    print("%-8s %10.2f %10s %12.1f %12.1f %16s" %
+          ("solve", dt, "", args.jitter, error, "%u tiles" %
+           (args.solve_cols * args.solve_rows)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Simulate a scan being captured and compare:
+-StreamCSIP: process buckets while the scan is running
+-DirCSIP: process everything after the scan completes
+Reports time from last capture to fully processed
+
+Ex:
+./test/imagep/bench_stream.py --cols 4 --rows 3 --stack 3 --hdr 2 --capture-ms 100
+"""
+
+from uscope.imagep.pipeline import CSImageProcessor
+from uscope.imagep.streams import PlannerImageStream
+from uscope.microscope import get_virtual_microscope
+import argparse
+import numpy as np
+import os
+import tempfile
+import threading
+import time
+from PIL import Image
+
+
+class SimulatedScan(threading.Thread):
+    """
+    Write tiles to disk at a fixed rate like PlannerSaveImage
+    """
+    def __init__(self, args, directory, stream=None):
+        super().__init__()
+        self.args = args
+        self.directory = directory
+        self.stream = stream
+        self.tend = None
+
+    def run(self):
+        args = self.args
+        rng = np.random.default_rng(0)
+        base = rng.integers(0,
+                            256,
+                            size=(args.height, args.width, 3),
+                            dtype=np.uint8)
+        for row in range(args.rows):
+            for col in range(args.cols):
+                for stacki in range(args.stack):
+                    for hdri in range(args.hdr):
+                        tstart = time.time()
+                        fn = os.path.join(
+                            self.directory, "c%03u_r%03u_z%02u_h%02u.jpg" %
+                            (col, row, stacki, hdri))
+                        im = (base >> hdri) + np.uint8(stacki)
+                        Image.fromarray(im).save(fn, quality=90)
+                        if self.stream:
+                            self.stream.emit_image(fn)
+                        dt = time.time() - tstart
+                        time.sleep(max(0, self.args.capture_ms / 1000.0 - dt))
+        self.tend = time.time()
+        if self.stream:
+            self.stream.finish()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark StreamCSIP vs DirCSIP on a simulated scan")
+    parser.add_argument("--microscope", default="mock")
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--cols", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=3)
+    parser.add_argument("--stack", type=int, default=3)
+    parser.add_argument("--hdr", type=int, default=2)
+    parser.add_argument("--capture-ms", type=float, default=100)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--hdr-plugin", default="hdr-mertens")
+    parser.add_argument("--stack-plugin", default="stack-native")
+    args = parser.parse_args()
+
+    microscope = get_virtual_microscope(mconfig={"name": args.microscope})
+    pconfig = {
+        "imager": {
+            "hdr": {
+                "properties_list": [{}] * args.hdr
+            }
+        },
+        "points-stacker": {
+            "number": args.stack
+        },
+    }
+    configj = {
+        "hdr_plugin": args.hdr_plugin,
+        "stack_plugin": args.stack_plugin,
+        "cloud_stitch": False,
+    }
+
+    def log(s):
+        pass
+
+    def run(streaming):
+        with tempfile.TemporaryDirectory() as directory:
+            ip = CSImageProcessor(nthreads=args.threads,
+                                  microscope=microscope,
+                                  log=log)
+            ip.start()
+            ip.ready.wait(1.0)
+            try:
+                if streaming:
+                    stream = PlannerImageStream(pconfig, directory)
+                    scan = SimulatedScan(args, directory, stream)
+                    scan.start()
+                    ip.process_stream(stream, upload=False, configj=configj)
+                else:
+                    scan = SimulatedScan(args, directory)
+                    scan.start()
+                    scan.join()
+                    ip.process_dir(directory, upload=False, configj=configj)
+                tdone = time.time()
+                scan.join()
+            finally:
+                ip.shutdown()
+            outputs = len(os.listdir(os.path.join(directory, "hdr", "stack")))
+            return tdone - scan.tend, outputs
+
+    print("Scan: %u x %u tiles, %u stack x %u hdr, %u ms / capture" %
+          (args.cols, args.rows, args.stack, args.hdr, args.capture_ms))
+    print("%-10s %20s %8s" % ("engine", "after last capture", "tiles"))
+    for name, streaming in (("DirCSIP", False), ("StreamCSIP", True)):
+        dt, outputs = run(streaming)
+        print("%-10s %18.2f s %8u" % (name, dt, outputs))
+
+
+if __name__ == "__main__":
+    main()
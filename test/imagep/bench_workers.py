@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+CSImageProcessor worker scaling
+Runs each plugin stage on synthetic frames at 1 to N workers
+and reports images / sec + speedup relative to 1 worker
+Each worker runs one task before timing starts
+so plugin construction / first call overhead isn't counted
+
+Ex:
+./test/imagep/bench_workers.py --width 5440 --height 3648 --images 32
+"""
+
+from uscope.imagep.pipeline import CSImageProcessor
+from uscope.imagep.util import TaskBarrier
+from uscope.microscope import get_virtual_microscope
+import argparse
+import multiprocessing
+import numpy as np
+import os
+import tempfile
+import time
+from PIL import Image
+
+
+def write_frames(dir_out, n, width, height):
+    fns = []
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    for i in range(n):
+        noise = rng.integers(0, 8, size=(height, width, 3), dtype=np.uint8)
+        fn = os.path.join(dir_out, "frame_%04u.jpg" % i)
+        Image.fromarray(base + noise).save(fn, quality=90)
+        fns.append(fn)
+    return fns
+
+
+def run_stage(ip, stage, fns_in, dir_out, bucket_size):
+    tb = TaskBarrier()
+    if stage == "stabilization" or stage.startswith(("hdr-", "stack-")):
+        for i in range(0, len(fns_in) - bucket_size + 1, bucket_size):
+            ip.queue_n_to_1_plugin(task_name=stage,
+                                   fns_in=fns_in[i:i + bucket_size],
+                                   fn_out=os.path.join(dir_out,
+                                                       "out_%04u.jpg" % i),
+                                   tb=tb)
+    else:
+        for i, fn_in in enumerate(fns_in):
+            ip.queue_1_to_1_plugin(plugin=stage,
+                                   fn_in=fn_in,
+                                   fn_out=os.path.join(dir_out,
+                                                       "out_%04u.jpg" % i),
+                                   tb=tb)
+    tb.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark CSImageProcessor worker scaling")
+    parser.add_argument("--microscope", default="mock")
+    parser.add_argument("--width", type=int, default=2048)
+    parser.add_argument("--height", type=int, default=1536)
+    parser.add_argument("--images", type=int, default=32)
+    parser.add_argument("--bucket-size", type=int, default=4)
+    parser.add_argument("--max-workers",
+                        type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument("--stages",
+                        default="stabilization,correct-sharp1,correct-vm1v1")
+    args = parser.parse_args()
+
+    microscope = get_virtual_microscope(mconfig={"name": args.microscope})
+    nworkers = []
+    n = 1
+    while n < args.max_workers:
+        nworkers.append(n)
+        n *= 2
+    nworkers.append(args.max_workers)
+
+    def log(s):
+        pass
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fns_in = write_frames(tmp_dir, args.images, args.width, args.height)
+        print("%-16s %8s %10s %8s" %
+              ("stage", "workers", "images/s", "speedup"))
+        for stage in args.stages.split(","):
+            base_rate = None
+            for workers in nworkers:
+                ip = CSImageProcessor(nthreads=workers,
+                                      microscope=microscope,
+                                      log=log)
+                ip.start()
+                ip.ready.wait(1.0)
+                try:
+                    # Warm up: at least one task per worker
+                    with tempfile.TemporaryDirectory() as dir_out:
+                        run_stage(ip, stage,
+                                  fns_in[:workers * args.bucket_size], dir_out,
+                                  args.bucket_size)
+                    with tempfile.TemporaryDirectory() as dir_out:
+                        tstart = time.time()
+                        run_stage(ip, stage, fns_in, dir_out, args.bucket_size)
+                        dt = time.time() - tstart
+                finally:
+                    ip.shutdown()
+                rate = len(fns_in) / dt
+                if base_rate is None:
+                    base_rate = rate
+                print("%-16s %8u %10.2f %7.2fx" %
+                      (stage, workers, rate, rate / base_rate))
+
+
+if __name__ == "__main__":
+    main()
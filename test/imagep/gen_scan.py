@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+Write a synthetic scan directory that cs_auto / DirCSIP can process
+
+Ex:
+./test/imagep/gen_scan.py --cols 8 --rows 6 --stack 5 --hdr 3 /tmp/scan
+./utils/cs_auto.py --no-upload --microscope mock /tmp/scan
+"""
+
+from uscope.imagep.synthetic import add_scan_args, scan_from_args
+import argparse
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic scan")
+    add_scan_args(parser)
+    parser.add_argument("--microscope", default="mock")
+    parser.add_argument("dir_out")
+    args = parser.parse_args()
+
+    scan = scan_from_args(args, microscope=args.microscope)
+    tstart = time.time()
+    n = scan.write(args.dir_out)
+    print("Wrote %u images to %s in %0.1f sec" %
+          (n, args.dir_out, time.time() - tstart))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Image processing engine / kernels
+No hardware needed
+"""
+
+import unittest
+import concurrent.futures
+import os
+import tempfile
+import threading
+import numpy as np
+from unittest import mock
+from PIL import Image
+from uscope.imagep.plugins import ff_gain_map, ff_apply_gain, stabilize_frames
+from uscope.imagep.pipeline import CSImageProcessor
+from uscope.imagep.streams import DirCSIP
+from uscope.imagep.synthetic import SyntheticScan
+from uscope.imagep.util import CSIPTaskError
+from uscope.scan_util import IIndexCache
+from uscope import scan_util
+from uscope.microscope import get_virtual_microscope
+
+# (peak, falloff) per band
+SHALLOW_VIGNETTE = ((235, 1.6), (245, 1.2), (225, 2.0))
+# Corners fall to single digits
+DEEP_VIGNETTE = ((235, 1.97), (245, 1.98), (225, 1.95))
+
+
+def vignette_ff(width=320, height=240, bands=SHALLOW_VIGNETTE, floor=3):
+    """
+    Bright center falling off towards the corners
+    floor: corners bottom out at peak / floor (None: at 1)
+    """
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float64)
+    r2 = ((xs - width / 2) / width)**2 + ((ys - height / 2) / height)**2
+    ret = np.empty((height, width, 3), dtype=np.uint8)
+    for band, (peak, falloff) in enumerate(bands):
+        low = peak / floor if floor else 1
+        ret[:, :, band] = np.clip(peak * (1 - falloff * r2), low, 255)
+    return ret
+
+
+class FF1TestCase(unittest.TestCase):
+    def check_matches_float(self, ff):
+        maxes = ff.reshape(-1, 3).max(axis=0)
+        rng = np.random.default_rng(0)
+        im = rng.integers(0, 256, size=ff.shape, dtype=np.uint8)
+        gain, shift = ff_gain_map(ff, maxes)
+        # Odd strip size to cover the partial last strip
+        got = ff_apply_gain(im, gain, shift, strip_rows=37)
+        ref = np.minimum(np.round(im * (maxes / ff.astype(np.float64))), 255)
+        self.assertLessEqual(np.abs(got.astype(int) - ref).max(), 1)
+
+    def test_fixed_matches_float(self):
+        self.check_matches_float(vignette_ff())
+
+    def test_deep_vignette_matches_float(self):
+        ff = vignette_ff(bands=DEEP_VIGNETTE, floor=None)
+        self.assertLess(ff.max(axis=2).min(), 10)
+        self.check_matches_float(ff)
+
+    def test_dead_pixel_passes_through(self):
+        ff = vignette_ff()
+        maxes = ff.reshape(-1, 3).max(axis=0)
+        gain, shift = ff_gain_map(ff, maxes)
+        ff[10, 10] = 0
+        dead_gain, dead_shift = ff_gain_map(ff, maxes)
+        # Doesn't cost the rest of the frame precision
+        self.assertEqual(shift, dead_shift)
+        im = np.full(ff.shape, 200, dtype=np.uint8)
+        got = ff_apply_gain(im, dead_gain, dead_shift)
+        np.testing.assert_array_equal(got[10, 10], im[10, 10])
+
+
+class StabilizeTestCase(unittest.TestCase):
+    def frames(self, n):
+        rng = np.random.default_rng(n)
+        return [
+            rng.integers(0, 256, size=(50, 40, 3), dtype=np.uint8)
+            for _i in range(n)
+        ]
+
+    def test_median_matches_numpy(self):
+        # Odd and even frame counts take different paths
+        for n in (3, 4, 5):
+            frames = self.frames(n)
+            # Odd strip size to cover the partial last strip
+            got = stabilize_frames(frames, method="median", strip_rows=7)
+            ref = np.median(np.stack(frames), axis=0).astype(np.uint8)
+            np.testing.assert_array_equal(got, ref)
+
+    def test_trimmed_mean_matches_numpy(self):
+        for n, trim in ((4, 0.25), (5, 0.2), (6, 0.25), (3, 0.5)):
+            frames = self.frames(n)
+            got = stabilize_frames(frames,
+                                   method="trimmed-mean",
+                                   trim=trim,
+                                   strip_rows=7)
+            ntrim = min(int(n * trim), (n - 1) // 2)
+            kept = np.sort(np.stack(frames), axis=0)[ntrim:n - ntrim]
+            ref = np.floor(kept.mean(axis=0) + 0.5).astype(np.uint8)
+            np.testing.assert_array_equal(got, ref)
+
+
+class CSIPTestCase(unittest.TestCase):
+    """
+    Live worker pool on the mock microscope
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.microscope = get_virtual_microscope(mconfig={"name": "mock"})
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.directory = self.tmp_dir.name
+        self.csip = CSImageProcessor(nthreads=1,
+                                     microscope=self.microscope,
+                                     log=lambda s: None)
+        self.csip.start()
+        self.csip.ready.wait(1.0)
+        self.addCleanup(self.csip.shutdown)
+
+    def write_frames(self, n=3):
+        rng = np.random.default_rng(0)
+        ret = []
+        for i in range(n):
+            fn = os.path.join(self.directory, "c000_r000_s%02u.jpg" % i)
+            im = rng.integers(0, 256, size=(48, 64, 3), dtype=np.uint8)
+            Image.fromarray(im).save(fn)
+            ret.append(fn)
+        return ret
+
+
+class CacheTestCase(CSIPTestCase):
+    """
+    Lazy processing reuses an output only if nothing that made it changed
+    """
+    def setUp(self):
+        super().setUp()
+        self.fns_in = self.write_frames()
+        self.fn_out = os.path.join(self.directory, "c000_r000.jpg")
+
+    def process(self, options={}):
+        """
+        Return True if the task ran, False if the manifest skipped it
+        """
+        dir_csip = DirCSIP(self.csip,
+                           self.directory,
+                           upload=False,
+                           microscope=self.microscope,
+                           verbose=False)
+        future = dir_csip.queue_task("stabilization",
+                                     self.fns_in,
+                                     self.fn_out,
+                                     n_to_1=True,
+                                     options=options)
+        if future:
+            future.result(timeout=30)
+        dir_csip.manifest.save()
+        return future is not None
+
+    def test_unchanged_skips(self):
+        self.assertTrue(self.process())
+        self.assertFalse(self.process())
+
+    def test_option_reruns(self):
+        self.assertTrue(self.process({"method": "median"}))
+        self.assertTrue(self.process({"method": "trimmed-mean"}))
+        self.assertFalse(self.process({"method": "trimmed-mean"}))
+
+    def test_input_mtime_reruns(self):
+        self.assertTrue(self.process())
+        st = os.stat(self.fns_in[1])
+        os.utime(self.fns_in[1], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertTrue(self.process())
+        self.assertFalse(self.process())
+
+    def test_missing_output_fails_once(self):
+        dir_csip = DirCSIP(self.csip,
+                           self.directory,
+                           upload=False,
+                           microscope=self.microscope,
+                           verbose=False)
+        # Plugin "succeeds" without writing anything
+        for worker in self.csip.workers.values():
+            mock.patch.object(worker, "run_plugin").start()
+        self.addCleanup(mock.patch.stopall)
+        session = self.csip.tracer.begin()
+        future = dir_csip.queue_task("stabilization",
+                                     self.fns_in,
+                                     self.fn_out,
+                                     n_to_1=True)
+        with self.assertRaises(CSIPTaskError):
+            future.result(timeout=30)
+        self.csip.tracer.end(session)
+        self.assertEqual(len(session.tasks), 1)
+        self.assertEqual(dir_csip.manifest.entries, {})
+
+
+class DAGTestCase(CSIPTestCase):
+    """
+    Per tile scheduling gives the same outputs as stage by stage
+    """
+    def process(self, dag):
+        directory = os.path.join(self.directory, "dag" if dag else "stages")
+        os.mkdir(directory)
+        scan = SyntheticScan(cols=2,
+                             rows=2,
+                             width=128,
+                             height=96,
+                             stack=2,
+                             hdr=2)
+        scan.write(directory)
+        self.csip.process_dir(directory,
+                              upload=False,
+                              lazy=False,
+                              verbose=False,
+                              configj={
+                                  "dag_schedule": dag,
+                                  "hdr_plugin": "hdr-mertens",
+                                  "stack_plugin": "stack-native",
+                                  "cloud_stitch": False,
+                                  "write_html_viewer": False,
+                              })
+        ret = {}
+        for root, _dirs, files in os.walk(directory):
+            for fn in files:
+                if fn.endswith(".jpg"):
+                    fn = os.path.join(root, fn)
+                    ret[os.path.relpath(fn, directory)] = np.asarray(
+                        Image.open(fn))
+        return ret
+
+    def test_matches_stages(self):
+        dag = self.process(True)
+        stages = self.process(False)
+        self.assertEqual(sorted(dag), sorted(stages))
+        self.assertIn(os.path.join("hdr", "stack", "c000_r000.jpg"), dag)
+        for fn, im in stages.items():
+            np.testing.assert_array_equal(dag[fn], im, err_msg=fn)
+
+
+class FutureTestCase(CSIPTestCase):
+    def test_cancelled_never_runs(self):
+        fns_in = self.write_frames()
+        started = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+        ran = []
+        worker = next(iter(self.csip.workers.values()))
+        run_plugin = worker.run_plugin
+
+        def blocking_run_plugin(ip_params):
+            ran.append(ip_params.data_out["image"].want_fn)
+            started.set()
+            release.wait(30)
+            return run_plugin(ip_params)
+
+        mock.patch.object(worker,
+                          "run_plugin",
+                          side_effect=blocking_run_plugin).start()
+        self.addCleanup(mock.patch.stopall)
+
+        fns_out = [
+            os.path.join(self.directory, "out_%u.jpg" % i) for i in range(3)
+        ]
+        callbacks = []
+        first = self.csip.queue_stabilization(fns_in=fns_in, fn_out=fns_out[0])
+        # Only worker is busy => the next tasks stay queued
+        self.assertTrue(started.wait(30))
+        cancelled = self.csip.queue_stabilization(
+            fns_in=fns_in,
+            fn_out=fns_out[1],
+            callback=lambda _ip_params, result, _info: callbacks.append(result
+                                                                        ))
+        last = self.csip.queue_stabilization(fns_in=fns_in, fn_out=fns_out[2])
+        self.assertTrue(cancelled.cancel())
+        release.set()
+        first.result(timeout=30)
+        # Queued after the cancelled task => the worker got past it
+        last.result(timeout=30)
+        with self.assertRaises(concurrent.futures.CancelledError):
+            cancelled.result(timeout=30)
+        self.assertEqual(ran, [fns_out[0], fns_out[2]])
+        self.assertEqual(callbacks, ["cancelled"])
+        self.assertFalse(os.path.exists(fns_out[1]))
+
+
+class IIndexCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.directory = self.tmp_dir.name
+        self.cache = IIndexCache()
+        self.touch("c000_r000.jpg")
+        self.touch("c001_r000.jpg")
+        # Settled directory: outside the racy window
+        st = os.stat(self.directory)
+        os.utime(self.directory,
+                 ns=(st.st_atime_ns, st.st_mtime_ns - 60 * 10**9))
+
+    def touch(self, basename):
+        # Index only looks at file names
+        open(os.path.join(self.directory, basename), "wb").close()
+
+    def index(self):
+        return set(self.cache.index(self.directory)["images"])
+
+    def listing(self):
+        return mock.patch("uscope.scan_util.list_scan_images",
+                          wraps=scan_util.list_scan_images)
+
+    def test_unchanged_reuses(self):
+        self.index()
+        with self.listing() as listing:
+            self.assertEqual(self.index(), {"c000_r000.jpg", "c001_r000.jpg"})
+        listing.assert_not_called()
+
+    def test_added_file(self):
+        self.index()
+        self.touch("c002_r000.jpg")
+        self.assertEqual(self.index(),
+                         {"c000_r000.jpg", "c001_r000.jpg", "c002_r000.jpg"})
+
+    def test_touched_directory_relists(self):
+        self.index()
+        os.utime(self.directory)
+        with self.listing() as listing:
+            self.assertEqual(self.index(), {"c000_r000.jpg", "c001_r000.jpg"})
+        listing.assert_called_once()
+
+    def test_added_same_mtime(self):
+        self.touch("c002_r000.jpg")
+        mtime_ns = os.stat(self.directory).st_mtime_ns
+        self.index()
+        # Added within the directory mtime resolution
+        self.touch("c003_r000.jpg")
+        os.utime(self.directory, ns=(mtime_ns, mtime_ns))
+        self.assertIn("c003_r000.jpg", self.index())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,6 +2,7 @@ from uscope.planner.planner_util import get_planner
 from uscope.planner.planner import PlannerStop
 from uscope.benchmark import Benchmark
 from uscope import cloud_stitch
+from uscope.scan_catalog import get_scan_catalog, error_str
 from uscope.imagep.thread import ImageProcessingThreadBase
 from uscope.planner.thread import PlannerThreadBase
 from uscope.motion.thread import MotionThreadBase
@@ -13,6 +14,7 @@ import traceback
 import time
 import subprocess
 import psutil
+import sqlite3
 import sys
 import json
 import platform
@@ -59,6 +61,16 @@ class StitcherThread(CommandThreadBase, ArgusThread):
     def log(self, msg):
         self.log_msg.emit(msg)
 
+    def catalog_call(self, method, directory, *args, **kwargs):
+        """
+        Record scan progress in the scan catalog
+        Best effort: a broken catalog shouldn't fail processing
+        """
+        try:
+            getattr(get_scan_catalog(), method)(directory, *args, **kwargs)
+        except sqlite3.Error as e:
+            self.log(f"WARNING: scan catalog {method}: {e}")
+
     # Offload uploads etc to thread since they might take a while
     def cloud_stitch_add(
         self,
@@ -74,10 +86,20 @@ class StitcherThread(CommandThreadBase, ArgusThread):
         self.command("cloud_stitch", j)
 
     def _cloud_stitch(self, j):
-        cloud_stitch.upload_dir(directory=j["directory"],
-                                cs_info=j["cs_info"],
-                                log=self.log,
-                                running=self.running)
+        self.catalog_call("stage_begin", j["directory"], "upload")
+        try:
+            cloud_stitch.upload_dir(directory=j["directory"],
+                                    cs_info=j["cs_info"],
+                                    log=self.log,
+                                    running=self.running)
+        except Exception as e:
+            self.catalog_call("stage_end",
+                              j["directory"],
+                              "upload",
+                              error=error_str(e))
+            raise
+        self.catalog_call("stage_end", j["directory"], "upload")
+        self.catalog_call("mark_uploaded", j["directory"])
 
     def _imagep(self, j):
         self._imagep_run(j)
@@ -107,7 +129,13 @@ class StitcherThread(CommandThreadBase, ArgusThread):
         directory,
         cs_info=None,
         ippj={},
+        stream_thread=None,
     ):
+        """
+        stream_thread: in progress stream processing of the scan
+        Waited on so cs_auto sees its results
+        """
+        self.catalog_call("scan_captured", directory)
         j = {
             #"type": "imagep",
             "directory": directory,
@@ -115,6 +143,8 @@ class StitcherThread(CommandThreadBase, ArgusThread):
         }
         if cs_info is not None:
             j["cs_info"] = cs_info
+        if stream_thread is not None:
+            j["stream_thread"] = stream_thread
         self.command("imagep", j)
 
     def process_run(self, args, variant, directory_comment):
@@ -154,6 +184,11 @@ class StitcherThread(CommandThreadBase, ArgusThread):
 
         self.log(f"Process scan: starting {j['directory']}")
 
+        stream_thread = j.get("stream_thread")
+        if stream_thread:
+            self.log("Process scan: waiting for stream processing")
+            stream_thread.join()
+
         if not cs_auto_cli and not simple_cli:
             self.log(
                 "Process scan: WARNING: no image processing engines are configured"
@@ -203,6 +238,9 @@ class StitcherThread(CommandThreadBase, ArgusThread):
                 self.log(f"Process scan: completed {j['directory']}")
         else:
             self.log(f"Process scan: error on {j['directory']}")
+            # cs_auto records its own failures, but not the custom CLI's
+            self.catalog_call("failed", j["directory"],
+                              "Process scan: external command failed")
 
 
 class QMotionThread(MotionThreadBase, ArgusThread):
@@ -727,6 +727,22 @@ class USCImageProcessingPipeline:
         """
         return self.j.get("snapshot_correction", [])
 
+    def hdr_plugin(self):
+        """
+        Plugin used to merge HDR exposures
+        hdr-enfuse: external enfuse
+        hdr-mertens: in process OpenCV exposure fusion
+        """
+        return self.j.get("hdr_plugin", "hdr-enfuse")
+
+    def stack_plugin(self):
+        """
+        Plugin used to focus stack scans
+        stack-enfuse: external enfuse (+ align_image_stack)
+        stack-native: in process Laplacian pyramid
+        """
+        return self.j.get("stack_plugin", "stack-enfuse")
+
     # plugin specific options
     def get_plugin(self, name):
         return self.j.get("plugins", {}).get(name, {})
@@ -1236,6 +1252,10 @@ class BaseConfig:
         if not os.path.exists(self._script_data_dir):
             os.mkdir(self._script_data_dir)
 
+        self._cache_dir = os.path.join(self.get_data_dir(), "cache")
+        if not os.path.exists(self._cache_dir):
+            os.mkdir(self._cache_dir)
+
     def cache_constants(self):
         raw = self.j.get("timeout_scalar", "1.0")
         if raw is None:
@@ -1276,6 +1296,20 @@ class BaseConfig:
         """
         return self._script_data_dir
 
+    def cache_dir(self):
+        """
+        Directory holding derived data that can be regenerated at any time
+        Ex: preprocessed calibration arrays
+        """
+        return self._cache_dir
+
+    def scan_catalog_fn(self):
+        """
+        SQLite database tracking scan processing / upload state
+        See uscope.scan_catalog
+        """
+        return os.path.join(self.get_data_dir(), "scan_catalog.sqlite")
+
     def labsmore_stitch_use_xyfstitch(self):
         """
         xyfstitch is the newer higher fidelity stitch engine
@@ -1321,6 +1355,13 @@ class BaseConfig:
         """
         return self.j.get("argus_cs_auto", "./utils/cs_auto.py")
 
+    def argus_stream_processing(self):
+        """
+        Process HDR / stack buckets as the scan captures them
+        cs_auto then only has the leftovers to do
+        """
+        return bool(self.j.get("argus_stream_processing", False))
+
     def dev_mode(self):
         """
         Display unsightly extra information
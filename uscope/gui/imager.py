@@ -104,7 +104,12 @@ class GstGUIImager(Imager):
     def get_processed(self,
                       recover_errors=True,
                       snapshot_timeout=None,
-                      processing_timeout=None):
+                      processing_timeout=None,
+                      priority="interactive"):
+        """
+        priority: CSImageProcessor priority class
+            (ex: "planner" while a scan is running)
+        """
         if processing_timeout is None:
             processing_timeout = self.ac.microscope.usc.imager.processing_timeout(
             )
@@ -131,6 +136,7 @@ class GstGUIImager(Imager):
             options["objective_config"] = self.ac.objective_config()
             options["scale_factor"] = self.ac.usc.imager.scalar()
             options["scale_expected_wh"] = self.ac.usc.imager.final_wh()
+            options["priority"] = priority
             if self.ac.usc.imager.videoflip_method():
                 options[
                     "videoflip_method"] = self.ac.usc.imager.videoflip_method(
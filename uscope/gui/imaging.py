@@ -5,6 +5,7 @@ from uscope.gui.widgets import AWidget, ArgusTab
 from uscope.motion import motion_util
 from uscope.benchmark import Benchmark
 from uscope.app.argus.threads import QPlannerThread
+from uscope.imagep.streams import PlannerImageStream
 from uscope.microscope import StopEvent, MicroscopeStop
 
 from PyQt5 import Qt
@@ -1431,6 +1432,11 @@ class ImagingTaskWidget(AWidget):
         if self.restore_properties:
             self.ac.imager.set_properties(self.restore_properties)
 
+        image_stream = last_scan_config.get("image_stream")
+        if image_stream:
+            # Normally already finished by the planner's meta event
+            image_stream.finish(ok=result["result"] == "ok")
+
         if result["result"] == "ok":
             self.ac.stitchingTab.scan_completed(last_scan_config, result)
 
@@ -1482,7 +1488,20 @@ class ImagingTaskWidget(AWidget):
                 self.plannerDone({"result": "init_failure"})
                 return
 
+            # Start HDR / stacking as tiles come in
+            # cs_auto picks up the results from the processing manifest
+            image_stream = None
+            if not dry and self.ac.microscope.bc.argus_stream_processing():
+                image_stream = PlannerImageStream(pconfig, out_dir)
+                ippj = pconfig.get("ipp", {})
+                stream_thread = self.ac.image_processing_thread.process_stream(
+                    image_stream, configj=ippj)
+                self.current_scan_config["image_stream"] = image_stream
+                self.current_scan_config["stream_thread"] = stream_thread
+
             def emitCncProgress(state):
+                if image_stream:
+                    image_stream.planner_progress(state)
                 self.ac.cncProgress.emit(state)
 
             # not sure if this is the right place to add this
@@ -1007,8 +1007,10 @@ class StitchingTab(ArgusTab):
             self.ac.log(
                 f"Aborting stitch: directory does not exist: {directory}")
             return
+        stream_thread = None
         if scan_config is not None:
             ippj = scan_config["pconfig"].get("ipp", {})
+            stream_thread = scan_config.get("stream_thread")
         else:
             ippj = {}
             self.ac.mainTab.imaging_widget.update_ippj(ippj)
@@ -1025,6 +1027,7 @@ class StitchingTab(ArgusTab):
             directory=directory,
             cs_info=cs_info,
             ippj=ippj,
+            stream_thread=stream_thread,
         )
 
     def get_cs_info(self):
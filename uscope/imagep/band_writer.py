@@ -0,0 +1,335 @@
+"""
+Streaming image writers for summary images too big to build in memory
+
+Rows are fed top to bottom a band at a time (ex: one row of scan tiles)
+and are regrouped into fixed size chunks that are encoded and written
+as soon as they are complete
+Only about one chunk is buffered, regardless of image size
+
+JPEGBandWriter: each chunk is encoded as its own JPEG with identical
+tables and the entropy coded data is concatenated
+with restart markers in between, which resets the decoder state
+Result is a normal baseline JPEG
+Chunks are encoded in parallel if given an executor
+
+BigTIFFWriter: tiled, deflate compressed with the horizontal predictor
+which any reasonable TIFF reader (libtiff, Pillow, tifffile, vips) supports
+For images beyond the JPEG limit (65535 pixels per side)
+"""
+
+from collections import deque
+import io
+import numpy as np
+import struct
+import zlib
+from PIL import Image
+
+# TIFF tags
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_PHOTOMETRIC = 262
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_PLANAR_CONFIG = 284
+TAG_PREDICTOR = 317
+TAG_TILE_WIDTH = 322
+TAG_TILE_LENGTH = 323
+TAG_TILE_OFFSETS = 324
+TAG_TILE_BYTE_COUNTS = 325
+
+# TIFF types
+TYPE_SHORT = 3
+TYPE_LONG = 4
+TYPE_LONG8 = 16
+
+COMPRESSION_DEFLATE = 8
+PREDICTOR_HORIZONTAL = 2
+
+# mode: (samples per pixel, TIFF photometric)
+MODES = {
+    "L": (1, 1),
+    "RGB": (3, 2),
+}
+
+# JPEG markers
+MARKER_SOF0 = 0xC0
+MARKER_DRI = 0xDD
+MARKER_SOS = 0xDA
+MARKER_RST0 = 0xD0
+MARKER_EOI = 0xD9
+
+
+class BandWriter:
+    """
+    Regroups incoming rows into chunks of chunk_rows
+    Subclasses implement write_chunk() and finish()
+    """
+    def __init__(self, width, height, mode, chunk_rows):
+        if mode not in MODES:
+            raise ValueError(f"Unsupported mode {mode}")
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.samples = MODES[mode][0]
+        self.chunk_rows = chunk_rows
+        # Rows received but not yet written as a full chunk
+        self.pending = deque()
+        self.pending_rows = 0
+        self.rows_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write_rows(self, rows):
+        """
+        rows: uint8 array (n, width) or (n, width, samples)
+        Next n rows of the image
+        """
+        rows = np.asarray(rows, dtype=np.uint8)
+        rows = rows.reshape(rows.shape[0], self.width, self.samples)
+        self.pending.append(rows)
+        self.pending_rows += rows.shape[0]
+        while self.pending_rows >= self.chunk_rows:
+            self.flush_chunk(self.chunk_rows)
+
+    def flush_chunk(self, nrows):
+        # Only copy when a chunk spans several writes
+        parts = []
+        need = nrows
+        while need:
+            head = self.pending[0]
+            if len(head) <= need:
+                parts.append(self.pending.popleft())
+                need -= len(head)
+            else:
+                parts.append(head[:need])
+                self.pending[0] = head[need:]
+                need = 0
+        self.pending_rows -= nrows
+        if len(parts) == 1:
+            self.write_chunk(parts[0])
+        else:
+            self.write_chunk(np.concatenate(parts, axis=0))
+        self.rows_written += nrows
+
+    def close(self):
+        if self.pending_rows:
+            self.flush_chunk(self.pending_rows)
+        assert self.rows_written == self.height, (self.rows_written,
+                                                  self.height)
+        self.finish()
+
+    def write_chunk(self, rows):
+        raise NotImplementedError()
+
+    def finish(self):
+        raise NotImplementedError()
+
+    def abort(self):
+        """
+        Stop writing. The file is left incomplete
+        """
+        raise NotImplementedError()
+
+
+def jpeg_segments(data):
+    """
+    Return (SOF0 offset, SOS offset, entropy coded data offset)
+    """
+    sof = None
+    pos = 2
+    while True:
+        assert data[pos] == 0xFF, "Bad JPEG marker"
+        marker = data[pos + 1]
+        length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        if marker == MARKER_SOF0:
+            sof = pos
+        elif marker == MARKER_SOS:
+            assert sof is not None, "Expect baseline JPEG"
+            return sof, pos, pos + 2 + length
+        pos += 2 + length
+
+
+class JPEGBandWriter(BandWriter):
+    def __init__(self,
+                 fn,
+                 width,
+                 height,
+                 mode="RGB",
+                 quality=95,
+                 executor=None,
+                 max_inflight=4):
+        """
+        executor: optional concurrent.futures executor to encode chunks on
+        max_inflight: chunks queued on the executor before waiting
+        """
+        if width >= 2**16 or height >= 2**16:
+            raise ValueError("Image exceeds maximum JPEG w/h")
+        # 4:2:0 color => 16 x 16 pixel MCUs, gray => 8 x 8
+        mcu = 16 if mode == "RGB" else 8
+        mcus_across = (width + mcu - 1) // mcu
+        # Restart interval (MCUs per chunk) is a 16 bit field
+        chunk_mcu_rows = max(1, min(16, 0xFFFF // mcus_across))
+        super().__init__(width, height, mode, chunk_mcu_rows * mcu)
+        self.restart_interval = chunk_mcu_rows * mcus_across
+        self.quality = quality
+        self.executor = executor
+        self.max_inflight = max_inflight
+        self.inflight = deque()
+        self.chunks = 0
+        self.f = open(fn, "wb")
+
+    def encode(self, rows):
+        if self.samples == 1:
+            rows = rows[:, :, 0]
+        buf = io.BytesIO()
+        # Baseline, fixed tables => chunks only differ in their scan data
+        Image.fromarray(rows, self.mode).save(buf,
+                                              "JPEG",
+                                              quality=self.quality,
+                                              subsampling="4:2:0",
+                                              optimize=False,
+                                              progressive=False)
+        return buf.getvalue()
+
+    def write_chunk(self, rows):
+        if self.executor:
+            self.inflight.append(self.executor.submit(self.encode, rows))
+        else:
+            self.write_encoded(self.encode(rows))
+        while len(self.inflight) > self.max_inflight:
+            self.write_encoded(self.inflight.popleft().result())
+
+    def write_encoded(self, data):
+        assert data[-2:] == bytes((0xFF, MARKER_EOI))
+        sof, sos, scan = jpeg_segments(data)
+        if self.chunks == 0:
+            header = bytearray(data[:scan])
+            # Full image height
+            header[sof + 5:sof + 7] = struct.pack(">H", self.height)
+            dri = struct.pack(">BBHH", 0xFF, MARKER_DRI, 4,
+                              self.restart_interval)
+            self.f.write(bytes(header[:sos]) + dri + bytes(header[sos:]))
+        else:
+            rst = MARKER_RST0 + (self.chunks - 1) % 8
+            self.f.write(bytes((0xFF, rst)))
+        self.f.write(data[scan:-2])
+        self.chunks += 1
+
+    def finish(self):
+        while self.inflight:
+            self.write_encoded(self.inflight.popleft().result())
+        self.f.write(bytes((0xFF, MARKER_EOI)))
+        self.f.close()
+
+    def abort(self):
+        for future in self.inflight:
+            future.cancel()
+        self.inflight.clear()
+        self.f.close()
+
+
+class BigTIFFWriter(BandWriter):
+    def __init__(self,
+                 fn,
+                 width,
+                 height,
+                 mode="RGB",
+                 tile_size=256,
+                 level=1,
+                 executor=None):
+        """
+        executor: optional concurrent.futures executor to compress tiles on
+        level: zlib level. Photos don't compress much better at higher levels
+            but take several times longer
+        """
+        super().__init__(width, height, mode, tile_size)
+        self.photometric = MODES[mode][1]
+        self.tile_size = tile_size
+        self.level = level
+        self.executor = executor
+        self.tiles_across = (width + tile_size - 1) // tile_size
+        self.tiles_down = (height + tile_size - 1) // tile_size
+        self.offsets = []
+        self.byte_counts = []
+        self.f = open(fn, "wb")
+        # Little endian, BigTIFF, 8 byte offsets, first IFD patched by finish()
+        self.f.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, 0))
+
+    def abort(self):
+        self.f.close()
+
+    def write_chunk(self, rows):
+        # Tiles must be full size: pad the right / bottom edges
+        pad_h = self.tile_size - rows.shape[0]
+        pad_w = self.tiles_across * self.tile_size - self.width
+        if pad_h or pad_w:
+            rows = np.pad(rows, ((0, pad_h), (0, pad_w), (0, 0)))
+        tiles = [
+            rows[:, x:x + self.tile_size]
+            for x in range(0, rows.shape[1], self.tile_size)
+        ]
+        if self.executor:
+            compressed = list(self.executor.map(self.compress, tiles))
+        else:
+            compressed = [self.compress(tile) for tile in tiles]
+        for data in compressed:
+            self.offsets.append(self.f.tell())
+            self.byte_counts.append(len(data))
+            self.f.write(data)
+
+    def compress(self, tile):
+        # Horizontal predictor: each sample minus the one to its left
+        diff = tile.copy()
+        diff[:, 1:] = tile[:, 1:] - tile[:, :-1]
+        return zlib.compress(diff.tobytes(), self.level)
+
+    def finish(self):
+        assert len(self.offsets) == self.tiles_across * self.tiles_down
+
+        # Arrays that don't fit in the entry go after the IFD
+        bits = [8] * self.samples
+        entries = [
+            (TAG_IMAGE_WIDTH, TYPE_LONG, [self.width]),
+            (TAG_IMAGE_LENGTH, TYPE_LONG, [self.height]),
+            (TAG_BITS_PER_SAMPLE, TYPE_SHORT, bits),
+            (TAG_COMPRESSION, TYPE_SHORT, [COMPRESSION_DEFLATE]),
+            (TAG_PHOTOMETRIC, TYPE_SHORT, [self.photometric]),
+            (TAG_SAMPLES_PER_PIXEL, TYPE_SHORT, [self.samples]),
+            (TAG_PLANAR_CONFIG, TYPE_SHORT, [1]),
+            (TAG_PREDICTOR, TYPE_SHORT, [PREDICTOR_HORIZONTAL]),
+            (TAG_TILE_WIDTH, TYPE_LONG, [self.tile_size]),
+            (TAG_TILE_LENGTH, TYPE_LONG, [self.tile_size]),
+            (TAG_TILE_OFFSETS, TYPE_LONG8, self.offsets),
+            (TAG_TILE_BYTE_COUNTS, TYPE_LONG8, self.byte_counts),
+        ]
+        formats = {TYPE_SHORT: "H", TYPE_LONG: "I", TYPE_LONG8: "Q"}
+
+        # Word align the IFD
+        ifd_offset = (self.f.tell() + 7) & ~7
+        self.f.write(b"\x00" * (ifd_offset - self.f.tell()))
+        # count + 20 byte entries + next IFD offset
+        extra_offset = ifd_offset + 8 + 20 * len(entries) + 8
+        ifd = struct.pack("<Q", len(entries))
+        extra = b""
+        for tag, type_, values in entries:
+            data = struct.pack("<%u%s" % (len(values), formats[type_]),
+                               *values)
+            if len(data) <= 8:
+                value = data.ljust(8, b"\x00")
+            else:
+                value = struct.pack("<Q", extra_offset + len(extra))
+                extra += data
+            ifd += struct.pack("<HHQ", tag, type_, len(values)) + value
+        ifd += struct.pack("<Q", 0)
+        self.f.write(ifd + extra)
+        self.f.seek(8)
+        self.f.write(struct.pack("<Q", ifd_offset))
+        self.f.close()
@@ -0,0 +1,129 @@
+"""
+Processing cache manifest
+
+Lazy processing used to reuse any output that existed on disk
+Instead each output is recorded in a per scan manifest along with a key
+hashed from everything that went into it:
+-Plugin name + cache_version
+-Task options
+-Identity (name, size, mtime) of each input file
+-Plugin dependencies such as calibration files and microscope plugin config
+
+An output is reused only if the key still matches and the output file is
+the one that was recorded (same size / mtime)
+Interrupted writes never get recorded and so are redone
+Since outputs of one stage are inputs of the next, redoing a stage
+invalidates everything downstream of it
+"""
+
+from uscope.imagep.plugins import get_plugin_ctors
+from uscope.imagep.util import file_identity
+from uscope import config
+
+import hashlib
+import json
+import os
+import threading
+
+MANIFEST_VERSION = 1
+MANIFEST_FN = "processing_cache.json"
+
+
+def plugin_dependencies(task_name, options={}, usc=None):
+    """
+    Return {plugin name: dependencies} for everything task_name will run
+    """
+    if usc is None:
+        usc = config.get_usc()
+    if task_name == "correct-chain":
+        names = list(options.get("plugins", []))
+    else:
+        names = [task_name]
+    ret = {}
+    for name in names:
+        ctor = get_plugin_ctors()[name]
+        ret[name] = {
+            "version": ctor.cache_version,
+            "config": usc.ipp.get_plugin(name),
+            "external": ctor.cache_dependencies(usc),
+        }
+    return ret
+
+
+def task_key(task_name, fns_in, options={}, usc=None):
+    j = {
+        "version": MANIFEST_VERSION,
+        "plugin": task_name,
+        "options": options,
+        "inputs":
+        [[os.path.basename(fn)] + file_identity(fn) for fn in fns_in],
+        "dependencies": plugin_dependencies(task_name,
+                                            options=options,
+                                            usc=usc),
+    }
+    data = json.dumps(j, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("ascii")).hexdigest()
+
+
+class ProcessingManifest:
+    """
+    Thread safe: yes
+    Outputs are recorded from worker callbacks
+    """
+    def __init__(self, directory, log=None):
+        self.directory = os.path.realpath(directory)
+        self.fn = os.path.join(self.directory, MANIFEST_FN)
+        self.lock = threading.Lock()
+        self.dirty = False
+        # output path relative to directory => entry
+        self.entries = {}
+        if os.path.exists(self.fn):
+            try:
+                with open(self.fn) as f:
+                    j = json.load(f)
+                if j.get("version") == MANIFEST_VERSION:
+                    self.entries = j["entries"]
+            except ValueError:
+                log and log(f"WARNING: ignoring corrupt {self.fn}")
+
+    def relpath(self, fn_out):
+        return os.path.relpath(os.path.realpath(fn_out), self.directory)
+
+    def valid(self, fn_out, key):
+        """
+        Return True if fn_out was generated from key and hasn't changed since
+        """
+        with self.lock:
+            entry = self.entries.get(self.relpath(fn_out))
+        if not entry or entry["key"] != key:
+            return False
+        try:
+            return file_identity(fn_out) == entry["output"]
+        except FileNotFoundError:
+            return False
+
+    def record(self, fn_out, key):
+        entry = {"key": key, "output": file_identity(fn_out)}
+        with self.lock:
+            self.entries[self.relpath(fn_out)] = entry
+            self.dirty = True
+
+    def invalidate(self, fn_out):
+        with self.lock:
+            if self.entries.pop(self.relpath(fn_out), None):
+                self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            j = {
+                "version": MANIFEST_VERSION,
+                "entries": self.entries,
+            }
+            # Don't leave a truncated manifest if interrupted
+            fn_tmp = self.fn + ".tmp"
+            with open(fn_tmp, "w") as f:
+                json.dump(j, f, sort_keys=True, indent=1)
+            os.replace(fn_tmp, self.fn)
+            self.dirty = False
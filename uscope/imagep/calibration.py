@@ -0,0 +1,119 @@
+"""
+Process wide calibration cache
+
+Every worker gets its own plugin set
+Without this each correction plugin instance would load its calibration image
+and keep its own copy of the arrays derived from it
+
+Instead derived arrays are computed once, saved as .npy under the data cache
+directory and memory mapped read only
+-Threads in a process share the same mapping
+-Other processes (ex: several cs_auto runs) map the same file
+    and so share the same physical pages through the page cache
+
+Entries are keyed by the calibration file path, size and mtime
+along with a name identifying how the array was derived
+A new calibration is picked up automatically and stale entries are removed
+"""
+
+from uscope import config
+from uscope.imagep.util import file_identity
+import hashlib
+import json
+import numpy as np
+import os
+import threading
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def calibration_cache_dir():
+    return os.path.join(config.get_bc().cache_dir(), "calibration")
+
+
+def path_hash(fn):
+    return hashlib.sha256(
+        os.path.realpath(fn).encode("utf-8")).hexdigest()[:16]
+
+
+def identity_hash(fn, name):
+    j = [os.path.realpath(fn), name] + file_identity(fn)
+    return hashlib.sha256(json.dumps(j).encode("utf-8")).hexdigest()[:16]
+
+
+def load_entry(fn_npy, fn_json):
+    if not os.path.exists(fn_npy) or not os.path.exists(fn_json):
+        return None
+    try:
+        with open(fn_json) as f:
+            meta = json.load(f)
+        array = np.load(fn_npy, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    return array, meta
+
+
+def save_entry(fn_npy, fn_json, array, meta):
+    """
+    Atomic so that concurrent processes never see a partial entry
+    """
+    suffix = ".%u.tmp" % os.getpid()
+    with open(fn_npy + suffix, "wb") as f:
+        np.save(f, np.ascontiguousarray(array))
+    os.replace(fn_npy + suffix, fn_npy)
+    with open(fn_json + suffix, "w") as f:
+        json.dump(meta, f)
+    os.replace(fn_json + suffix, fn_json)
+
+
+def remove_stale(directory, prefix, keep):
+    for basename in os.listdir(directory):
+        if not basename.startswith(prefix) or basename.startswith(keep):
+            continue
+        try:
+            os.unlink(os.path.join(directory, basename))
+        except OSError:
+            pass
+
+
+def get_calibration_array(fn, name, derive):
+    """
+    fn: calibration file
+    name: identifies the derivation. Change it when derive() changes
+    derive(fn): return (numpy array, JSON serializable meta dict)
+
+    Return (read only memory mapped array, meta)
+    """
+    key = (os.path.realpath(fn), name, tuple(file_identity(fn)))
+    with _lock:
+        ret = _cache.get(key)
+        if ret is not None:
+            return ret
+
+        directory = calibration_cache_dir()
+        os.makedirs(directory, exist_ok=True)
+        prefix = "%s_%s_" % (name, path_hash(fn))
+        base = os.path.join(directory, prefix + identity_hash(fn, name))
+        fn_npy = base + ".npy"
+        fn_json = base + ".json"
+        ret = load_entry(fn_npy, fn_json)
+        if ret is None:
+            array, meta = derive(fn)
+            save_entry(fn_npy, fn_json, array, meta)
+            remove_stale(directory, prefix, os.path.basename(base))
+            ret = load_entry(fn_npy, fn_json)
+            assert ret is not None
+        # Drop any older version of this calibration held in this process
+        for k in [k for k in _cache if k[0:2] == key[0:2]]:
+            del _cache[k]
+        _cache[key] = ret
+        return ret
+
+
+def clear():
+    """
+    Forget in process mappings. Files on disk are kept
+    """
+    with _lock:
+        _cache.clear()
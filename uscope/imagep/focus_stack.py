@@ -0,0 +1,153 @@
+"""
+In process focus stacking
+Laplacian pyramid fusion with contrast based masks, similar to
+enfuse --exposure-weight=0 --saturation-weight=0 --contrast-weight=1
+
+Slices are streamed in one at a time
+Memory is bounded by a few pyramids regardless of stack depth
+
+hard mask (default, like enfuse --hard-mask)
+    Each pyramid coefficient comes from the slice with the highest local contrast
+    Sharpest result, may show some noise
+soft mask
+    Coefficients are averaged weighted by contrast ** exponent
+    Smoother, slightly less sharp
+The lowpass residual is averaged across all slices in both modes
+"""
+
+import cv2
+import numpy as np
+
+
+def default_levels(width, height, min_size=32):
+    levels = 1
+    while min(width, height) >> levels >= min_size:
+        levels += 1
+    return levels
+
+
+def laplacian_pyramid(im, levels):
+    """
+    im: float32 HxWxC
+    Return list of levels, highest resolution first
+    The last entry is the lowpass residual
+    """
+    ret = []
+    cur = im
+    for _i in range(levels - 1):
+        down = cv2.pyrDown(cur)
+        up = cv2.pyrUp(down, dstsize=(cur.shape[1], cur.shape[0]))
+        ret.append(cur - up)
+        cur = down
+    ret.append(cur)
+    return ret
+
+
+def collapse_pyramid(pyramid):
+    cur = pyramid[-1]
+    for lap in reversed(pyramid[:-1]):
+        cur = cv2.pyrUp(cur, dstsize=(lap.shape[1], lap.shape[0]))
+        cur += lap
+    return cur
+
+
+class PyramidFocusStacker:
+    def __init__(self,
+                 levels=None,
+                 hard_mask=True,
+                 contrast_window=5,
+                 soft_exponent=4.0):
+        self.levels = levels
+        self.hard_mask = hard_mask
+        self.contrast_window = contrast_window
+        self.soft_exponent = soft_exponent
+        self.reset()
+
+    def reset(self):
+        self.nslices = 0
+        self.shape = None
+        # hard: selected coefficients, soft: weighted sum
+        self.fused = None
+        # hard: best contrast so far, soft: sum of weights
+        self.weights = None
+        self.residual = None
+
+    def contrast(self, lap):
+        """
+        Local contrast of a Laplacian level
+        Mean absolute coefficient over a small window, channels combined
+        """
+        energy = np.abs(lap).sum(axis=2)
+        return cv2.blur(energy, (self.contrast_window, self.contrast_window))
+
+    def add(self, im):
+        """
+        Add a slice
+        im: HxWx3 uint8 array or PIL image
+        """
+        array = np.asarray(im)
+        if self.shape is None:
+            self.shape = array.shape
+            if self.levels is None:
+                self.levels = default_levels(array.shape[1], array.shape[0])
+        elif array.shape != self.shape:
+            raise ValueError("Stack slice size mismatch: %s vs %s" %
+                             (array.shape, self.shape))
+
+        pyramid = laplacian_pyramid(array.astype(np.float32), self.levels)
+        residual = pyramid.pop()
+
+        if self.fused is None:
+            self.fused = []
+            self.weights = []
+            for lap in pyramid:
+                contrast = self.contrast(lap)
+                if self.hard_mask:
+                    self.fused.append(lap)
+                    self.weights.append(contrast)
+                else:
+                    weight = contrast**self.soft_exponent + 1e-6
+                    self.fused.append(lap * weight[..., None])
+                    self.weights.append(weight)
+            self.residual = residual
+        else:
+            for leveli, lap in enumerate(pyramid):
+                contrast = self.contrast(lap)
+                if self.hard_mask:
+                    better = contrast > self.weights[leveli]
+                    np.copyto(self.fused[leveli], lap, where=better[..., None])
+                    np.maximum(self.weights[leveli],
+                               contrast,
+                               out=self.weights[leveli])
+                else:
+                    weight = contrast**self.soft_exponent + 1e-6
+                    self.fused[leveli] += lap * weight[..., None]
+                    self.weights[leveli] += weight
+            self.residual += residual
+        self.nslices += 1
+
+    def result(self):
+        """
+        Return fused image as HxWx3 uint8 array
+        """
+        assert self.nslices, "No slices"
+        pyramid = []
+        for leveli, fused in enumerate(self.fused):
+            if self.hard_mask:
+                pyramid.append(fused)
+            else:
+                pyramid.append(fused / self.weights[leveli][..., None])
+        pyramid.append(self.residual / self.nslices)
+        ret = collapse_pyramid(pyramid)
+        np.clip(ret, 0, 255, out=ret)
+        return np.rint(ret).astype(np.uint8)
+
+
+def focus_stack(ims, **kwargs):
+    """
+    Convenience wrapper: stack an iterable of images
+    """
+    stacker = PyramidFocusStacker(**kwargs)
+    for im in ims:
+        stacker.add(im)
+    return stacker.result()
@@ -0,0 +1,116 @@
+"""
+High level jobs sharing one CSImageProcessor worker pool
+
+A job is whatever a user thinks of as one unit of work
+(ex: processing a scan directory, a snapshot stack)
+Every task belongs to exactly one job
+Tasks queued without one go to the processor's default job
+
+Jobs get:
+-Fair share: within a priority class, workers alternate between jobs
+    in proportion to their weight instead of draining whoever queued first
+-A private temp directory
+-Progress counters
+-Cancellation: queued tasks are dropped and further submissions raise
+    CSIPJobCancelled. Tasks already on a worker run to completion
+
+Fair share uses start time fair queuing:
+each task is tagged with a virtual start time when queued
+max(job's last finish tag, virtual time of the last dispatched task)
+and workers always take the lowest tag
+A job that shows up late starts at the current virtual time
+so it interleaves with, rather than waits behind, a long running job
+"""
+
+import concurrent.futures
+import shutil
+import threading
+
+
+class CSIPJobCancelled(concurrent.futures.CancelledError):
+    pass
+
+
+class CSIPJob:
+    def __init__(self, job_id, name, weight=1.0, temp_dir=None):
+        if weight <= 0:
+            raise ValueError(f"Invalid job weight {weight}")
+        self.id = job_id
+        self.name = name
+        self.weight = weight
+        # Owned by the job. None => shared (default job)
+        self.temp_dir = temp_dir
+        self.lock = threading.Lock()
+        self.cancelled_event = threading.Event()
+        # Fair share finish tag of the last queued task. See module docstring
+        self.vfinish = 0.0
+        self.futures = set()
+        self.submitted = 0
+        self.dispatched = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled_tasks = 0
+
+    def __repr__(self):
+        return f"CSIPJob({self.id}, {self.name!r})"
+
+    def cancelled(self):
+        return self.cancelled_event.is_set()
+
+    def raise_if_cancelled(self):
+        if self.cancelled():
+            raise CSIPJobCancelled(f"Job {self.name} cancelled")
+
+    def cancel(self):
+        """
+        Drop queued tasks and reject new ones
+        Return number of tasks cancelled
+        """
+        self.cancelled_event.set()
+        with self.lock:
+            futures = list(self.futures)
+        return sum(1 for future in futures if future.cancel())
+
+    def task_queued(self, future):
+        with self.lock:
+            self.submitted += 1
+            self.futures.add(future)
+
+    def task_dispatched(self):
+        with self.lock:
+            self.dispatched += 1
+
+    def task_done(self, future):
+        with self.lock:
+            self.futures.discard(future)
+            if future.cancelled():
+                self.cancelled_tasks += 1
+            elif future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def progress(self):
+        """
+        Return JSON serializable task counts
+        """
+        with self.lock:
+            finished = self.completed + self.failed
+            return {
+                "id": self.id,
+                "name": self.name,
+                "weight": self.weight,
+                "cancelled": self.cancelled(),
+                "submitted": self.submitted,
+                "queued":
+                self.submitted - self.dispatched - self.cancelled_tasks,
+                "running": self.dispatched - finished,
+                "completed": self.completed,
+                "failed": self.failed,
+                "cancelled_tasks": self.cancelled_tasks,
+            }
+
+    def close(self):
+        if self.temp_dir:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
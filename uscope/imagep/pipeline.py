@@ -11,17 +11,27 @@ a different image processing pipeline may be constructed
 Tasks are centered around IPPlugin's
 These are image processing algorithms such as HDR or focus stacking
 They generally take one or more images in and produce a single image out
+
+Every queued task gets a CSIPFuture
+It can be cancelled while still queued and carries a CSIPTaskError on failure
+The submission queue is bounded: producers block (or get queue.Full)
+once max_queued tasks are waiting for a worker
+
+Tasks are grouped into jobs (see jobs.py) so that several high level
+tasks (ex: two scans) can share one worker pool fairly
 """
 
 from uscope.scan_util import index_scan_images
-from uscope.imagep.util import EtherealImageR, EtherealImageW
+from uscope.scan_catalog import get_scan_catalog, uploaded_on_disk
+from uscope.imagep.util import EtherealImageR, EtherealImageW, CSIPFuture, CSIPTaskError, ethereal_fns
 from uscope.imagep.streams import StreamCSIP, DirCSIP, SnapshotCSIP
 from uscope.imagep.plugins import get_plugins, get_plugin_ctors
+from uscope.imagep.jobs import CSIPJob
+from uscope.imagep.trace import Tracer, TaskTrace, set_current_task
 from uscope import config
 from uscope.microscope import get_virtual_microscope, get_mconfig
 
 import os
-import glob
 import subprocess
 import shutil
 from collections import OrderedDict
@@ -31,6 +41,8 @@ import threading
 import queue
 import tempfile
 import json
+import time
+import itertools
 
 
 def get_open_set(working_iindex):
@@ -43,10 +55,37 @@ def get_open_set(working_iindex):
     return open_set
 
 
-def already_uploaded(directory):
-    # upload metadata file cloud_stitch.json => uploaded
-    return len(glob.glob(f'{directory}/**/cloud_stitch.json',
-                         recursive=True)) > 0
+def already_uploaded(directory, catalog=None):
+    """
+    Ask the scan catalog (if given) and only crawl the scan if it doesn't know
+    """
+    if catalog is not None:
+        uploaded = catalog.is_uploaded(directory)
+        if uploaded is not None:
+            return uploaded
+    return uploaded_on_disk(directory) is not None
+
+
+# Task priority classes
+# Workers always take the most important queued task once their current task
+# is done (ie preemption at task boundaries) and FIFO within a class
+PRIORITIES = {
+    # Someone is waiting on the result (ex: GUI snapshot)
+    "interactive": 0,
+    # Keeping up with a running capture (ex: planner, StreamCSIP)
+    "planner": 1,
+    # Everything else (ex: DirCSIP)
+    "bulk": 2,
+}
+# Ahead of everything
+PRIORITY_SHUTDOWN = -1
+
+
+def priority_rank(priority):
+    rank = PRIORITIES.get(priority)
+    if rank is None:
+        raise ValueError(f"Invalid priority {priority}")
+    return rank
 
 
 class CSImageProcessorThread(threading.Thread):
@@ -66,15 +105,21 @@ class CSImageProcessorThread(threading.Thread):
         self.queue_in = queue.Queue()
         # self.queue_out = queue.Queue()
 
-        # Each thrread gets its own set of correction engines
-        self.plugins = get_plugins(log=self.log,
-                                   microscope=self.csip.microscope)
+        # Each thread gets its own set of correction engines
+        # Constructed on first use
+        self.plugins = self.create_plugins()
         self.running.set()
 
+    def create_plugins(self):
+        return get_plugins(log=self.log, microscope=self.csip.microscope)
+
     def stop(self):
         self.running.clear()
+        # Wake up run()
+        self.queue_in.put(None)
 
     def queue_command(self, ip_params):
+        self.simple_idle.clear()
         self.queue_in.put(ip_params)
 
     """
@@ -88,40 +133,109 @@ class CSImageProcessorThread(threading.Thread):
         return info
     """
 
+    def run_plugin(self, ip_params):
+        """
+        Execute the task and return the plugin result
+        Raises on plugin failure
+        """
+        plugin = self.plugins[ip_params.task_name]
+        return plugin.run(data_in=ip_params.data_in,
+                          data_out=ip_params.data_out,
+                          options=ip_params.options)
+
+    def has_plugin(self, task_name):
+        return task_name in self.plugins
+
     def run(self):
 
         while self.running.is_set():
-            try:
-                ip_params = self.queue_in.get(True, 0.1)
-            except queue.Empty:
+            ip_params = self.queue_in.get()
+            # Shutdown request
+            if ip_params is None:
                 continue
 
+            task = TaskTrace(ip_params.task_name,
+                             worker=self.name,
+                             t_queued=ip_params.t_queued,
+                             priority=ip_params.priority,
+                             job=ip_params.job.id)
+
             def finish_command(result, info):
+                set_current_task(None)
+                task.finish(result)
+                # Before callbacks so the task is counted once they clear
+                self.csip.tracer.record(task)
                 out = (ip_params, result, info)
                 # self.queue_out.put(out)
+                # User callback first so it is done once the barrier clears
+                # A broken callback must not finish the task a second time
+                if ip_params.callback:
+                    try:
+                        ip_params.callback(*out)
+                    except Exception:
+                        self.log("WARNING: task callback crashed")
+                        self.log(traceback.format_exc())
                 if ip_params.tb:
                     ip_params.tb.callback()
-                if ip_params.callback:
-                    ip_params.callback(*out)
+                # Last so result() returns after the above
+                self.set_future(ip_params, result, info)
                 self.simple_idle.set()
+                self.csip.worker_idle(self)
 
-            plugin = self.plugins.get(ip_params.task_name)
-            if plugin is None:
+            if not self.has_plugin(ip_params.task_name):
                 self.log(f"Invalid plugin {ip_params.task_name}")
                 finish_command("error", "invalid command")
                 continue
+            set_current_task(task)
             try:
-                ret = plugin.run(data_in=ip_params.data_in,
-                                 data_out=ip_params.data_out,
-                                 options=ip_params.options)
+                ret = self.run_plugin(ip_params)
+                self.check_outputs(ip_params)
                 # self.log("Command done")
-                finish_command("ok", ret)
             except Exception as e:
+                formatted = getattr(e, "csip_traceback", None)
+                if formatted is None:
+                    formatted = traceback.format_exc()
+                e.csip_traceback = formatted
                 self.log("")
                 self.log("WARNING: worker thread crashed")
-                self.log(traceback.format_exc())
+                self.log(formatted)
                 finish_command("exception", e)
                 continue
+            finish_command("ok", ret)
+
+    def check_outputs(self, ip_params):
+        """
+        A plugin that returns without writing its output file failed
+        Otherwise callers would record / chain a file that isn't there
+        """
+        for fn in ethereal_fns(ip_params.data_out or {}):
+            if not os.path.exists(fn):
+                raise FileNotFoundError(
+                    f"{ip_params.task_name}: output not written: {fn}")
+
+    def set_future(self, ip_params, result, info):
+        future = ip_params.future
+        if future is None:
+            return
+        if result == "ok":
+            future.info = info
+            future.set_result(ip_params.data_out)
+            return
+        if isinstance(info, Exception):
+            message = f"{type(info).__name__}: {info}"
+            formatted = getattr(info, "csip_traceback", None)
+        else:
+            message = f"{result}: {info}"
+            formatted = None
+        e = CSIPTaskError(ip_params.task_name,
+                          message,
+                          worker=self.name,
+                          fns_in=ethereal_fns(ip_params.data_in or {}),
+                          fns_out=ethereal_fns(ip_params.data_out or {}),
+                          formatted_traceback=formatted)
+        if isinstance(info, Exception):
+            e.__cause__ = info
+        future.set_exception(e)
 
 
 """
@@ -136,7 +250,9 @@ class CSIPParams:
                  data_out={},
                  options={},
                  callback=None,
-                 tb=None):
+                 tb=None,
+                 priority="bulk",
+                 job=None):
         self.task_name = task_name
         self.data_in = data_in
         self.data_out = data_out
@@ -147,6 +263,8 @@ class CSIPParams:
             self.callback(self, "ok", returned result (probably None))
         on failure
             self.callback(self, "exception", exception)
+        if cancelled before reaching a worker
+            self.callback(self, "cancelled", None)
         """
         self.callback = callback
         """
@@ -156,6 +274,16 @@ class CSIPParams:
         self.tb.callback called on completion
         """
         self.tb = tb
+        # See PRIORITIES
+        self.priority = priority
+        # CSIPJob. None => set to the default job when queued
+        self.job = job
+        # Set when queued, used to measure queue wait
+        self.t_queued = None
+        # Set when queued. See CSIPFuture
+        self.future = None
+        # Holding a submission slot
+        self.queued = False
 
 
 """
@@ -165,14 +293,18 @@ Can accept:
 -Image stream for in progress scan
 -Small jobs like a single stack
 
-Currently only one high level task can be run at a time
-ie it can't process two completed scans at the same time or do an image stack while a scan is running 
-Probably would need to make this a thread to handle that
+Several high level tasks can run at once (ex: two completed scans,
+or an image stack while a scan is running), each from its own thread
+Give each its own job (job_begin()) for fair sharing, progress and cancel
 """
 
 
 class CSImageProcessor(threading.Thread):
-    def __init__(self, nthreads=None, log=None, microscope=None):
+    def __init__(self,
+                 nthreads=None,
+                 log=None,
+                 microscope=None,
+                 max_queued=None):
         super().__init__()
         self.microscope = microscope
         if log is None:
@@ -181,11 +313,29 @@ class CSImageProcessor(threading.Thread):
                 print(s)
 
         self.log = log
-        self.queue_in = queue.Queue()
+        # (priority rank, fair share tag, sequence, CSIPParams)
+        self.queue_in = queue.PriorityQueue()
+        self.queue_seq = itertools.count()
+        # Submission backpressure: tasks queued but not yet dispatched
+        self.queue_cv = threading.Condition()
+        self.nqueued = 0
+        # Futures of the above, for cancel_pending()
+        self.pending_futures = set()
+        # Fair share virtual time per priority rank. See jobs.py
+        self.vtimes = {}
+        self.job_ids = itertools.count(1)
+        # Active jobs by id
+        self.jobs = OrderedDict()
+        # Tasks queued without a job
+        self.default_job = CSIPJob(0, "default")
         # self.queue_out = queue.Queue()
+        # Workers ready to accept a task
+        self.idle_workers = queue.Queue()
         self.running = threading.Event()
         self.ready = threading.Event()
         self.workers = OrderedDict()
+        # Per task timing. See trace.py
+        self.tracer = Tracer()
 
         # Used
         self.temp_dir_object = tempfile.TemporaryDirectory()
@@ -193,9 +343,13 @@ class CSImageProcessor(threading.Thread):
 
         if not nthreads:
             nthreads = multiprocessing.cpu_count()
-        for i in range(nthreads):
+        for i in range(int(nthreads)):
             name = f"w{i}"
             self.workers[name] = CSImageProcessorThread(self, name)
+        # Enough to keep every worker fed without holding a whole scan
+        if max_queued is None:
+            max_queued = 16 * len(self.workers)
+        self.max_queued = max_queued
         self.running.set()
 
     def __del__(self):
@@ -207,6 +361,14 @@ class CSImageProcessor(threading.Thread):
 
     def shutdown_request(self):
         self.running.clear()
+        # Anything still queued will never run
+        self.cancel_pending()
+        # Wake up blocked producers
+        with self.queue_cv:
+            self.queue_cv.notify_all()
+        # Wake up the dispatcher
+        self.idle_workers.put(None)
+        self.queue_in.put((PRIORITY_SHUTDOWN, 0.0, next(self.queue_seq), None))
 
         if self.workers:
             self.log("Shutting down: requesting")
@@ -225,13 +387,143 @@ class CSImageProcessor(threading.Thread):
             self.temp_dir_object.cleanup()
             self.temp_dir = None
 
-    def queue_task(self, ip_params, callback=None, block=None):
-        assert not block, "fixme"
+    def job_begin(self, name=None, weight=1.0):
+        """
+        Start a new job
+        weight: relative share of the workers vs other jobs of the same priority
+        """
+        job_id = next(self.job_ids)
+        temp_dir = os.path.join(self.temp_dir, f"job{job_id}")
+        os.mkdir(temp_dir)
+        job = CSIPJob(job_id,
+                      name or f"job{job_id}",
+                      weight=weight,
+                      temp_dir=temp_dir)
+        with self.queue_cv:
+            self.jobs[job_id] = job
+        return job
+
+    def job_end(self, job):
+        """
+        Job is done queuing tasks and nothing of it is running
+        """
+        with self.queue_cv:
+            self.jobs.pop(job.id, None)
+        job.close()
+
+    def jobs_progress(self):
+        with self.queue_cv:
+            jobs = [self.default_job] + list(self.jobs.values())
+        return [job.progress() for job in jobs]
+
+    def job_temp_dir(self, job):
+        if job is None or job.temp_dir is None:
+            return self.temp_dir
+        return job.temp_dir
+
+    def bounded(self, ip_params):
+        """
+        Interactive tasks skip the line
+        Tasks queued from a worker (ex: a callback) can't wait on the workers
+        """
+        if ip_params.priority == "interactive":
+            return False
+        return not isinstance(threading.current_thread(),
+                              CSImageProcessorThread)
+
+    def acquire_slot(self, ip_params, block=None, timeout=None):
+        """
+        Raise queue.Full if the queue is still full after block / timeout
+        """
+        if block is None:
+            block = True
+        with self.queue_cv:
+            if self.max_queued and self.bounded(ip_params):
+
+                def ready():
+                    return (self.nqueued < self.max_queued
+                            or not self.running.is_set())
+
+                if not block:
+                    timeout = 0
+                if not self.queue_cv.wait_for(ready, timeout=timeout):
+                    raise queue.Full(
+                        f"{ip_params.task_name}: {self.nqueued} tasks queued")
+            if not self.running.is_set():
+                raise CSIPTaskError(ip_params.task_name,
+                                    "image processor shut down")
+            self.nqueued += 1
+            ip_params.queued = True
+            self.pending_futures.add(ip_params.future)
+
+    def release_slot(self, ip_params):
+        """
+        Task was dispatched or cancelled
+        """
+        with self.queue_cv:
+            if not ip_params.queued:
+                return
+            ip_params.queued = False
+            self.nqueued -= 1
+            self.pending_futures.discard(ip_params.future)
+            self.queue_cv.notify()
+
+    def queue_task(self, ip_params, callback=None, block=None, timeout=None):
+        """
+        Return a CSIPFuture
+        block / timeout: wait for a free submission slot like queue.Queue.put()
+        """
+        rank = priority_rank(ip_params.priority)
+        if ip_params.job is None:
+            ip_params.job = self.default_job
+        job = ip_params.job
+        job.raise_if_cancelled()
+        future = CSIPFuture(ip_params)
+        ip_params.future = future
+        self.acquire_slot(ip_params, block=block, timeout=timeout)
+        with self.queue_cv:
+            vstart = max(job.vfinish, self.vtimes.get(rank, 0.0))
+            job.vfinish = vstart + 1.0 / job.weight
+        job.task_queued(future)
+
+        def done(future):
+            job.task_done(future)
+            if not future.cancelled():
+                return
+            # Won't reach a worker: complete it now
+            self.release_slot(ip_params)
+            if ip_params.callback:
+                ip_params.callback(ip_params, "cancelled", None)
+            if ip_params.tb:
+                ip_params.tb.callback()
+
+        ip_params.t_queued = time.time()
         if ip_params.tb:
             # Mark task allocated
             # tb callback will be manually invoked on result
             ip_params.tb.allocate_callback()
-        self.queue_in.put(ip_params)
+        future.add_done_callback(done)
+        self.queue_in.put((rank, vstart, next(self.queue_seq), ip_params))
+        # Raced shutdown / job cancel: won't be cancelled otherwise
+        if not self.running.is_set() or job.cancelled():
+            future.cancel()
+        return future
+
+    def cancel_pending(self, priority=None):
+        """
+        Cancel queued tasks that haven't reached a worker yet
+        Running tasks complete normally
+        Return number of tasks cancelled
+        """
+        with self.queue_cv:
+            futures = list(self.pending_futures)
+        ret = 0
+        for future in futures:
+            if priority is not None and future.priority != priority:
+                continue
+            if future.cancel():
+                ret += 1
+        return ret
 
     def queue_n_to_1_plugin(self,
                             task_name=None,
@@ -244,9 +536,13 @@ class CSImageProcessor(threading.Thread):
                             options={},
                             callback=None,
                             tb=None,
-                            block=None):
+                            block=None,
+                            timeout=None,
+                            priority="bulk",
+                            job=None):
         """
         Use enfuse to HDR process a sequence of images of varying exposures
+        Return a CSIPFuture
         """
         if fns_in is not None:
             data_in = {
@@ -260,15 +556,20 @@ class CSImageProcessor(threading.Thread):
             }
         if want_im_out:
             data_out = {
-                "image": EtherealImageW(want_im=True, temp_dir=self.temp_dir)
+                "image":
+                EtherealImageW(want_im=True, temp_dir=self.job_temp_dir(job))
             }
         ip_params = CSIPParams(task_name=task_name,
                                data_in=data_in,
                                data_out=data_out,
                                options=options,
                                callback=callback,
-                               tb=tb)
-        self.queue_task(ip_params=ip_params, block=block)
+                               tb=tb,
+                               priority=priority,
+                               job=job)
+        return self.queue_task(ip_params=ip_params,
+                               block=block,
+                               timeout=timeout)
 
     def queue_1_to_1_plugin(self,
                             plugin,
@@ -281,7 +582,10 @@ class CSImageProcessor(threading.Thread):
                             options={},
                             callback=None,
                             tb=None,
-                            block=None):
+                            block=None,
+                            timeout=None,
+                            priority="bulk",
+                            job=None):
         if plugin not in get_plugin_ctors():
             print("Valid plugins:", get_plugin_ctors().keys())
             assert 0, f"Bad plugin {plugin}"
@@ -293,25 +597,29 @@ class CSImageProcessor(threading.Thread):
             data_in = {"image": EtherealImageR(im=im_in)}
         if want_im_out:
             data_out = {
-                "image": EtherealImageW(want_im=True, temp_dir=self.temp_dir)
+                "image":
+                EtherealImageW(want_im=True, temp_dir=self.job_temp_dir(job))
             }
         ip_params = CSIPParams(task_name=plugin,
                                data_in=data_in,
                                data_out=data_out,
                                options=options,
                                callback=callback,
-                               tb=tb)
-        self.queue_task(ip_params=ip_params, block=block)
-        return data_out
+                               tb=tb,
+                               priority=priority,
+                               job=job)
+        return self.queue_task(ip_params=ip_params,
+                               block=block,
+                               timeout=timeout)
 
     def queue_hdr_enfuse(self, **kwargs):
-        self.queue_n_to_1_plugin(task_name="hdr-enfuse", **kwargs)
+        return self.queue_n_to_1_plugin(task_name="hdr-enfuse", **kwargs)
 
     def queue_stack_enfuse(self, **kwargs):
-        self.queue_n_to_1_plugin(task_name="stack-enfuse", **kwargs)
+        return self.queue_n_to_1_plugin(task_name="stack-enfuse", **kwargs)
 
     def queue_stabilization(self, **kwargs):
-        self.queue_n_to_1_plugin(task_name="stabilization", **kwargs)
+        return self.queue_n_to_1_plugin(task_name="stabilization", **kwargs)
 
     def queue_correct_ff1(self, **kwargs):
         return self.queue_1_to_1_plugin(plugin="correct-ff1", **kwargs)
@@ -400,18 +708,47 @@ class CSImageProcessor(threading.Thread):
             return
 
         for worker in self.workers.values():
+            self.idle_workers.put(worker)
             worker.start()
 
         self.ready.set()
 
+        # Block until both a worker and a task are available
         while self.running.is_set():
-            for worker in self.workers.values():
-                if worker.simple_idle.is_set():
-                    try:
-                        ip_params = self.queue_in.get(True, 0.1)
-                    except queue.Empty:
-                        break
-                    worker.queue_command(ip_params)
+            worker = self.idle_workers.get()
+            if worker is None:
+                break
+            # Most important task first
+            ip_params = self.next_task()
+            if ip_params is None:
+                break
+            worker.queue_command(ip_params)
+
+    def next_task(self):
+        """
+        Return the next task to run, skipping cancelled ones
+        None => shutdown
+        """
+        while True:
+            rank, vstart, _seq, ip_params = self.queue_in.get()
+            if ip_params is None:
+                return None
+            self.release_slot(ip_params)
+            # False => cancelled, already completed by its done callback
+            if ip_params.future.set_running_or_notify_cancel():
+                with self.queue_cv:
+                    self.vtimes[rank] = max(self.vtimes.get(rank, 0.0), vstart)
+                ip_params.job.task_dispatched()
+                return ip_params
+
+    def worker_idle(self, worker):
+        self.idle_workers.put(worker)
+
+    def queue_wait_stats(self):
+        """
+        Return {priority: queue wait stats} since the engine started
+        """
+        return self.tracer.queue_wait_stats()
 
 
 def microscope_name_from_scan_dir(directory, mconfig):
@@ -441,7 +778,13 @@ def process_dir(directory,
                 nthreads=None,
                 microscope=None,
                 microscope_name=None,
+                catalog=None,
                 **kwargs):
+    """
+    catalog: ScanCatalog to record progress in (None => data dir's)
+    """
+    if catalog is None:
+        catalog = get_scan_catalog()
     if microscope is None:
         mconfig = {}
         if microscope_name:
@@ -456,13 +799,79 @@ def process_dir(directory,
         ip = CSImageProcessor(nthreads=nthreads, microscope=microscope)
         ip.start()
         ip.ready.wait(1.0)
-        ip.process_dir(directory, *args, **kwargs)
+        ip.process_dir(directory, *args, catalog=catalog, **kwargs)
     finally:
         if ip:
             ip.shutdown()
     del ip
 
 
+def process_dirs(directories,
+                 *args,
+                 nthreads=None,
+                 microscope_name=None,
+                 max_jobs=None,
+                 catalog=None,
+                 **kwargs):
+    """
+    Process several scans at once sharing one worker pool
+    instead of one process (and pool) per scan
+    Each scan is its own job => workers are split fairly between them
+
+    Plugins are configured for one microscope
+    so scans are grouped by microscope and groups run one after another
+    max_jobs: max scans in progress at once (None => all in the group)
+    catalog: ScanCatalog to record progress in (None => data dir's)
+    """
+    if catalog is None:
+        catalog = get_scan_catalog()
+    groups = OrderedDict()
+    for directory in directories:
+        mconfig = {}
+        if microscope_name:
+            mconfig["name"] = microscope_name
+        else:
+            microscope_name_from_scan_dir(directory, mconfig)
+        k = (mconfig.get("name"), mconfig.get("serial"))
+        groups.setdefault(k, (mconfig, []))[1].append(directory)
+
+    failed = []
+    for mconfig, group in groups.values():
+        microscope = get_virtual_microscope(mconfig=mconfig)
+        slots = threading.Semaphore(max_jobs or len(group))
+        ip = None
+        try:
+            ip = CSImageProcessor(nthreads=nthreads, microscope=microscope)
+            ip.start()
+            ip.ready.wait(1.0)
+
+            def run_one(directory):
+                try:
+                    ip.process_dir(directory, *args, catalog=catalog, **kwargs)
+                except Exception:
+                    ip.log(f"{directory}: processing failed")
+                    ip.log(traceback.format_exc())
+                    failed.append(directory)
+                finally:
+                    slots.release()
+
+            threads = []
+            for directory in group:
+                slots.acquire()
+                thread = threading.Thread(target=run_one,
+                                          args=(directory, ),
+                                          name=f"process_dirs {directory}")
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+        finally:
+            if ip:
+                ip.shutdown()
+    if failed:
+        raise Exception("Failed to process: %s" % (", ".join(failed), ))
+
+
 def process_snapshots(images,
                       *args,
                       nthreads=None,
@@ -483,5 +892,5 @@ def process_snapshots(images,
         return ret
     finally:
         if ip:
-            ip.stop()
+            ip.shutdown()
     del ip
@@ -1,4 +1,8 @@
 from uscope.imager.imager_util import format_mm_3dec
+from uscope.imagep.calibration import get_calibration_array
+from uscope.imagep.focus_stack import PyramidFocusStacker
+from uscope.imagep.stack_align import StackAligner
+from uscope.imagep.util import EtherealImageR, EtherealImageW, file_identity
 
 import subprocess
 import shutil
@@ -22,6 +26,10 @@ class IPPlugin:
     Thread safe: no
     If you want to do multiple in parallel create multiple instances
     """
+    # Bump when output changes for the same inputs
+    # Invalidates previously processed outputs (see cache.py)
+    cache_version = 1
+
     def __init__(self,
                  log=None,
                  need_tmp_dir=False,
@@ -38,11 +46,13 @@ class IPPlugin:
         self.log = log
         self.default_options = default_options
 
+        # Created on first get_tmp_dir()
         self.tmp_dir = None
         self.need_tmp_dir = need_tmp_dir
-        if need_tmp_dir:
-            self.create_tmp_dir()
         self.delete_tmp = True
+        # Other plugins owned by the same worker
+        # Set by LazyPlugins
+        self.siblings = {}
 
     def __del__(self):
         if self.tmp_dir:
@@ -50,7 +60,8 @@ class IPPlugin:
             self.tmp_dir = None
 
     def get_tmp_dir(self):
-        assert self.tmp_dir
+        assert self.need_tmp_dir
+        self.create_tmp_dir()
         return self.tmp_dir.name
 
     def create_tmp_dir(self):
@@ -77,6 +88,9 @@ class IPPlugin:
             simple plugin: a single key called "images" containing a list of EtherealImageR
         data_out: dictionary of output products
             simple plugin: a single key called "image" containing a an EtherealImageW
+        Plugins should read with to_im() and write with set_im() / set_cv_im()
+        so that in memory requests (ex: GUI snapshots) never touch disk
+        Use get_filename() only when a file is actually required (ex: enfuse)
         """
         if self.tmp_dir:
             self.clear_tmp_dir()
@@ -89,6 +103,15 @@ class IPPlugin:
     def _run(self, data_in, data_out, options={}):
         assert 0, "required"
 
+    @classmethod
+    def cache_dependencies(cls, usc):
+        """
+        Return JSON serializable state outside of the task options
+        that output depends on (ex: calibration files)
+        Changing it invalidates previously processed outputs
+        """
+        return {}
+
 
 class HDREnfusePlugin(IPPlugin):
     def __init__(self, log, default_options={}, microscope=None):
@@ -111,7 +134,7 @@ class HDREnfusePlugin(IPPlugin):
             args.append("-d")
             args.append("16")
         for image_in in data_in["images"]:
-            fn = image_in.get_filename()
+            fn = image_in.get_filename(tmp_dir=self.get_tmp_dir())
             args.append(fn)
         self.log(" ".join(args))
         try:
@@ -124,28 +147,104 @@ class HDREnfusePlugin(IPPlugin):
                 traceback.print_exc()
 
 
+"""
+HDR using OpenCV's Mertens exposure fusion
+In process alternative to hdr-enfuse
+See utils/hdr_merge_opencv.py
+"""
+
+
+class HDRMertensPlugin(IPPlugin):
+    def __init__(self, log, default_options={}, microscope=None):
+        super().__init__(log=log,
+                         microscope=microscope,
+                         default_options=default_options)
+        plugin_config = self.usc.ipp.get_plugin("hdr-mertens")
+        # Weights are fixed per microscope => build the merger once
+        self.merge_mertens = cv2.createMergeMertens(
+            float(plugin_config.get("contrast_weight", 1.0)),
+            float(plugin_config.get("saturation_weight", 1.0)),
+            float(plugin_config.get("exposure_weight", 0.0)))
+
+    def _run(self, data_in, data_out, options={}):
+        ims = []
+        for image_in in data_in["images"]:
+            im = image_in.to_im()
+            if im.mode != "RGB":
+                im = im.convert("RGB")
+            ims.append(np.asarray(im))
+        # float32 result nominally in 0.0 to 1.0
+        fused = self.merge_mertens.process(ims)
+        fused *= 255
+        np.clip(fused, 0, 255, out=fused)
+        im_out = Image.fromarray(np.rint(fused).astype(np.uint8))
+        data_out["image"].set_im(im_out, quality=90)
+
+
 """
 Stack using enfuse
 Currently skips align
 """
 
 
+def stack_align_cache(data_in, data_out):
+    """
+    Return (cache filename, key) to reuse a tile's alignment across runs
+    or (None, None) if images aren't files
+    Kept in a hidden directory next to the output so it isn't indexed / uploaded
+    """
+    fn_out = data_out["image"].want_fn
+    fns_in = [image_in.fn for image_in in data_in["images"]]
+    if not fn_out or not all(fns_in):
+        return None, None
+    key = [[os.path.basename(fn)] + file_identity(fn) for fn in fns_in]
+    cache_fn = os.path.join(os.path.dirname(fn_out), ".stack_align",
+                            os.path.basename(fn_out) + ".json")
+    return cache_fn, key
+
+
+def align_stack(data_in, data_out, get_option):
+    """
+    Yield (index, RGB array warped onto the middle slice) for each slice
+    Slices are decoded one at a time as they are consumed
+    Order is stack_align.slice_order(), not input order
+    """
+    aligner = StackAligner(method=get_option("align_method", "phase"),
+                           downscale=int(get_option("align_downscale", 4)))
+    images = data_in["images"]
+
+    def load(i):
+        im = images[i].to_im()
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        return np.asarray(im)
+
+    cache_fn, key = stack_align_cache(data_in, data_out)
+    return aligner.align_iter(load, len(images), cache_fn=cache_fn, key=key)
+
+
 class StackEnfusePlugin(IPPlugin):
     def __init__(self, log, default_options={}, microscope=None):
         super().__init__(log=log,
                          microscope=microscope,
                          default_options=default_options,
                          need_tmp_dir=True)
-        # X1 has "perfect" axes
-        # Other systems have a lot of jitter
-        self.align = self.usc.ipp.get_plugin("stack-enfuse").get(
-            "align", False)
+        self.plugin_config = self.usc.ipp.get_plugin("stack-enfuse")
         self.enfuse = config.get_bc().enfuse_cli()
         self.align_image_stack = config.get_bc().align_image_stack_cli()
 
     def _run(self, data_in, data_out, options={}):
+        def get_option(k, default):
+            return options.get(k, self.plugin_config.get(k, default))
+
         assert self.enfuse, "Requires enfuse"
-        if self.align:
+        # X1 has "perfect" axes
+        # Other systems have a lot of jitter
+        align = get_option("align", False)
+        # align_image_stack: Hugin
+        # native: in process (see stack_align.py)
+        aligner = get_option("aligner", "align_image_stack")
+        if align and aligner == "align_image_stack":
             assert self.align_image_stack, "Requires align_image_stack"
         best_effort = options.get("best_effort", False)
 
@@ -178,7 +277,13 @@ class StackEnfusePlugin(IPPlugin):
         """
 
         prefix = "aligned_"
-        if self.align:
+        if align and aligner == "native":
+            aligned = align_stack(data_in, data_out, get_option)
+            for imi, array in aligned:
+                fn_aligned = os.path.join(self.get_tmp_dir(),
+                                          prefix + "%04u.tif" % imi)
+                Image.fromarray(array).save(fn_aligned)
+        elif align:
             # Always output as .tif
             args = list(self.align_image_stack) + [
                 # is there a reason to use -i vs -x -y?
@@ -192,7 +297,7 @@ class StackEnfusePlugin(IPPlugin):
                 os.path.join(self.get_tmp_dir(), prefix)
             ]
             for image_in in data_in["images"]:
-                args.append(image_in.get_filename())
+                args.append(image_in.get_filename(tmp_dir=self.get_tmp_dir()))
             # self.log(" ".join(args))
             check_call(args)
         else:
@@ -223,34 +328,181 @@ class StackEnfusePlugin(IPPlugin):
                 os.unlink(fn)
 
 
+"""
+Stack in process using a Laplacian pyramid
+Drop in replacement for stack-enfuse w/o the ImageMagick / enfuse round trips
+Slices are streamed in one at a time to keep memory bounded
+"""
+
+
+class StackNativePlugin(IPPlugin):
+    def __init__(self, log, default_options={}, microscope=None):
+        super().__init__(log=log,
+                         microscope=microscope,
+                         default_options=default_options)
+        self.plugin_config = self.usc.ipp.get_plugin("stack-native")
+
+    def _run(self, data_in, data_out, options={}):
+        def get_option(k, default):
+            return options.get(k, self.plugin_config.get(k, default))
+
+        stacker = PyramidFocusStacker(
+            levels=get_option("levels", None),
+            hard_mask=bool(get_option("hard_mask", True)),
+            contrast_window=int(get_option("contrast_window", 5)),
+            soft_exponent=float(get_option("soft_exponent", 4.0)))
+        if get_option("align", False):
+            for _imi, array in align_stack(data_in, data_out, get_option):
+                stacker.add(array)
+        else:
+            for image_in in data_in["images"]:
+                im = image_in.to_im()
+                if im.mode != "RGB":
+                    im = im.convert("RGB")
+                stacker.add(im)
+        data_out["image"].set_im(Image.fromarray(stacker.result()), quality=90)
+
+
+# Rows per pass when combining stabilization frames
+# Scratch is frames x rows x width x 3 bytes (8 x 64 x 5440 x 3 = 8 MB)
+STABILIZATION_STRIP_ROWS = 64
+
+
+def stabilize_frames(arrays,
+                     method="median",
+                     trim=0.25,
+                     strip_rows=STABILIZATION_STRIP_ROWS):
+    """
+    Combine repeated exposures of the same field into one uint8 image
+    arrays: list of same size uint8 HxW or HxWxC arrays
+    method
+        median: per pixel median
+            Even counts average the two middle values rounding down
+            (same as np.median().astype(np.uint8))
+        trimmed-mean: drop the trim fraction of highest and lowest values
+            then take the rounded mean of the rest
+    Works a strip of rows at a time so memory is bounded by the frames
+    themselves plus a small scratch buffer
+    """
+    nframes = len(arrays)
+    assert nframes, "No frames"
+    shape = arrays[0].shape
+    for array in arrays:
+        if array.shape != shape:
+            raise ValueError("Stabilization frame size mismatch: %s vs %s" %
+                             (array.shape, shape))
+    if method == "trimmed-mean":
+        ntrim = min(int(nframes * trim), (nframes - 1) // 2)
+    elif method != "median":
+        raise ValueError(f"Bad stabilization method {method}")
+
+    height = shape[0]
+    strip_rows = max(1, int(strip_rows))
+    ret = np.empty(shape, dtype=np.uint8)
+    scratch = np.empty((nframes, min(strip_rows, height)) + shape[1:],
+                       dtype=np.uint8)
+    mid = nframes // 2
+    for y0 in range(0, height, strip_rows):
+        y1 = min(height, y0 + strip_rows)
+        strip = scratch[:, :y1 - y0]
+        for framei, array in enumerate(arrays):
+            strip[framei] = array[y0:y1]
+        if method == "median":
+            if nframes % 2:
+                strip.partition(mid, axis=0)
+                ret[y0:y1] = strip[mid]
+            else:
+                strip.partition((mid - 1, mid), axis=0)
+                ret[y0:y1] = (strip[mid - 1].astype(np.uint16) +
+                              strip[mid]) >> 1
+        else:
+            strip.sort(axis=0)
+            keep = nframes - 2 * ntrim
+            total = strip[ntrim:nframes - ntrim].sum(axis=0, dtype=np.uint32)
+            ret[y0:y1] = (total + keep // 2) // keep
+    return ret
+
+
 class StabilizationPlugin(IPPlugin):
     def __init__(self, log, default_options={}, microscope=None):
         super().__init__(log=log,
                          microscope=microscope,
                          default_options=default_options,
                          need_tmp_dir=True)
+        self.plugin_config = self.usc.ipp.get_plugin("stabilization")
 
     def _run(self, data_in, data_out, options={}):
-        # https://stackoverflow.com/questions/34865765/finding-the-median-of-a-set-of-pictures-using-pil-and-numpy-gives-a-black-and-wh
-
-        images_np = []
-        for image_in in data_in["images"]:
-            fn = image_in.get_filename()
-            image_matrix = np.array(Image.open(fn))
-            images_np.append(image_matrix)
+        def get_option(k, default):
+            return options.get(k, self.plugin_config.get(k, default))
 
-        image_stack = np.concatenate([im[..., None] for im in images_np],
-                                     axis=3)
-        median_array = np.median(image_stack, axis=3)
-        median_array = median_array.astype(np.uint8)
-        median_image = Image.fromarray(median_array)
-        median_image.save(data_out["image"].get_filename(), quality=90)
+        # Keep frames as uint8, never build a float stack
+        images_np = [
+            np.asarray(image_in.to_im()) for image_in in data_in["images"]
+        ]
+        median_array = stabilize_frames(
+            images_np,
+            method=get_option("method", "median"),
+            trim=float(get_option("trim", 0.25)),
+            strip_rows=int(get_option("strip_rows", STABILIZATION_STRIP_ROWS)))
+        data_out["image"].set_im(Image.fromarray(median_array), quality=90)
 
 
 """
 Correct uneven illumination using a flat field mask
 """
 
+# Rows per pass when applying the gain map
+# Bounds the uint32 scratch buffer to a few MB
+FF_STRIP_ROWS = 128
+
+
+def ff_gain_map(ff_array, ff_maxes):
+    """
+    Precompute the flat field correction as fixed point
+    ff_array: HxWx3 uint8 flat field calibration image
+    ff_maxes: per channel flat field value that maps to gain 1.0
+    Return (HxWx3 uint16 gain map, shift)
+    where out = min((in * gain + round) >> shift, 255)
+
+    Boost dim values by scalars in the range 1.0 to near 0.0
+    The lower the flat field value, the more it needs to be scaled
+    Values at max flat field value stay the same
+    Dead pixels (0) have nothing to correct against and are passed through
+    Within +/- 1 of the float result for any real gain (at most 255)
+    """
+    ff_array = np.asarray(ff_array)
+    gain = np.asarray(ff_maxes, dtype=np.float64) / np.maximum(ff_array, 1)
+    gain[ff_array == 0] = 1.0
+    # Give as many fraction bits as the largest gain allows
+    int_bits = max(1, int(np.floor(gain.max())).bit_length())
+    shift = 16 - int_bits
+    gain *= 1 << shift
+    np.rint(gain, out=gain)
+    np.minimum(gain, 0xFFFF, out=gain)
+    return gain.astype(np.uint16), shift
+
+
+def ff_apply_gain(array, gain, shift, strip_rows=FF_STRIP_ROWS):
+    """
+    array: HxWx3 uint8
+    Return corrected HxWx3 uint8
+    Single interleaved multiply / shift / saturate pass, strip at a time
+    """
+    height = array.shape[0]
+    ret = np.empty_like(array)
+    scratch = np.empty((min(strip_rows, height), ) + array.shape[1:],
+                       dtype=np.uint32)
+    rounding = 1 << (shift - 1)
+    for y0 in range(0, height, strip_rows):
+        y1 = min(height, y0 + strip_rows)
+        strip = scratch[:y1 - y0]
+        np.multiply(array[y0:y1], gain[y0:y1], out=strip, dtype=np.uint32)
+        strip += rounding
+        strip >>= shift
+        np.minimum(strip, 255, out=strip)
+        ret[y0:y1] = strip
+    return ret
+
 
 class CorrectFF1Plugin(IPPlugin):
     def __init__(self, log, default_options={}, microscope=None):
@@ -260,29 +512,50 @@ class CorrectFF1Plugin(IPPlugin):
                          need_tmp_dir=True)
         # Plugin is always registered
         # Maybe should have a mechanism to exclude if it can't actually run?
-        self.ff_im = None
+        self.ff_size = None
+        self.ff_gain = None
+        self.ff_shift = None
 
         if self.usc.imager.has_ff_cal():
-            self.ff_im = Image.open(self.usc.imager.ff_cal_fn())
-            self.ff_rband_im, self.ff_gband_im, self.ff_bband_im = self.ff_im.split(
-            )
-            self.ff_rband_np = np.array(self.ff_rband_im)
-            self.ff_gband_np = np.array(self.ff_gband_im)
-            self.ff_bband_np = np.array(self.ff_bband_im)
-            self.ff_minmax()
-
-            # Boost dim values by scalars in the range 1.0 to near 0.0
-            # The lower the flat field value, the more it needs to be scaled
-            # Values at max flat field value stay the same
-            # Note: dead pixels always 0 not currently handled / will crash
-            self.rband_scalar = self.ff_rmax / self.ff_rband_np
-            self.gband_scalar = self.ff_gmax / self.ff_gband_np
-            self.bband_scalar = self.ff_bmax / self.ff_bband_np
+            # Shared read only across all workers
+            self.ff_gain, meta = get_calibration_array(
+                self.usc.imager.ff_cal_fn(), "ff1-gain-v3", self.ff_derive)
+            self.ff_size = tuple(meta["size"])
+            self.ff_shift = meta["shift"]
+            rbounds, gbounds, bbounds = meta["bounds"]
+            self.ff_rmin, self.ff_rmax = rbounds
+            self.ff_gmin, self.ff_gmax = gbounds
+            self.ff_bmin, self.ff_bmax = bbounds
 
             # It's easy to have an outlier that boosts everything
-            self.verbose and print(f"ffi r: {self.ffi_rmin} : {self.ffi_rmax}")
-            self.verbose and print(f"ffi g: {self.ffi_gmin} : {self.ffi_gmax}")
-            self.verbose and print(f"ffi b: {self.ffi_bmin} : {self.ffi_bmax}")
+            self.verbose and print(f"ff r: {self.ff_rmin} : {self.ff_rmax}")
+            self.verbose and print(f"ff g: {self.ff_gmin} : {self.ff_gmax}")
+            self.verbose and print(f"ff b: {self.ff_bmin} : {self.ff_bmax}")
+            self.verbose and print(f"ff shift: {self.ff_shift}")
+
+    def ff_derive(self, fn):
+        """
+        Calibration image => fixed point gain map
+        Only runs when the calibration cache is cold
+        """
+        ff_im = Image.open(fn).convert("RGB")
+        self.ff_rband_im, self.ff_gband_im, self.ff_bband_im = ff_im.split()
+        self.ff_minmax()
+        # Only needed to find the bounds
+        del self.ff_rband_im, self.ff_gband_im, self.ff_bband_im
+        gain, shift = ff_gain_map(np.asarray(ff_im),
+                                  (self.ff_rmax, self.ff_gmax, self.ff_bmax))
+        bounds = [[self.ff_rmin, self.ff_rmax], [self.ff_gmin, self.ff_gmax],
+                  [self.ff_bmin, self.ff_bmax]]
+        meta = {"size": list(ff_im.size), "shift": shift, "bounds": bounds}
+        return gain, meta
+
+    @classmethod
+    def cache_dependencies(cls, usc):
+        if not usc.imager.has_ff_cal():
+            return {"ff_cal": None}
+        fn = usc.imager.ff_cal_fn()
+        return {"ff_cal": [fn] + file_identity(fn)}
 
     def npf2im(self, statef):
         #return statef, None
@@ -330,54 +603,23 @@ class CorrectFF1Plugin(IPPlugin):
 
     def _run(self, data_in, data_out, options={}):
         # Calibration must be loaded
-        assert self.ff_im
+        assert self.ff_gain is not None
 
         print(f"FF1: run")
 
         self.verbose and print("")
 
         image_in = data_in["image"]
-        # im_in = "cal/cal06_ff_1.5x/2023-06-20_01-22-25_blue_20x_cal6_1.5x_pic/c000_r001.jpg"
-        im = image_in.to_mutable_im()
-        if im.size != self.ff_im.size:
+        im = image_in.to_im()
+        if im.size != self.ff_size:
             raise Exception(
                 "Calibration image size %uw x %uh but got image %uw x %uh" %
-                (self.ff_im.width, self.ff_im.height, im.width, im.height))
-
-        rband_im, gband_im, bband_im = im.split()
-        # fixme = Image.merge("RGB", (rband_im, gband_im, bband_im))
-        rband_np = np.array(rband_im)
-        gband_np = np.array(gband_im)
-        bband_np = np.array(bband_im)
+                (self.ff_size[0], self.ff_size[1], im.width, im.height))
+        if im.mode != "RGB":
+            im = im.convert("RGB")
 
-        # Rescale based on flat field
-        rband_np = np.multiply(rband_np, self.rband_scalar)
-        gband_np = np.multiply(gband_np, self.gband_scalar)
-        bband_np = np.multiply(bband_np, self.bband_scalar)
-
-        # floats aren't ideal for images
-        rband_np = np.round(rband_np)
-        gband_np = np.round(gband_np)
-        bband_np = np.round(bband_np)
-        # print("max", rband_np.max(), gband_np.max(), bband_np.max())
-
-        rband_np = np.minimum(rband_np, 255)
-        gband_np = np.minimum(gband_np, 255)
-        bband_np = np.minimum(bband_np, 255)
-        # print("max", rband_np.max(), gband_np.max(), bband_np.max())
-
-        rband_np = rband_np.astype(np.uint8)
-        gband_np = gband_np.astype(np.uint8)
-        bband_np = bband_np.astype(np.uint8)
-        # print("max", rband_np.max(), gband_np.max(), bband_np.max())
-
-        # Convert back into more standard PIL format
-        final_im_r = Image.fromarray(rband_np, "L")
-        final_im_g = Image.fromarray(gband_np, "L")
-        final_im_b = Image.fromarray(bband_np, "L")
-        final_im = Image.merge("RGB", (final_im_r, final_im_g, final_im_b))
-
-        final_im.save(data_out["image"].get_filename(), quality=90)
+        final_np = ff_apply_gain(np.asarray(im), self.ff_gain, self.ff_shift)
+        data_out["image"].set_im(Image.fromarray(final_np), quality=90)
 
 
 """
@@ -413,8 +655,7 @@ class CorrectSharp1Plugin(IPPlugin):
         pil_im = data_in["image"].to_im()
         cv_im = np.array(pil_im.convert('RGB'))[:, :, ::-1].copy()
         result = cv2.filter2D(cv_im, -1, self.kernel)
-        cv2.imwrite(data_out["image"].get_filename(), result,
-                    [int(cv2.IMWRITE_JPEG_QUALITY), 90])
+        data_out["image"].set_cv_im(result, quality=90)
 
 
 """
@@ -509,8 +750,42 @@ class CorrectVM1V1Plugin(IPPlugin):
                                corrected_b[0][0].dtype)
 
         merged = cv2.merge([corrected_b, g, r])
-        cv2.imwrite(data_out["image"].get_filename(), merged,
-                    [int(cv2.IMWRITE_JPEG_QUALITY), 90])
+        data_out["image"].set_cv_im(merged, quality=90)
+
+
+"""
+Run several 1 to 1 plugins back to back in a single decode / encode pass
+Intermediate images stay in memory
+=> no per stage I/O and no generational JPEG loss
+options["plugins"]: list of plugin names, in order
+"""
+
+
+class CorrectChainPlugin(IPPlugin):
+    def __init__(self, log, default_options={}, microscope=None):
+        super().__init__(log=log,
+                         microscope=microscope,
+                         default_options=default_options,
+                         need_tmp_dir=True)
+
+    def _run(self, data_in, data_out, options={}):
+        chain = options["plugins"]
+        assert len(chain), "Empty chain"
+        sub_options = dict(options)
+        del sub_options["plugins"]
+
+        image_in = data_in["image"]
+        for plugini, plugin_name in enumerate(chain):
+            if plugini == len(chain) - 1:
+                image_out = data_out["image"]
+            else:
+                image_out = EtherealImageW(want_im=True,
+                                           temp_dir=self.get_tmp_dir())
+            self.siblings[plugin_name].run(data_in={"image": image_in},
+                                           data_out={"image": image_out},
+                                           options=sub_options)
+            if plugini != len(chain) - 1:
+                image_in = EtherealImageR(im=image_out.get_im())
 
 
 class AnnotateScalebarPlugin(IPPlugin):
@@ -609,23 +884,60 @@ class AnnotateScalebarPlugin(IPPlugin):
         scale_text = draw_scale_text()
         draw_labsmore(scale_text)
 
-        modified_image.save(data_out["image"].get_filename(), quality=90)
+        data_out["image"].set_im(modified_image, quality=90)
 
 
 def get_plugin_ctors():
     return {
         "stack-enfuse": StackEnfusePlugin,
+        "stack-native": StackNativePlugin,
         "hdr-enfuse": HDREnfusePlugin,
+        "hdr-mertens": HDRMertensPlugin,
         "stabilization": StabilizationPlugin,
         "correct-ff1": CorrectFF1Plugin,
         "correct-sharp1": CorrectSharp1Plugin,
         "correct-vm1v1": CorrectVM1V1Plugin,
         "annotate-scalebar": AnnotateScalebarPlugin,
+        "correct-chain": CorrectChainPlugin,
     }
 
 
+class LazyPlugins:
+    """
+    Plugin set owned by a single worker
+    Plugins are constructed on first use
+    Most workers only ever run a few plugins and some are expensive to create
+    (temporary directories, calibration loading, font checks, etc)
+    """
+    def __init__(self, log=None, microscope=None, ctors=None):
+        self.log = log
+        self.microscope = microscope
+        if ctors is None:
+            ctors = get_plugin_ctors()
+        self.ctors = ctors
+        self.plugins = {}
+
+    def __contains__(self, task_name):
+        return task_name in self.ctors
+
+    def __getitem__(self, task_name):
+        plugin = self.plugins.get(task_name)
+        if plugin is None:
+            plugin = self.ctors[task_name](log=self.log,
+                                           microscope=self.microscope)
+            plugin.siblings = self
+            self.plugins[task_name] = plugin
+        return plugin
+
+    def keys(self):
+        return self.ctors.keys()
+
+    def created(self):
+        """
+        Return names of plugins that have been constructed so far
+        """
+        return list(self.plugins.keys())
+
+
 def get_plugins(log=None, microscope=None):
-    return {
-        k: v(log=log, microscope=microscope)
-        for k, v in get_plugin_ctors().items()
-    }
+    return LazyPlugins(log=log, microscope=microscope)
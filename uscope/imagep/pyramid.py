@@ -0,0 +1,402 @@
+"""
+Multi resolution tile pyramid of a processed scan + offline viewer
+
+The HTML table viewer (write_html_viewer) points the browser at every full
+resolution capture which makes opening a large scan decode gigabytes
+Instead cut the snapshot grid (see SnapshotGrid) into a Deep Zoom pyramid:
+    summary/pyramid.dzi
+    summary/pyramid_files/<level>/<col>_<row>.jpg
+Level max is full resolution, each level below is half the size of the
+one above it down to 1 x 1 (level 0)
+Tiles are tile_size square (smaller on the right / bottom edges), no overlap
+summary/pyramid.html only loads the tiles visible at the current zoom
+It works straight from the local disk (file://)
+and the .dzi can also be opened with other Deep Zoom viewers (ex: OpenSeadragon)
+
+Generation streams the grid top to bottom: each level buffers one row of tiles
+which is written (in parallel) and then halved into the level below
+"""
+
+from uscope.imagep.band_writer import BandWriter, MODES
+from uscope.imagep.summary import SnapshotGrid
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import json
+import math
+import numpy as np
+import os
+import shutil
+from PIL import Image
+
+DZI_TEMPLATE = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"
+  Format="{format}"
+  Overlap="0"
+  TileSize="{tile_size}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+
+VIEWER_TEMPLATE = """\
+<!DOCTYPE html>
+<html lang="en">
+
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Labsmore Scan Viewer</title>
+    <style>
+        html,
+        body {
+            margin: 0;
+            height: 100%;
+            overflow: hidden;
+            font-family: Arial, Helvetica, sans-serif;
+            color: gray;
+            background-color: #000000;
+        }
+
+        #viewer {
+            position: absolute;
+            left: 0;
+            top: 0;
+            right: 0;
+            bottom: 0;
+            cursor: grab;
+            touch-action: none;
+        }
+
+        #viewer img {
+            position: absolute;
+            user-select: none;
+        }
+
+        #status {
+            position: absolute;
+            left: 8px;
+            bottom: 8px;
+            font-size: 12px;
+        }
+    </style>
+</head>
+
+<body>
+    <div id="viewer"></div>
+    <div id="status"></div>
+    <script>
+        const PYRAMID = __PYRAMID__;
+        // Always drawn under the current level so zooming never shows holes
+        const BASE_LEVEL = Math.min(PYRAMID.maxLevel, 10);
+        const viewer = document.getElementById("viewer");
+        const status = document.getElementById("status");
+        // Full resolution pixel (x, y) is drawn at screen (x * zoom + ox, y * zoom + oy)
+        let zoom = 1;
+        let ox = 0;
+        let oy = 0;
+        let fitZoom = 1;
+        // "level/col_row" => img
+        const tiles = new Map();
+        let pending = false;
+
+        function fit() {
+            const w = viewer.clientWidth;
+            const h = viewer.clientHeight;
+            fitZoom = Math.min(w / PYRAMID.width, h / PYRAMID.height);
+            zoom = fitZoom;
+            ox = (w - PYRAMID.width * zoom) / 2;
+            oy = (h - PYRAMID.height * zoom) / 2;
+            schedule();
+        }
+
+        function schedule() {
+            if (!pending) {
+                pending = true;
+                window.requestAnimationFrame(render);
+            }
+        }
+
+        function showLevel(level, wanted) {
+            // Full resolution pixels per level pixel
+            const scale = Math.pow(2, PYRAMID.maxLevel - level);
+            const levelWidth = Math.ceil(PYRAMID.width / scale);
+            const levelHeight = Math.ceil(PYRAMID.height / scale);
+            const size = PYRAMID.tileSize;
+            const screenTile = size * scale * zoom;
+            const col0 = Math.max(0, Math.floor(-ox / screenTile));
+            const col1 = Math.min(Math.ceil(levelWidth / size) - 1,
+                Math.floor((viewer.clientWidth - ox) / screenTile));
+            const row0 = Math.max(0, Math.floor(-oy / screenTile));
+            const row1 = Math.min(Math.ceil(levelHeight / size) - 1,
+                Math.floor((viewer.clientHeight - oy) / screenTile));
+            for (let row = row0; row <= row1; row++) {
+                for (let col = col0; col <= col1; col++) {
+                    const key = level + "/" + col + "_" + row;
+                    wanted.add(key);
+                    let img = tiles.get(key);
+                    if (!img) {
+                        img = document.createElement("img");
+                        img.draggable = false;
+                        img.style.zIndex = level;
+                        img.src = PYRAMID.files + "/" + key + "." + PYRAMID.format;
+                        tiles.set(key, img);
+                        viewer.appendChild(img);
+                    }
+                    // Edge tiles are smaller. Snap to whole pixels to avoid seams
+                    const width = Math.min(size, levelWidth - col * size);
+                    const height = Math.min(size, levelHeight - row * size);
+                    const x0 = Math.floor(ox + col * screenTile);
+                    const y0 = Math.floor(oy + row * screenTile);
+                    const x1 = Math.ceil(ox + (col * size + width) * scale * zoom);
+                    const y1 = Math.ceil(oy + (row * size + height) * scale * zoom);
+                    img.style.left = x0 + "px";
+                    img.style.top = y0 + "px";
+                    img.style.width = (x1 - x0) + "px";
+                    img.style.height = (y1 - y0) + "px";
+                }
+            }
+        }
+
+        function render() {
+            pending = false;
+            // Coarsest level with at least one pixel per screen pixel
+            const ratio = zoom * (window.devicePixelRatio || 1);
+            const level = Math.max(0, Math.min(PYRAMID.maxLevel,
+                PYRAMID.maxLevel + Math.ceil(Math.log2(ratio))));
+            const wanted = new Set();
+            showLevel(Math.min(level, BASE_LEVEL), wanted);
+            showLevel(level, wanted);
+            for (const [key, img] of tiles) {
+                if (!wanted.has(key)) {
+                    img.remove();
+                    tiles.delete(key);
+                }
+            }
+            status.textContent = PYRAMID.width + " x " + PYRAMID.height +
+                ", level " + level + " / " + PYRAMID.maxLevel +
+                ", " + (zoom * 100).toFixed(1) + "%";
+        }
+
+        function zoomAt(x, y, factor) {
+            // From fit to window up to 8 screen pixels per image pixel
+            const newZoom = Math.max(Math.min(fitZoom, 1), Math.min(8, zoom * factor));
+            ox = x - (x - ox) * newZoom / zoom;
+            oy = y - (y - oy) * newZoom / zoom;
+            zoom = newZoom;
+            schedule();
+        }
+
+        viewer.addEventListener("wheel", function(e) {
+            e.preventDefault();
+            zoomAt(e.clientX, e.clientY, Math.pow(1.0015, -e.deltaY));
+        }, {
+            passive: false
+        });
+        viewer.addEventListener("dblclick", function(e) {
+            zoomAt(e.clientX, e.clientY, e.shiftKey ? 0.5 : 2);
+        });
+
+        let drag = null;
+        viewer.addEventListener("pointerdown", function(e) {
+            viewer.setPointerCapture(e.pointerId);
+            viewer.style.cursor = "grabbing";
+            drag = {
+                x: e.clientX,
+                y: e.clientY
+            };
+        });
+        viewer.addEventListener("pointermove", function(e) {
+            if (drag) {
+                ox += e.clientX - drag.x;
+                oy += e.clientY - drag.y;
+                drag.x = e.clientX;
+                drag.y = e.clientY;
+                schedule();
+            }
+        });
+        viewer.addEventListener("pointerup", function(e) {
+            viewer.style.cursor = "grab";
+            drag = null;
+        });
+
+        window.addEventListener("keydown", function(e) {
+            const x = viewer.clientWidth / 2;
+            const y = viewer.clientHeight / 2;
+            if (e.key == "+" || e.key == "=") {
+                zoomAt(x, y, 1.5);
+            } else if (e.key == "-") {
+                zoomAt(x, y, 1 / 1.5);
+            } else if (e.key == "0") {
+                fit();
+            }
+        });
+        window.addEventListener("resize", schedule);
+        fit();
+    </script>
+</body>
+</html>
+"""
+
+
+def half_size(rows):
+    """
+    Return rows (h, w, samples) shrunk 2x, rounding odd sizes up
+    """
+    h, w = rows.shape[:2]
+    if h % 2 or w % 2:
+        rows = np.pad(rows, ((0, h % 2), (0, w % 2), (0, 0)), mode="edge")
+    size = (rows.shape[1] // 2, rows.shape[0] // 2)
+    # Exact 2x => box filter
+    ret = cv2.resize(rows, size, interpolation=cv2.INTER_AREA)
+    return ret.reshape(size[1], size[0], rows.shape[2])
+
+
+class PyramidLevel(BandWriter):
+    """
+    One level: cuts rows into tiles and passes them on at half size
+    """
+    def __init__(self, pyramid, level, width, height):
+        super().__init__(width, height, pyramid.mode, pyramid.tile_size)
+        self.pyramid = pyramid
+        self.level = level
+        self.tile_row = 0
+        os.mkdir(os.path.join(pyramid.files_dir, str(level)))
+        self.below = None
+        if level > 0:
+            self.below = PyramidLevel(pyramid, level - 1, (width + 1) // 2,
+                                      (height + 1) // 2)
+
+    def write_chunk(self, rows):
+        self.pyramid.save_tiles(self.level, self.tile_row, rows)
+        self.tile_row += 1
+        if self.below:
+            self.below.write_rows(half_size(rows))
+
+    def finish(self):
+        if self.below:
+            self.below.close()
+
+    def abort(self):
+        pass
+
+
+class PyramidWriter:
+    """
+    Same interface as the band writers: write_rows() top to bottom, close()
+    """
+    def __init__(self,
+                 output_dir,
+                 width,
+                 height,
+                 mode="RGB",
+                 name="pyramid",
+                 tile_size=256,
+                 quality=90,
+                 executor=None):
+        if mode not in MODES:
+            raise ValueError(f"Unsupported mode {mode}")
+        self.output_dir = output_dir
+        self.name = name
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.tile_size = tile_size
+        self.quality = quality
+        self.executor = executor
+        self.max_level = int(math.ceil(math.log2(max(width, height, 1))))
+        self.files_dir = os.path.join(output_dir, name + "_files")
+        # Don't mix with tiles from a previous (ex: differently sized) run
+        shutil.rmtree(self.files_dir, ignore_errors=True)
+        os.makedirs(self.files_dir)
+        self.top = PyramidLevel(self, self.max_level, width, height)
+        self.tiles = 0
+
+    def levels(self):
+        return self.max_level + 1
+
+    def write_rows(self, rows):
+        self.top.write_rows(rows)
+
+    def save_tile(self, fn, tile):
+        if self.mode == "L":
+            tile = tile[:, :, 0]
+        Image.fromarray(tile, self.mode).save(fn, quality=self.quality)
+
+    def save_tiles(self, level, row, rows):
+        level_dir = os.path.join(self.files_dir, str(level))
+        args = []
+        for col, x in enumerate(range(0, rows.shape[1], self.tile_size)):
+            fn = os.path.join(level_dir, "%u_%u.jpg" % (col, row))
+            args.append((fn, rows[:, x:x + self.tile_size]))
+        if self.executor:
+            list(self.executor.map(lambda arg: self.save_tile(*arg), args))
+        else:
+            for arg in args:
+                self.save_tile(*arg)
+        self.tiles += len(args)
+
+    def close(self):
+        self.top.close()
+        with open(os.path.join(self.output_dir, self.name + ".dzi"), "w") as f:
+            f.write(
+                DZI_TEMPLATE.format(format="jpg",
+                                    tile_size=self.tile_size,
+                                    width=self.width,
+                                    height=self.height))
+        pyramid = {
+            "width": self.width,
+            "height": self.height,
+            "tileSize": self.tile_size,
+            "maxLevel": self.max_level,
+            "format": "jpg",
+            # Relative to the viewer
+            "files": self.name + "_files",
+        }
+        with open(os.path.join(self.output_dir, self.name + ".html"),
+                  "w") as f:
+            f.write(VIEWER_TEMPLATE.replace("__PYRAMID__",
+                                            json.dumps(pyramid)))
+
+    def abort(self):
+        shutil.rmtree(self.files_dir, ignore_errors=True)
+
+
+def write_pyramid(iindex,
+                  output_dir=None,
+                  tile_size=256,
+                  quality=90,
+                  threads=None,
+                  verbose=True):
+    """
+    Return the viewer filename
+    """
+    if output_dir is None:
+        output_dir = os.path.join(iindex["dir"], "summary")
+    if not os.path.exists(output_dir):
+        os.mkdir(output_dir)
+    grid = SnapshotGrid(iindex,
+                        output_filename=os.path.join(output_dir,
+                                                     "pyramid.dzi"),
+                        threads=threads,
+                        verbose=verbose)
+    grid.calc_dimensions()
+    with ThreadPoolExecutor(max_workers=grid.threads) as executor:
+        pyramid = PyramidWriter(output_dir,
+                                grid.width,
+                                grid.height,
+                                mode=grid.mode,
+                                tile_size=tile_size,
+                                quality=quality,
+                                executor=executor)
+        verbose and print(
+            "Writing pyramid %s (%uw x %uh, %u levels)..." %
+            (pyramid.files_dir, grid.width, grid.height, pyramid.levels()))
+        try:
+            for rows in grid.iter_rows(executor):
+                pyramid.write_rows(rows)
+            pyramid.close()
+        except BaseException:
+            pyramid.abort()
+            raise
+    verbose and print("Done! %u tiles" % (pyramid.tiles, ))
+    return os.path.join(output_dir, pyramid.name + ".html")
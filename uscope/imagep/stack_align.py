@@ -0,0 +1,301 @@
+"""
+In process focus stack alignment
+Replacement for Hugin's align_image_stack on stages with z jitter
+
+Transforms are estimated on grayscale slices
+phase (default)
+    Translation only using FFT phase correlation
+    Coarse estimate on downsampled slices, refined on a full resolution crop
+    Fast and robust to the focus changing between slices
+ecc
+    Translation + rotation refined with ECC starting from the phase estimate
+Neighboring slices are compared since they are the most similar
+and then chained to the reference (middle) slice
+Slices are loaded, aligned and handed off one at a time walking outwards
+from the reference so only two grayscale slices are held at once
+
+Transforms are 2x3 affine matrices mapping slice pixel coordinates
+to reference pixel coordinates (ie cv2.warpAffine forward matrices)
+"""
+
+import cv2
+import json
+import numpy as np
+import os
+
+
+def identity_transform():
+    return np.eye(2, 3, dtype=np.float64)
+
+
+def compose_transforms(a, b):
+    """
+    Return transform applying b and then a
+    """
+    a3 = np.vstack([a, [0, 0, 1]])
+    b3 = np.vstack([b, [0, 0, 1]])
+    return (a3 @ b3)[0:2]
+
+
+def invert_transform(m):
+    return cv2.invertAffineTransform(m).astype(np.float64)
+
+
+def translation_transform(dx, dy):
+    ret = identity_transform()
+    ret[0, 2] = dx
+    ret[1, 2] = dy
+    return ret
+
+
+def slice_order(n):
+    """
+    Middle (reference) slice first, then outwards towards each end
+    """
+    ref = n // 2
+    return [ref] + list(range(ref - 1, -1, -1)) + list(range(ref + 1, n))
+
+
+class StackAligner:
+    def __init__(self,
+                 method="phase",
+                 downscale=4,
+                 refine_size=512,
+                 max_shift=0.1,
+                 min_response=0.02,
+                 ecc_iterations=50):
+        if method not in ("phase", "ecc"):
+            raise ValueError(f"Bad stack align method {method}")
+        self.method = method
+        self.downscale = max(1, int(downscale))
+        # Full resolution center crop used to refine the coarse estimate
+        # 0 => coarse only
+        self.refine_size = int(refine_size)
+        # Reject shifts larger than this fraction of the image
+        self.max_shift = max_shift
+        # Phase correlation peak strength below which we don't trust it
+        self.min_response = min_response
+        self.ecc_iterations = ecc_iterations
+        self.verbose = False
+
+    def params(self):
+        """
+        Settings that affect the transforms (ie the cache key)
+        """
+        return {
+            "method": self.method,
+            "downscale": self.downscale,
+            "refine_size": self.refine_size,
+            "max_shift": self.max_shift,
+            "min_response": self.min_response,
+            "ecc_iterations": self.ecc_iterations,
+        }
+
+    def gray(self, array):
+        if array.ndim == 3:
+            return cv2.cvtColor(array, cv2.COLOR_RGB2GRAY)
+        return array
+
+    def small(self, gray):
+        if self.downscale > 1:
+            height, width = gray.shape
+            size = (max(1, width // self.downscale),
+                    max(1, height // self.downscale))
+            gray = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+        return gray.astype(np.float32)
+
+    def coarse_shift(self, src, dst, window):
+        """
+        Return full resolution (dx, dy) from the downsampled images
+        or None if the estimate isn't trustworthy
+        """
+        (dx, dy), response = cv2.phaseCorrelate(src, dst, window)
+        height, width = src.shape
+        max_dx = width * self.max_shift
+        max_dy = height * self.max_shift
+        too_far = abs(dx) > max_dx or abs(dy) > max_dy
+        if response < self.min_response or too_far:
+            self.verbose and print(
+                "stack align: reject %0.1f, %0.1f (response %0.3f)" %
+                (dx, dy, response))
+            return None
+        return dx * self.downscale, dy * self.downscale
+
+    def crop_origin(self, shape):
+        """
+        Return (x0, y0, size) of the refinement crop
+        """
+        height, width = shape
+        size = min(self.refine_size, width, height)
+        return (width - size) // 2, (height - size) // 2, size
+
+    def refine_shift(self, src, dst, shift):
+        """
+        src, dst: full resolution grayscale
+        Phase correlate a center crop of dst against the matching
+        (coarse shift compensated) crop of src
+        """
+        x0, y0, size = self.crop_origin(dst.shape)
+        height, width = src.shape
+        sx0 = min(max(0, x0 - int(round(shift[0]))), width - size)
+        sy0 = min(max(0, y0 - int(round(shift[1]))), height - size)
+        src_crop = src[sy0:sy0 + size, sx0:sx0 + size].astype(np.float32)
+        dst_crop = dst[y0:y0 + size, x0:x0 + size].astype(np.float32)
+        window = cv2.createHanningWindow((size, size), cv2.CV_32F)
+        (dx, dy), response = cv2.phaseCorrelate(src_crop, dst_crop, window)
+        if response < self.min_response:
+            return shift
+        return x0 - sx0 + dx, y0 - sy0 + dy
+
+    def refine_ecc(self, src, dst, transform):
+        """
+        Add rotation by running ECC on the full resolution center crops
+        """
+        x0, y0, size = self.crop_origin(dst.shape)
+        src_crop = src[y0:y0 + size, x0:x0 + size].astype(np.float32)
+        dst_crop = dst[y0:y0 + size, x0:x0 + size].astype(np.float32)
+        # ECC warp maps template (dst) coordinates to input (src) coordinates
+        # A pure translation is the same in crop and full coordinates
+        warp = invert_transform(transform).astype(np.float32)
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
+                    self.ecc_iterations, 1e-4)
+        try:
+            _cc, warp = cv2.findTransformECC(dst_crop, src_crop, warp,
+                                             cv2.MOTION_EUCLIDEAN, criteria,
+                                             None, 5)
+        except cv2.error:
+            # Didn't converge, phase estimate is still reasonable
+            self.verbose and print("stack align: ECC failed")
+            return transform
+        # Crop => full coordinates
+        origin = translation_transform(x0, y0)
+        warp = compose_transforms(
+            origin, compose_transforms(warp, translation_transform(-x0, -y0)))
+        return invert_transform(warp)
+
+    def estimate_pair(self, src, dst):
+        """
+        src, dst: (full resolution gray, small float32 gray)
+        Return transform taking src coordinates to dst coordinates
+        """
+        shift = self.coarse_shift(src[1], dst[1], self.window)
+        if shift is None:
+            return identity_transform()
+        if self.refine_size:
+            shift = self.refine_shift(src[0], dst[0], shift)
+        ret = translation_transform(*shift)
+        if self.method == "ecc" and self.refine_size:
+            ret = self.refine_ecc(src[0], dst[0], ret)
+        return ret
+
+    def prepare(self, array):
+        """
+        Return (full resolution gray, small float32 gray)
+        """
+        gray = self.gray(array)
+        return gray, self.small(gray)
+
+    def iter_transforms(self, load, n):
+        """
+        Yield (index, slice, transform) walking outwards from the middle slice
+        load(i): return slice i as an array
+        """
+        ref = n // 2
+        transforms = [None] * n
+        ref_gray = prev_gray = None
+        for i in slice_order(n):
+            array = load(i)
+            gray = self.prepare(array)
+            if i == ref:
+                small_shape = gray[1].shape
+                self.window = cv2.createHanningWindow(
+                    (small_shape[1], small_shape[0]), cv2.CV_32F)
+                transforms[i] = identity_transform()
+                ref_gray = gray
+            else:
+                neighbor = i + 1 if i < ref else i - 1
+                # First slice past the reference restarts from it
+                neighbor_gray = ref_gray if neighbor == ref else prev_gray
+                transforms[i] = compose_transforms(
+                    transforms[neighbor],
+                    self.estimate_pair(gray, neighbor_gray))
+            prev_gray = gray
+            yield i, array, transforms[i]
+
+    def estimate(self, arrays):
+        """
+        Return a list of transforms, one per slice
+        """
+        ret = [None] * len(arrays)
+        for i, _array, transform in self.iter_transforms(
+                lambda i: arrays[i], len(arrays)):
+            ret[i] = transform
+        return ret
+
+    def warp(self, array, transform):
+        if np.allclose(transform, identity_transform()):
+            return array
+        height, width = array.shape[0:2]
+        return cv2.warpAffine(array,
+                              transform, (width, height),
+                              flags=cv2.INTER_LINEAR,
+                              borderMode=cv2.BORDER_REPLICATE)
+
+    def load_cache(self, cache_fn, key):
+        if not cache_fn or not os.path.exists(cache_fn):
+            return None
+        try:
+            with open(cache_fn) as f:
+                j = json.load(f)
+        except ValueError:
+            return None
+        if j.get("key") != key or j.get("params") != self.params():
+            return None
+        return [np.array(transform) for transform in j["transforms"]]
+
+    def save_cache(self, cache_fn, key, transforms):
+        os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+        j = {
+            "key": key,
+            "params": self.params(),
+            "transforms": [transform.tolist() for transform in transforms],
+        }
+        fn_tmp = cache_fn + ".tmp"
+        with open(fn_tmp, "w") as f:
+            json.dump(j, f)
+        os.replace(fn_tmp, cache_fn)
+
+    def align_iter(self, load, n, cache_fn=None, key=None):
+        """
+        Yield (index, slice warped onto the middle slice) for the n slices
+        in slice_order()
+        load(i): return slice i as an array
+        If cache_fn and key are given transforms are reused across runs
+        as long as key (ex: input file identities) is unchanged
+        """
+        transforms = None
+        if cache_fn and key:
+            transforms = self.load_cache(cache_fn, key)
+        if transforms is not None:
+            for i in slice_order(n):
+                yield i, self.warp(load(i), transforms[i])
+            return
+
+        transforms = [None] * n
+        for i, array, transform in self.iter_transforms(load, n):
+            transforms[i] = transform
+            yield i, self.warp(array, transform)
+        if cache_fn and key:
+            self.save_cache(cache_fn, key, transforms)
+
+    def align(self, arrays, cache_fn=None, key=None):
+        """
+        Return slices warped onto the middle slice
+        """
+        ret = [None] * len(arrays)
+        for i, array in self.align_iter(lambda i: arrays[i],
+                                        len(arrays),
+                                        cache_fn=cache_fn,
+                                        key=key):
+            ret[i] = array
+        return ret
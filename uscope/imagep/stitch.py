@@ -0,0 +1,524 @@
+"""
+Local stitcher: for scans that can't (or shouldn't wait to) be uploaded
+
+Tiles are placed with a translation each. In order:
+-priors: stage positions from uscan.json converted to camera pixels
+    Camera rotation (calibration optics rotation_cw) is applied to the
+    stage axes rather than to the tiles so tiles are never resampled
+-pairwise: FFT phase correlation of each left / right and up / down pair
+    only on the strip the priors say they share
+    Weak or out of range peaks (ex: blank areas) fall back to the prior
+-layout: weighted least squares over all pairs
+    (sparse normal equations, conjugate gradient)
+    Pairs that disagree with the solution are demoted and it is solved again
+-blend: feathered across the overlap, a band of rows at a time
+    straight into a streaming band writer (JPEG, BigTIFF if too big)
+    and optionally a Deep Zoom pyramid (see pyramid.py)
+
+Tiles are decoded / correlated / blended in parallel
+Memory stays at about two rows of tiles regardless of how many rows there are
+
+Writes summary/stitch.jpg (or .tif) and summary/stitch.json (layout)
+"""
+
+from uscope.imagep.summary import QuickPano, new_band_writer
+from uscope.imagep.pyramid import PyramidWriter
+from uscope.util import writej
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import os
+from PIL import Image
+
+# Narrower shared strips don't have enough signal to correlate
+MIN_OVERLAP = 16
+# Phase correlation peaks further out than this fraction of the strip
+# may have wrapped around
+MAX_SHIFT = 0.4
+# Pairs without a trusted measurement still hold the layout together
+PRIOR_WEIGHT = 0.01
+# Pins the layout as a whole to the stage
+# Tiny: starting from the priors it only matters for tiles without pairs
+# and it would otherwise bend the layout towards the stage error
+ANCHOR_WEIGHT = 1e-8
+
+
+def fft_range(start, end):
+    """
+    Return the centered sub range of [start, end) with an even length
+    that the DFT doesn't need to pad
+    cv2.phaseCorrelate is biased by half a pixel on odd (padded) sizes
+    """
+    n = end - start
+    size = n - n % 2
+    while cv2.getOptimalDFTSize(size) != size:
+        size -= 2
+    start += (n - size) // 2
+    return start, start + size
+
+
+def solve_layout(ia,
+                 ib,
+                 offsets,
+                 weights,
+                 priors,
+                 anchor_weight=ANCHOR_WEIGHT,
+                 tolerance=1e-4,
+                 max_iterations=5000):
+    """
+    Return positions (n, 2) minimizing
+        sum(weights * |p[ib] - p[ia] - offsets|^2)
+        + anchor_weight * sum(|p - priors|^2)
+    x and y are independent systems solved side by side
+    with Jacobi preconditioned conjugate gradient starting from the priors
+    """
+    n = len(priors)
+    weights = weights[:, None]
+
+    def normal(p):
+        diff = weights * (p[ib] - p[ia])
+        ret = anchor_weight * p
+        np.add.at(ret, ib, diff)
+        np.subtract.at(ret, ia, diff)
+        return ret
+
+    rhs = anchor_weight * priors
+    np.add.at(rhs, ib, weights * offsets)
+    np.subtract.at(rhs, ia, weights * offsets)
+    diag = (anchor_weight + np.bincount(ia, weights[:, 0], minlength=n) +
+            np.bincount(ib, weights[:, 0], minlength=n))[:, None]
+
+    ret = priors.astype(np.float64)
+    residual = rhs - normal(ret)
+    z = residual / diag
+    direction = z.copy()
+    rz = (residual * z).sum(axis=0)
+    zeros = np.zeros(2)
+    for _iteration in range(max_iterations):
+        if np.abs(residual).max() < tolerance:
+            break
+        step = normal(direction)
+        curvature = (direction * step).sum(axis=0)
+        # A converged axis stops moving
+        alpha = np.divide(rz, curvature, out=zeros.copy(), where=curvature > 0)
+        ret += alpha * direction
+        residual -= alpha * step
+        z = residual / diag
+        rz_next = (residual * z).sum(axis=0)
+        beta = np.divide(rz_next, rz, out=zeros.copy(), where=rz > 0)
+        direction = z + beta * direction
+        rz = rz_next
+    return ret
+
+
+class Stitcher:
+    """
+    min_response: phase correlation peak strength needed to trust a pair
+    max_residual: pixels a pair may disagree with the solved layout
+    band_rows: output rows blended at a time
+    pyramid: also write a Deep Zoom pyramid + viewer next to the output
+    """
+    def __init__(self,
+                 iindex,
+                 output_filename=None,
+                 threads=None,
+                 min_response=0.05,
+                 max_residual=3.0,
+                 band_rows=256,
+                 pyramid=False,
+                 verbose=True):
+        assert iindex[
+            "flat"], "Stitching only supported on final level image set"
+        self.iindex = iindex
+        if output_filename is None:
+            d = os.path.join(iindex["dir"], "summary")
+            if not os.path.exists(d):
+                os.mkdir(d)
+            output_filename = os.path.join(d, "stitch.jpg")
+        self.output_filename = output_filename
+        self.threads = threads or os.cpu_count() or 1
+        self.min_response = min_response
+        self.max_residual = max_residual
+        self.band_rows = band_rows
+        self.pyramid = pyramid
+        self.verbose = verbose
+        self.windows = {}
+
+    def filename(self, tile):
+        return os.path.join(self.iindex["dir"],
+                            self.iindex["crs"][tile]["basename"])
+
+    def load_priors(self):
+        """
+        Expected tile upper left in camera pixels from the stage positions
+        """
+        pano = QuickPano(self.iindex, output_filename=self.output_filename)
+        pano.load_scan_json()
+        with Image.open(self.filename((0, 0))) as im0:
+            self.tile_size = im0.size
+            self.mode = im0.mode if im0.mode in ("L", "RGB") else "RGB"
+        pixel_per_mm = 1000 / (
+            pano.uscan["pconfig"]["app"]["objective"]["um_per_pixel"])
+        self.rotation = pano.get_rotation_cw() or 0.0
+        # Stage axes => camera axes. QuickPano rotates tiles the other way
+        rotate = cv2.getRotationMatrix2D((0, 0), -self.rotation, 1.0)[:, :2]
+        self.priors = {}
+        for tile, info in pano.cr2info.items():
+            if tile not in self.iindex["crs"]:
+                continue
+            # Stage y is up while image y is down
+            stage = np.array([info["position"]["x"], -info["position"]["y"]])
+            self.priors[tile] = rotate @ (stage * pixel_per_mm)
+        self.tiles = sorted(self.priors, key=lambda tile: (tile[1], tile[0]))
+
+        overlaps = pano.get_overlaps()
+        w, h = self.tile_size
+        # Blend across the nominal overlap (10% if unknown)
+        self.feather = (max(
+            1,
+            overlaps.get("x", {}).get("overlap_pixels", w // 10)),
+                        max(
+                            1,
+                            overlaps.get("y", {}).get("overlap_pixels",
+                                                      h // 10)))
+
+    def overlap_region(self, a, b):
+        """
+        Return ((x0, y0, x1, y1) in a, (dx, dy) prior offset of b from a)
+        or None if the priors don't overlap enough to correlate
+        """
+        dx, dy = (int(round(v)) for v in self.priors[b] - self.priors[a])
+        w, h = self.tile_size
+        x0, x1 = max(0, dx), min(w, w + dx)
+        y0, y1 = max(0, dy), min(h, h + dy)
+        if x1 - x0 < MIN_OVERLAP or y1 - y0 < MIN_OVERLAP:
+            return None
+        x0, x1 = fft_range(x0, x1)
+        y0, y1 = fft_range(y0, y1)
+        return (x0, y0, x1, y1), (dx, dy)
+
+    def find_pairs(self):
+        """
+        Neighbors to the right and below that share a strip
+        """
+        self.regions = {}
+        self.tile_pairs = {tile: [] for tile in self.tiles}
+        for a in self.tiles:
+            col, row = a
+            for b in ((col + 1, row), (col, row + 1)):
+                if b not in self.priors:
+                    continue
+                region = self.overlap_region(a, b)
+                if region is None:
+                    continue
+                self.regions[(a, b)] = region
+                self.tile_pairs[a].append((a, b))
+                self.tile_pairs[b].append((a, b))
+
+    def load_strips(self, tile):
+        """
+        Return {pair: grayscale strip of tile shared with the other tile}
+        """
+        with Image.open(self.filename(tile)) as im:
+            # JPEG: decode straight to grayscale
+            im.draft("L", im.size)
+            gray = np.asarray(im.convert("L"))
+        ret = {}
+        for pair in self.tile_pairs[tile]:
+            (x0, y0, x1, y1), (dx, dy) = self.regions[pair]
+            if tile == pair[1]:
+                x0, x1, y0, y1 = x0 - dx, x1 - dx, y0 - dy, y1 - dy
+            ret[pair] = gray[y0:y1, x0:x1].copy()
+        return ret
+
+    def window(self, shape):
+        ret = self.windows.get(shape)
+        if ret is None:
+            ret = cv2.createHanningWindow((shape[1], shape[0]), cv2.CV_32F)
+            self.windows[shape] = ret
+        return ret
+
+    def correlate(self, pair, strip_a, strip_b):
+        """
+        Return (dx, dy, response) measured offset of b from a
+        response 0 => rejected, (dx, dy) is the prior
+        """
+        _region, (dx, dy) = self.regions[pair]
+        h, w = strip_a.shape
+        # strip_b is strip_a moved by the prior's error
+        (sx, sy), response = cv2.phaseCorrelate(strip_a.astype(np.float32),
+                                                strip_b.astype(np.float32),
+                                                self.window(strip_a.shape))
+        too_far = abs(sx) > w * MAX_SHIFT or abs(sy) > h * MAX_SHIFT
+        if response < self.min_response or too_far:
+            return dx, dy, 0.0
+        return dx - sx, dy - sy, response
+
+    def measure(self, executor):
+        """
+        Correlate all pairs a row of tiles at a time
+        Only the strips of the current and previous row are kept
+        """
+        self.measurements = {}
+        previous = {}
+        for row in range(self.iindex["rows"]):
+            tiles = [tile for tile in self.tiles if tile[1] == row]
+            current = dict(zip(tiles, executor.map(self.load_strips, tiles)))
+            strips = dict(previous)
+            strips.update(current)
+            # Pairs ending in this row: horizontal + vertical from above
+            pairs = [pair for pair in self.regions if pair[1][1] == row]
+
+            def correlate(pair):
+                return self.correlate(pair, strips[pair[0]][pair],
+                                      strips[pair[1]][pair])
+
+            self.measurements.update(zip(pairs, executor.map(correlate,
+                                                             pairs)))
+            previous = current
+        accepted = sum(1 for _dx, _dy, response in self.measurements.values()
+                       if response)
+        self.verbose and print("Stitch: %u / %u pairs matched" %
+                               (accepted, len(self.measurements)))
+
+    def solve(self):
+        """
+        Set self.layout: tile => (x, y) integer output position
+        """
+        index = {tile: i for i, tile in enumerate(self.tiles)}
+        priors = np.array([self.priors[tile] for tile in self.tiles])
+        pairs = list(self.measurements)
+        ia = np.array([index[a] for a, _b in pairs], dtype=np.int64)
+        ib = np.array([index[b] for _a, b in pairs], dtype=np.int64)
+        measured = np.array([self.measurements[pair][0:2] for pair in pairs],
+                            dtype=np.float64).reshape(-1, 2)
+        prior_offsets = priors[ib] - priors[ia]
+        self.used = np.array(
+            [self.measurements[pair][2] > 0 for pair in pairs], dtype=bool)
+        while True:
+            offsets = np.where(self.used[:, None], measured, prior_offsets)
+            weights = np.where(self.used, 1.0, PRIOR_WEIGHT)
+            positions = solve_layout(ia, ib, offsets, weights, priors)
+            residuals = np.hypot(*(positions[ib] - positions[ia] - offsets).T)
+            bad = self.used & (residuals > self.max_residual)
+            if not bad.any():
+                break
+            # Worst first: one bad pair also pulls its good neighbors off
+            worst = residuals[bad].max()
+            drop = bad & (residuals >= 0.5 * worst)
+            self.verbose and print(
+                "Stitch: demoting %u pairs (residual up to %0.1f)" %
+                (drop.sum(), worst))
+            self.used &= ~drop
+        self.pairs = pairs
+        self.residuals = residuals
+        self.positions = positions
+        origin = positions.min(axis=0)
+        self.layout = {}
+        for tile, position in zip(self.tiles, positions):
+            x, y = np.round(position - origin).astype(int)
+            self.layout[tile] = (int(x), int(y))
+        w, h = self.tile_size
+        self.width = max(x for x, _y in self.layout.values()) + w
+        self.height = max(y for _x, y in self.layout.values()) + h
+
+    def write_layout(self, fn):
+        tiles = []
+        for tile in self.tiles:
+            x, y = self.layout[tile]
+            tiles.append({
+                "col": tile[0],
+                "row": tile[1],
+                "basename": self.iindex["crs"][tile]["basename"],
+                "x": x,
+                "y": y,
+            })
+        pairs = []
+        for (a, b), used, residual in zip(self.pairs, self.used,
+                                          self.residuals):
+            dx, dy, response = self.measurements[(a, b)]
+            pairs.append({
+                "a": list(a),
+                "b": list(b),
+                "dx": float(dx),
+                "dy": float(dy),
+                "response": float(response),
+                "used": bool(used),
+                "residual": float(residual),
+            })
+        writej(
+            fn, {
+                "image": os.path.basename(self.output_filename),
+                "width": self.width,
+                "height": self.height,
+                "tile_width": self.tile_size[0],
+                "tile_height": self.tile_size[1],
+                "rotation_cw": self.rotation,
+                "tiles": tiles,
+                "pairs": pairs,
+            })
+
+    def load_tile(self, tile):
+        with Image.open(self.filename(tile)) as im:
+            if im.mode != self.mode:
+                im = im.convert(self.mode)
+            ret = np.asarray(im)
+        return ret.reshape(ret.shape[0], ret.shape[1], len(self.mode))
+
+    def blend_weights(self):
+        """
+        Weight ramps up from the tile edge across the overlap
+        so neighbors cross fade. The interior is flat
+        """
+        ret = []
+        for size, feather in zip(self.tile_size, self.feather):
+            i = np.arange(size, dtype=np.float32)
+            ret.append(
+                np.minimum(np.minimum(i + 0.5, size - i - 0.5) / feather, 1.0))
+        self.ramp_x, self.ramp_y = ret
+
+    def blend_chunk(self, y0, y1, x0, x1, tiles):
+        """
+        Return output rows [y0, y1) x columns [x0, x1) as uint8
+        tiles: [(x, y, image)] that may intersect
+        """
+        w, h = self.tile_size
+        samples = len(self.mode)
+        acc = np.zeros((y1 - y0, x1 - x0, samples), dtype=np.float32)
+        total = np.zeros((y1 - y0, x1 - x0, 1), dtype=np.float32)
+        for x, y, image in tiles:
+            ix0, ix1 = max(x0, x), min(x1, x + w)
+            iy0, iy1 = max(y0, y), min(y1, y + h)
+            if ix0 >= ix1 or iy0 >= iy1:
+                continue
+            weight = np.outer(self.ramp_y[iy0 - y:iy1 - y],
+                              self.ramp_x[ix0 - x:ix1 - x])[:, :, None]
+            dst = (slice(iy0 - y0, iy1 - y0), slice(ix0 - x0, ix1 - x0))
+            acc[dst] += weight * image[iy0 - y:iy1 - y, ix0 - x:ix1 - x]
+            total[dst] += weight
+        # Not covered by any tile => black
+        np.maximum(total, 1e-6, out=total)
+        acc /= total
+        acc += 0.5
+        return np.clip(acc, 0, 255).astype(np.uint8)
+
+    def iter_rows(self, executor):
+        """
+        Yield the blended output top to bottom a band of rows at a time
+        """
+        self.blend_weights()
+        w, h = self.tile_size
+        order = sorted(self.tiles, key=lambda tile: self.layout[tile][1])
+        # Columns blended per task
+        chunk = max(256, -(-self.width // self.threads))
+        loaded = {}
+        nexti = 0
+        try:
+            for y0 in range(0, self.height, self.band_rows):
+                y1 = min(self.height, y0 + self.band_rows)
+                # Decode tiles needed by the next band while this one blends
+                while nexti < len(order) and self.layout[
+                        order[nexti]][1] < y1 + self.band_rows:
+                    tile = order[nexti]
+                    loaded[tile] = executor.submit(self.load_tile, tile)
+                    nexti += 1
+                for tile in [
+                        tile for tile in loaded
+                        if self.layout[tile][1] + h <= y0
+                ]:
+                    del loaded[tile]
+                tiles = []
+                for tile, future in loaded.items():
+                    x, y = self.layout[tile]
+                    if y < y1:
+                        tiles.append((x, y, future.result()))
+
+                def blend(x0):
+                    return self.blend_chunk(y0, y1, x0,
+                                            min(self.width, x0 + chunk), tiles)
+
+                yield np.concatenate(list(
+                    executor.map(blend, range(0, self.width, chunk))),
+                                     axis=1)
+        finally:
+            for future in loaded.values():
+                future.cancel()
+
+    def write_image(self, executor):
+        self.output_filename, writer = new_band_writer(self.output_filename,
+                                                       self.width,
+                                                       self.height,
+                                                       self.mode,
+                                                       executor=executor,
+                                                       threads=self.threads)
+        writers = [writer]
+        if self.pyramid:
+            writers.append(
+                PyramidWriter(os.path.dirname(self.output_filename),
+                              self.width,
+                              self.height,
+                              mode=self.mode,
+                              name="stitch",
+                              executor=executor))
+        self.verbose and print('Writing %s (%uw x %uh)...' %
+                               (self.output_filename, self.width, self.height))
+        try:
+            for rows in self.iter_rows(executor):
+                for writer in writers:
+                    writer.write_rows(rows)
+            for writer in writers:
+                writer.close()
+        except BaseException:
+            for writer in writers:
+                writer.abort()
+            try:
+                os.remove(self.output_filename)
+            except OSError:
+                pass
+            raise
+
+    def run(self):
+        """
+        Return the filename written
+        """
+        self.load_priors()
+        self.find_pairs()
+        self.verbose and print("Stitch: %u tiles, %u pairs" %
+                               (len(self.tiles), len(self.regions)))
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            self.measure(executor)
+            self.solve()
+            self.write_image(executor)
+        self.write_layout(os.path.splitext(self.output_filename)[0] + ".json")
+        self.verbose and print('Done!')
+        return self.output_filename
+
+
+def local_stitch(*args, **kwargs):
+    return Stitcher(*args, **kwargs).run()
+
+
+def main():
+    import argparse
+    from uscope.scan_util import index_scan_images
+    from uscope.util import add_bool_arg
+
+    parser = argparse.ArgumentParser(
+        description="Stitch a scan locally (no upload)")
+    add_bool_arg(parser,
+                 "--pyramid",
+                 default=False,
+                 help="Also write a tile pyramid + viewer")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("dir_in")
+    parser.add_argument("output_filename", nargs="?", default=None)
+    args = parser.parse_args()
+
+    local_stitch(index_scan_images(args.dir_in),
+                 output_filename=args.output_filename,
+                 threads=args.threads,
+                 pyramid=args.pyramid)
+
+
+if __name__ == "__main__":
+    main()
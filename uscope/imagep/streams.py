@@ -1,12 +1,20 @@
 from uscope import cloud_stitch
-from uscope.scan_util import index_scan_images, bucket_group, reduce_iindex_filename, is_tif_scan
+from uscope.scan_util import index_scan_images, bucket_group, iindex_parse_fn, unkey_fn_prefix, iindex_is_tif, iindex_from_images
 from uscope import config
-from uscope.imagep.util import TaskBarrier, EtherealImageR, EtherealImageW, remove_intermediate_directories, find_qr_code_match
+from uscope.imagep.util import TaskBarrier, remove_intermediate_directories, find_qr_code_match
+from uscope.imagep.cache import ProcessingManifest, task_key
 from uscope.imagep.summary import write_html_viewer, write_snapshot_grid, write_quick_pano
+from uscope.imagep.pyramid import write_pyramid
+from uscope.imagep.stitch import local_stitch
+from uscope.scan_catalog import error_str
 from uscope.util import writej
-import glob
+from contextlib import contextmanager
 import shutil
+import sqlite3
 import os
+import heapq
+import queue
+import threading
 from PIL import Image
 """
 Support the following:
@@ -16,55 +24,148 @@ Support the following:
 """
 
 
-def get_image_suffix(dir_in):
-    if glob.glob(dir_in + "/*.tif"):
+def get_image_suffix(iindex):
+    if iindex_is_tif(iindex):
         return ".tif"
     else:
         return ".jpg"
 
 
 class ImageStream:
-    def __init__(self):
-        pass
-
-
-# FIXME: how to integrate this?
-# might require binding to a plugin and adding a queue
-class PlannerImageStream(ImageStream):
-    def __init__(self, pconfig, directory, planner_image_queue_plugin):
-        self.pconfig = pconfig
+    """
+    Source of images for StreamCSIP
+    Images may be emitted from any thread (ex: planner progress callback)
+    Events are buffered until a consumer calls listen()
+    Events:
+        ("image", filename)
+        ("done", ok): no more images. ok is False if the source was aborted
+    """
+    # CSImageProcessor priority class for tasks fed by this stream
+    priority = "bulk"
+
+    def __init__(self, directory):
+        self.lock = threading.Lock()
+        self.listener = None
+        self.backlog = []
+        self.finished = False
+        # Scan output directory the images are written to
         self.directory = directory
-        self.planner_image_queue_plugin = planner_image_queue_plugin
+        # operation: images per bucket
+        # Subclasses fill in the operations the scan uses
+        # Ex: {"stack": 3, "hdr": 2}
+        self.bucket_sizes = {}
 
     def working_dir(self):
         return self.directory
 
-    def new_images(self):
-        """
-        Return an iterable of EtherealImageR
-        """
-        fns = self.planner_image_queue_plugin.new_images()
-        return [EtherealImageR(fn=fn) for fn in fns]
-
-    def has_stack(self):
-        return "points-stacker" in self.pconfig
+    def has_stabilization(self):
+        return "stabilization" in self.bucket_sizes
 
     def has_hdr(self):
-        return "hdr" in self.pconfig["imager"]
+        return "hdr" in self.bucket_sizes
+
+    def has_stack(self):
+        return "stack" in self.bucket_sizes
 
     def bucket_size(self, operation):
         """
         Ex:
         images: c000_r002_z00.jpg, c000_r002_z01.jpg, c000_r002_z02.jpg
         operation: stack
-        Check the scan config to see if stacks have 3 elements
+        Return 3
         """
-        if operation == "stack":
-            return self.pconfig["points-stacker"]["number"]
-        elif operation == "hdr":
-            return len(self.pconfig["imager"]["hdr"]["properties_list"])
-        else:
-            assert 0, "FIXME"
+        if operation not in ("stack", "hdr", "stabilization"):
+            raise ValueError(f"Bad operation {operation}")
+        return self.bucket_sizes[operation]
+
+    def listen(self, listener):
+        """
+        Deliver all past and future events to listener(event)
+        """
+        with self.lock:
+            assert self.listener is None, "Stream already has a listener"
+            for event in self.backlog:
+                listener(event)
+            self.backlog = []
+            self.listener = listener
+
+    def emit(self, event):
+        with self.lock:
+            if self.listener:
+                self.listener(event)
+            else:
+                self.backlog.append(event)
+
+    def emit_image(self, fn):
+        assert not self.finished, "Image after stream finished"
+        self.emit(("image", fn))
+
+    def finish(self, ok=True):
+        """
+        Signal no more images are coming
+        Safe to call more than once, only the first call counts
+        """
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+        self.emit(("done", ok))
+
+    def done(self):
+        return self.finished
+
+
+class PlannerImageStream(ImageStream):
+    """
+    Stream images as the planner saves them
+
+    stream = PlannerImageStream(pconfig, out_dir)
+    planner.register_progress_callback(stream.planner_progress)
+    Call stream.finish(ok=False) if the planner doesn't complete
+    """
+    # Keep up with the capture ahead of any bulk processing
+    priority = "planner"
+
+    def __init__(self, pconfig, directory):
+        super().__init__(directory)
+        self.pconfig = pconfig
+        if "image-stabilization" in pconfig:
+            self.bucket_sizes["stabilization"] = int(
+                pconfig["image-stabilization"]["n"])
+        if "hdr" in pconfig["imager"]:
+            self.bucket_sizes["hdr"] = len(
+                pconfig["imager"]["hdr"]["properties_list"])
+        if "points-stacker" in pconfig:
+            self.bucket_sizes["stack"] = int(
+                pconfig["points-stacker"]["number"])
+
+    def planner_progress(self, state):
+        if state["type"] == "image":
+            fn = state.get("image_filename_rel")
+            if fn:
+                self.emit_image(fn)
+        # uscan.json has been written
+        elif state["type"] == "meta":
+            self.finish()
+
+
+class DirImageStream(ImageStream):
+    """
+    Replay the images of a completed scan
+    Lets DirCSIP use the StreamCSIP dependency scheduling
+    """
+    def __init__(self, directory, iindex=None):
+        super().__init__(directory)
+        if iindex is None:
+            iindex = index_scan_images(directory)
+        self.iindex = iindex
+        for operation, key in (("stabilization", "stabilization"),
+                               ("hdr", "hdrs"), ("stack", "stacks")):
+            if iindex[key]:
+                self.bucket_sizes[operation] = iindex[key]
+        for fn in iindex["images"].keys():
+            self.emit_image(os.path.join(iindex["dir"], fn))
+        self.finish()
 
 
 """
@@ -86,6 +187,13 @@ class IPPConfigJ:
     def cloud_stitch(self):
         return bool(self.j.get("cloud_stitch", True))
 
+    def local_stitch(self):
+        """
+        Stitch in process at the final image level (see stitch.py)
+        Independent of cloud_stitch: turn that off to keep the scan local
+        """
+        return bool(self.j.get("local_stitch", False))
+
     def write_html_viewer(self):
         """
         Write a simple .html file at the final image level
@@ -102,6 +210,13 @@ class IPPConfigJ:
         """
         return bool(self.j.get("write_snapshot_grid", False))
 
+    def snapshot_grid_scale(self):
+        """
+        Shrink snapshot grid tiles by this factor
+        Ex: 4 => 1/4 the width and height. Much faster on JPEG scans
+        """
+        return float(self.j.get("snapshot_grid_scale", 1))
+
     def write_quick_pano(self):
         """
         Write a simple combined image file at the final image level
@@ -110,6 +225,54 @@ class IPPConfigJ:
         # This takes up disk space => off by default
         return bool(self.j.get("write_quick_pano", False))
 
+    def quick_pano_scale(self):
+        """
+        Shrink the quick pano by this factor
+        Ex: 8 => preview of a large scan in seconds
+        """
+        return float(self.j.get("quick_pano_scale", 1))
+
+    def write_pyramid(self):
+        """
+        Write a multi resolution tile pyramid + viewer at the final image level
+        Opens large scans instantly, even from the local disk
+        """
+        # Roughly another copy of the scan on disk => off by default
+        return bool(self.j.get("write_pyramid", False))
+
+    def hdr_plugin(self):
+        """
+        Override the microscope HDR plugin (ex: hdr-mertens)
+        """
+        return self.j.get("hdr_plugin", None)
+
+    def stack_plugin(self):
+        """
+        Override the microscope stack plugin (ex: stack-native)
+        """
+        return self.j.get("stack_plugin", None)
+
+    def fuse_corrections(self):
+        """
+        Run back to back 1 to 1 corrections (ex: vm1v1 => sharp => ff1)
+        as a single in memory pass per tile instead of one directory each
+        """
+        return bool(self.j.get("fuse_corrections", False))
+
+    def dag_schedule(self):
+        """
+        Start each tile's next stage as soon as its inputs are ready
+        instead of waiting for every tile to finish the current stage
+        """
+        return bool(self.j.get("dag_schedule", True))
+
+    def write_trace(self):
+        """
+        Write per task timing as processing_trace.json next to processing.json
+        Open with chrome://tracing or ui.perfetto.dev
+        """
+        return bool(self.j.get("write_trace", False))
+
     def keep_intermediates(self):
         # https://github.com/Labsmore/pyuscope/issues/410
         # Keep GUI default but more conservative here
@@ -129,7 +292,9 @@ class DirCSIP:
                  ewf=None,
                  configj={},
                  microscope=None,
-                 verbose=True):
+                 verbose=True,
+                 job=None,
+                 catalog=None):
         self.csip = csip
         self.microscope = microscope
         self.log = csip.log
@@ -143,6 +308,128 @@ class DirCSIP:
         self.best_effort = best_effort
         self.ipp_config = IPPConfigJ(configj)
         self.verbose = verbose
+        # Tracks what lazy mode can safely skip
+        self.manifest = ProcessingManifest(directory, log=self.log)
+        # Task timing saved to processing.json
+        self.trace_session = None
+        # CSIPJob all tasks are queued under
+        # None => one is created for the duration of run()
+        self.job = job
+        self.own_job = False
+        # ScanCatalog to record progress in. None => don't
+        self.catalog = catalog
+        # dir_out: [(basename, parsed)] of stages the DAG pass finished
+        self.stream_outputs = {}
+
+    def catalog_call(self, method, *args, **kwargs):
+        """
+        Best effort: a broken catalog shouldn't fail processing
+        """
+        if self.catalog is None:
+            return
+        try:
+            getattr(self.catalog, method)(self.directory, *args, **kwargs)
+        except sqlite3.Error as e:
+            self.log(f"WARNING: scan catalog {method}: {e}")
+
+    @contextmanager
+    def catalog_stage(self, dir_out):
+        """
+        Record timing of the block as the stage writing dir_out
+        """
+        stage = os.path.relpath(dir_out, self.directory)
+        self.catalog_call("stage_begin", stage)
+        try:
+            yield
+        except BaseException as e:
+            self.catalog_call("stage_end", stage, error=error_str(e))
+            raise
+        self.catalog_call("stage_end", stage)
+
+    def job_begin(self):
+        if self.job is None:
+            name = os.path.basename(os.path.abspath(self.directory))
+            self.job = self.csip.job_begin(name=name)
+            self.own_job = True
+
+    def job_end(self):
+        if self.own_job:
+            self.csip.job_end(self.job)
+            self.job = None
+            self.own_job = False
+
+    def trace_begin(self):
+        """
+        Start collecting task timing
+        StreamCSIP may have already started it before run()
+        """
+        self.job_begin()
+        if self.trace_session is None:
+            self.trace_session = self.csip.tracer.begin(job=self.job.id)
+
+    def trace_end(self):
+        """
+        Return the finished session or None if not started
+        """
+        session = self.trace_session
+        if session is not None:
+            self.csip.tracer.end(session)
+            self.trace_session = None
+        return session
+
+    def queue_task(self,
+                   task_name,
+                   fns_in,
+                   fn_out,
+                   n_to_1,
+                   lazy=True,
+                   options={},
+                   callback=None,
+                   tb=None,
+                   priority="bulk"):
+        """
+        Queue a task unless the manifest says fn_out is still up to date
+        Return the CSIPFuture if queued, None if skipped
+        """
+        key = task_key(task_name, fns_in, options=options)
+        if lazy and self.manifest.valid(fn_out, key):
+            self.verbose and self.log(f"lazy: skip {fn_out}")
+            return None
+        self.manifest.invalidate(fn_out)
+
+        def done(ip_params, result, info):
+            if result == "ok":
+                self.manifest.record(fn_out, key)
+            if callback:
+                callback(ip_params, result, info)
+
+        if n_to_1:
+            return self.csip.queue_n_to_1_plugin(task_name=task_name,
+                                                 fns_in=fns_in,
+                                                 fn_out=fn_out,
+                                                 options=options,
+                                                 callback=done,
+                                                 tb=tb,
+                                                 priority=priority,
+                                                 job=self.job)
+        else:
+            assert len(fns_in) == 1
+            return self.csip.queue_1_to_1_plugin(plugin=task_name,
+                                                 fn_in=fns_in[0],
+                                                 fn_out=fn_out,
+                                                 options=options,
+                                                 callback=done,
+                                                 tb=tb,
+                                                 priority=priority,
+                                                 job=self.job)
+
+    def stage_outputs(self, dir_out, produced):
+        """
+        Return the index of what a stage wrote (or lazily kept)
+        so that the next stage doesn't have to rescan dir_out
+        produced: [(basename, parsed)] of outputs that are on disk
+        """
+        return iindex_from_images(dir_out, dict(produced))
 
     def run_n_to_1(self,
                    task_name,
@@ -150,93 +437,193 @@ class DirCSIP:
                    iindex_in,
                    dir_out,
                    lazy=True):
-        if not os.path.exists(dir_out):
-            os.mkdir(dir_out)
-        image_suffix = get_image_suffix(iindex_in["dir"])
-        buckets = bucket_group(iindex_in, bucket_name)
-
-        tb = TaskBarrier()
-        # Must be in exposure order?
-        for fn_prefix, hdrs in sorted(buckets.items()):
-            fns = [
-                os.path.join(iindex_in["dir"], fn)
-                for _i, fn in sorted(hdrs.items())
-            ]
-            fn_out = os.path.join(dir_out, fn_prefix + image_suffix)
-            if lazy and os.path.exists(fn_out):
-                self.log(f"lazy: skip {fn_out}")
-            else:
-                self.log("%s %s" % (fn_prefix, fn_out))
-                self.log("  %s" % (hdrs.items(), ))
-                self.log("Queing task")
-                self.csip.queue_n_to_1_plugin(task_name=task_name,
-                                              fns_in=fns,
-                                              fn_out=fn_out,
-                                              tb=tb)
-        tb.wait()
-
-    # FIXME: unify this + run_1_to_1
+        """
+        Return the output index
+        """
+        with self.catalog_stage(dir_out):
+            produced = self.stream_outputs.get(os.path.realpath(dir_out))
+            if produced is not None:
+                self.verbose and self.log(f"{task_name}: done by DAG pass")
+                return self.stage_outputs(dir_out, produced)
+            if not os.path.exists(dir_out):
+                os.mkdir(dir_out)
+            image_suffix = get_image_suffix(iindex_in)
+            buckets = bucket_group(iindex_in, bucket_name)
+            produced = []
+
+            tb = TaskBarrier()
+            # Must be in exposure order?
+            for fn_prefix, hdrs in sorted(buckets.items()):
+                fns = [
+                    os.path.join(iindex_in["dir"], fn)
+                    for _i, fn in sorted(hdrs.items())
+                ]
+                basename = fn_prefix + image_suffix
+                fn_out = os.path.join(dir_out, basename)
+                output = (basename, iindex_parse_fn(basename))
+
+                def callback(_ip_params, result, _info, output=output):
+                    if result == "ok":
+                        produced.append(output)
+
+                if self.queue_task(task_name,
+                                   fns,
+                                   fn_out,
+                                   n_to_1=True,
+                                   lazy=lazy,
+                                   callback=callback,
+                                   tb=tb):
+                    self.log("%s %s" % (fn_prefix, fn_out))
+                    self.log("  %s" % (hdrs.items(), ))
+                else:
+                    produced.append(output)
+            tb.wait()
+            self.manifest.save()
+            self.job.raise_if_cancelled()
+            return self.stage_outputs(dir_out, produced)
+
     def correct_plugin_run(self, plugin_config, iindex_in, dir_out, lazy=True):
         # TODO: some options as well?
-        plugin = plugin_config["plugin"]
-        if not os.path.exists(dir_out):
-            os.mkdir(dir_out)
-        tb = TaskBarrier()
-        for fn_in in iindex_in["images"].keys():
-            fn_out = os.path.join(dir_out, os.path.basename(fn_in))
-            if lazy and os.path.exists(fn_out):
-                self.log(f"lazy: skip {fn_out}")
-            else:
-                self.csip.queue_1_to_1_plugin(plugin=plugin,
-                                              fn_in=os.path.join(
-                                                  iindex_in["dir"], fn_in),
-                                              fn_out=fn_out,
-                                              tb=tb)
-        # print("TB: wait w/ alloc %s vs completed %s" % (tb.ntasks_allocated, tb.ntasks_completed))
-        tb.wait()
-
-    def run_1_to_1(self, task_name, iindex_in, dir_out, lazy=True):
-        if not os.path.exists(dir_out):
-            os.mkdir(dir_out)
-        tb = TaskBarrier()
-        for fn_in in iindex_in["images"].keys():
-            fn_out = os.path.join(dir_out, os.path.basename(fn_in))
-            if lazy and os.path.exists(fn_out):
-                self.log(f"lazy: skip {fn_out}")
-            else:
-                self.csip.queue_1_to_1_plugin(plugin=task_name,
-                                              fn_in=os.path.join(
-                                                  iindex_in["dir"], fn_in),
-                                              fn_out=fn_out,
-                                              tb=tb)
-        # print("TB: wait w/ alloc %s vs completed %s" % (tb.ntasks_allocated, tb.ntasks_completed))
-        tb.wait()
+        return self.run_1_to_1(task_name=plugin_config["plugin"],
+                               iindex_in=iindex_in,
+                               dir_out=dir_out,
+                               lazy=lazy)
+
+    def run_1_to_1(self, task_name, iindex_in, dir_out, lazy=True, options={}):
+        """
+        Return the output index
+        """
+        with self.catalog_stage(dir_out):
+            produced = self.stream_outputs.get(os.path.realpath(dir_out))
+            if produced is not None:
+                self.verbose and self.log(f"{task_name}: done by DAG pass")
+                return self.stage_outputs(dir_out, produced)
+            if not os.path.exists(dir_out):
+                os.mkdir(dir_out)
+            produced = []
+            tb = TaskBarrier()
+            for fn_in, v in iindex_in["images"].items():
+                # Same name => same parsed entry
+                output = (fn_in, v)
+
+                def callback(_ip_params, result, _info, output=output):
+                    if result == "ok":
+                        produced.append(output)
+
+                fn_out = os.path.join(dir_out, os.path.basename(fn_in))
+                if not self.queue_task(task_name,
+                                       [os.path.join(iindex_in["dir"], fn_in)],
+                                       fn_out,
+                                       n_to_1=False,
+                                       lazy=lazy,
+                                       options=options,
+                                       callback=callback,
+                                       tb=tb):
+                    produced.append(output)
+            tb.wait()
+            self.manifest.save()
+            self.job.raise_if_cancelled()
+            return self.stage_outputs(dir_out, produced)
+
+    def hdr_plugin(self):
+        return self.ipp_config.hdr_plugin() or config.get_usc().ipp.hdr_plugin(
+        )
+
+    def stack_plugin(self):
+        return self.ipp_config.stack_plugin() or config.get_usc(
+        ).ipp.stack_plugin()
 
     def hdr_run(self, **kwargs):
-        self.run_n_to_1(task_name="hdr-enfuse", bucket_name="hdr", **kwargs)
+        return self.run_n_to_1(task_name=self.hdr_plugin(),
+                               bucket_name="hdr",
+                               **kwargs)
 
     def stack_run(self, **kwargs):
-        self.run_n_to_1(task_name="stack-enfuse",
-                        bucket_name="stack",
-                        **kwargs)
+        return self.run_n_to_1(task_name=self.stack_plugin(),
+                               bucket_name="stack",
+                               **kwargs)
 
     def stabilization_run(self, **kwargs):
-        self.run_n_to_1(task_name="stabilization",
-                        bucket_name="stabilization",
-                        **kwargs)
+        return self.run_n_to_1(task_name="stabilization",
+                               bucket_name="stabilization",
+                               **kwargs)
 
     def correct_sharp1_run(self, **kwargs):
-        self.run_1_to_1(task_name="correct-sharp1", **kwargs)
+        return self.run_1_to_1(task_name="correct-sharp1", **kwargs)
 
     def correct_ff1_run(self, **kwargs):
-        self.run_1_to_1(task_name="correct-ff1", **kwargs)
+        return self.run_1_to_1(task_name="correct-ff1", **kwargs)
 
-    def run(self):
+    def correct_chain_run(self, pipelines, iindex_in):
+        """
+        Fused corrections: decode each tile once, run all plugins in memory,
+        encode once
+        Return the new iindex
+        """
+        plugins = [pipeline_this["plugin"] for pipeline_this in pipelines]
+        this_dir = self.correct_chain_dir(pipelines)
+        self.log("Fused corrections: %s" % (" => ".join(plugins), ))
+        next_dir = os.path.join(iindex_in["dir"], this_dir)
+        return self.run_1_to_1(task_name="correct-chain",
+                               iindex_in=iindex_in,
+                               dir_out=next_dir,
+                               options={"plugins": plugins})
+
+    def correct_chain_dir(self, pipelines):
+        return "_".join(pipeline_this["dir"] for pipeline_this in pipelines)
+
+    def want_correct_chain(self, pipelines):
+        return self.ipp_config.fuse_corrections() and len(pipelines) > 1
+
+    def pre_corrections(self):
+        """
+        1 to 1 corrections applied to raw captures
+        """
+        return config.get_usc().ipp.pipeline_first()
+
+    def post_corrections(self):
+        """
+        1 to 1 corrections applied after stabilization / HDR / stacking
+        """
+        ret = []
+        if self.ipp_config.snapshot_correction():
+            ret += config.get_usc().ipp.snapshot_correction()
+        if config.get_usc().imager.has_ff_cal():
+            ret.append({"plugin": "correct-ff1", "dir": "ff1"})
+        return ret
+
+    def run(self, dag=None):
         """
         Process a completed scan into processed images
         Spins off processing to workers where possible
+
+        dag: schedule per tile through StreamCSIP first
+        The stage by stage pass below then only has leftovers to do
+        (ex: partial buckets) in addition to the summaries / upload
+        """
+        self.trace_begin()
+        self.catalog_call("processing_begin")
+        try:
+            self._run(dag=dag)
+        except BaseException as e:
+            self.catalog_call("processing_end", error=error_str(e))
+            raise
+        else:
+            self.catalog_call("processing_end")
+        finally:
+            self.trace_end()
+            self.job_end()
+
+    def log_summary_image(self, what, fn):
+        """
+        Too big for JPEG => written as .tif instead of the usual .jpg
         """
+        if fn.lower().endswith((".tif", ".tiff")):
+            self.log(f"{what}: too big for JPEG, wrote {fn}")
+        else:
+            self.verbose and self.log(f"{what}: wrote {fn}")
 
+    def _run(self, dag=None):
         self.log("Reading metadata...")
         working_iindex = index_scan_images(self.directory)
         dst_basename = os.path.basename(os.path.abspath(self.directory))
@@ -247,37 +634,52 @@ class DirCSIP:
 
         self.log("")
 
-        ipp = config.get_usc().ipp.pipeline_first()
+        if dag is None:
+            dag = self.ipp_config.dag_schedule()
+        lazy = self.lazy
+        if dag:
+            stream = StreamCSIP(self.csip,
+                                DirImageStream(self.directory,
+                                               iindex=working_iindex),
+                                dir_csip=self,
+                                finish=False,
+                                microscope=self.microscope,
+                                verbose=self.verbose)
+            stream.run()
+            # Fully processed stages are taken as is below
+            # The rest only need their leftovers (ex: partial buckets)
+            self.stream_outputs = stream.completed_stages()
+            lazy = True
+
+        ipp = self.pre_corrections()
         if len(ipp) == 0:
             self.log("Pre corrections: skip")
+        elif self.want_correct_chain(ipp):
+            working_iindex = self.correct_chain_run(ipp, working_iindex)
         else:
             for pipeline_this in ipp:
                 plugin = pipeline_this["plugin"]
                 this_dir = pipeline_this["dir"]
                 self.log(f"{plugin}: start")
                 next_dir = os.path.join(working_iindex["dir"], this_dir)
-                self.correct_plugin_run(pipeline_this,
-                                        iindex_in=working_iindex,
-                                        dir_out=next_dir)
-                working_iindex = index_scan_images(next_dir)
+                working_iindex = self.correct_plugin_run(
+                    pipeline_this, iindex_in=working_iindex, dir_out=next_dir)
 
         if working_iindex["stabilization"]:
             self.log("Stabilization: yes. Processing")
             # dir name needs to be reasonable for CloudStitch to name it well
             next_dir = os.path.join(working_iindex["dir"], "stabilization")
-            self.stabilization_run(iindex_in=working_iindex,
-                                   dir_out=next_dir,
-                                   lazy=self.lazy)
-            working_iindex = index_scan_images(next_dir)
+            working_iindex = self.stabilization_run(iindex_in=working_iindex,
+                                                    dir_out=next_dir,
+                                                    lazy=lazy)
 
         if working_iindex["hdrs"]:
             self.log("HDR: yes. Processing")
             # dir name needs to be reasonable for CloudStitch to name it well
             next_dir = os.path.join(working_iindex["dir"], "hdr")
-            self.hdr_run(iindex_in=working_iindex,
-                         dir_out=next_dir,
-                         lazy=self.lazy)
-            working_iindex = index_scan_images(next_dir)
+            working_iindex = self.hdr_run(iindex_in=working_iindex,
+                                          dir_out=next_dir,
+                                          lazy=lazy)
 
         self.log("")
 
@@ -286,15 +688,17 @@ class DirCSIP:
             # dir name needs to be reasonable for CloudStitch to name it well
             next_dir = os.path.join(working_iindex["dir"], "stack")
             # maybe? helps some use cases
-            self.stack_run(iindex_in=working_iindex,
-                           dir_out=next_dir,
-                           lazy=self.lazy)
-            working_iindex = index_scan_images(next_dir)
+            working_iindex = self.stack_run(iindex_in=working_iindex,
+                                            dir_out=next_dir,
+                                            lazy=lazy)
         """
         Now apply custom correction plugins
         TODO: let the user actually determine order for these...ff1 before stack, etc
         """
-        if self.ipp_config.snapshot_correction():
+        post_ipp = self.post_corrections()
+        if self.want_correct_chain(post_ipp):
+            working_iindex = self.correct_chain_run(post_ipp, working_iindex)
+        elif self.ipp_config.snapshot_correction():
             ipp = config.get_usc().ipp.snapshot_correction()
             if len(ipp) == 0:
                 self.verbose and self.log("Post corrections: skip")
@@ -304,18 +708,20 @@ class DirCSIP:
                     this_dir = pipeline_this["dir"]
                     self.verbose and self.log(f"{plugin}: start")
                     next_dir = os.path.join(working_iindex["dir"], this_dir)
-                    self.correct_plugin_run(pipeline_this,
-                                            iindex_in=working_iindex,
-                                            dir_out=next_dir)
-                    working_iindex = index_scan_images(next_dir)
-
-        if not config.get_usc().imager.has_ff_cal():
+                    working_iindex = self.correct_plugin_run(
+                        pipeline_this,
+                        iindex_in=working_iindex,
+                        dir_out=next_dir)
+
+        if self.want_correct_chain(post_ipp):
+            pass
+        elif not config.get_usc().imager.has_ff_cal():
             self.verbose and self.log("FF correction: skip")
         else:
             self.verbose and self.log("FF correction: start")
             next_dir = os.path.join(working_iindex["dir"], "ff1")
-            self.correct_ff1_run(iindex_in=working_iindex, dir_out=next_dir)
-            working_iindex = index_scan_images(next_dir)
+            working_iindex = self.correct_ff1_run(iindex_in=working_iindex,
+                                                  dir_out=next_dir)
 
         self.verbose and self.log("")
         healthy = self.csip.inspect_final_dir(working_iindex)
@@ -345,6 +751,7 @@ class DirCSIP:
                     next_dir = working_iindex["dir"] + "_" + qr_match
                     os.rename(working_iindex["dir"], next_dir)
                     working_iindex = index_scan_images(next_dir)
+                    self.catalog_call("rename", next_dir)
                     self.directory = next_dir
                     # self.log("QR match found, renaming dir")
                     break
@@ -354,7 +761,7 @@ class DirCSIP:
         if healthy:
             if self.ipp_config.write_html_viewer():
                 self.verbose and self.log("Writing HTML viewer")
-                if is_tif_scan(working_iindex["dir"]):
+                if iindex_is_tif(working_iindex):
                     # Only Safari supports .tif
                     self.log(
                         "WARNING: HTML viewer only works reliably with jpg")
@@ -362,20 +769,44 @@ class DirCSIP:
 
             if self.ipp_config.write_snapshot_grid():
                 self.verbose and self.log("Writing tile image")
-                write_snapshot_grid(working_iindex)
+                fn = write_snapshot_grid(
+                    working_iindex,
+                    scale=self.ipp_config.snapshot_grid_scale(),
+                    verbose=self.verbose)
+                self.log_summary_image("Tile image", fn)
 
             if self.ipp_config.write_quick_pano():
                 self.verbose and self.log("Writing quick pano")
-                write_quick_pano(working_iindex)
+                fn = write_quick_pano(working_iindex,
+                                      scale=self.ipp_config.quick_pano_scale())
+                self.log_summary_image("Quick pano", fn)
+
+            if self.ipp_config.write_pyramid():
+                self.verbose and self.log("Writing tile pyramid")
+                write_pyramid(working_iindex, verbose=self.verbose)
+
+            if self.ipp_config.local_stitch() and len(
+                    working_iindex["images"]) > 1:
+                self.verbose and self.log("Stitching locally")
+                with self.catalog_stage(os.path.join(self.directory,
+                                                     "stitch")):
+                    local_stitch(working_iindex,
+                                 pyramid=self.ipp_config.write_pyramid(),
+                                 verbose=self.verbose)
         else:
             self.log(
                 "WARNING: skipping generating summary output on incomplete processed scan"
             )
 
+        session = self.trace_end()
         outj = {
             "type": "processing",
+            "metrics": session.summary(),
         }
         writej(os.path.join(self.directory, "processing.json"), outj)
+        if self.ipp_config.write_trace():
+            writej(os.path.join(self.directory, "processing_trace.json"),
+                   session.chrome_trace())
 
         if not self.ipp_config.keep_intermediates():
             remove_intermediate_directories(self.directory,
@@ -399,7 +830,7 @@ class DirCSIP:
             main_dir = working_iindex["dir"]
 
             # CloudStitch currently only supports .jpg
-            if is_tif_scan(working_iindex["dir"]):
+            if iindex_is_tif(working_iindex):
                 self.log("")
                 self.log("Converting to jpg")
                 next_dir = os.path.join(working_iindex["dir"], "jpg_tmp")
@@ -412,10 +843,13 @@ class DirCSIP:
 
             try:
                 self.log("Ready to stitch " + working_iindex["dir"])
-                cloud_stitch.upload_dir(working_iindex["dir"],
-                                        cs_info=self.cs_info,
-                                        dst_basename=dst_basename,
-                                        verbose=self.verbose)
+                with self.catalog_stage(os.path.join(self.directory,
+                                                     "upload")):
+                    cloud_stitch.upload_dir(working_iindex["dir"],
+                                            cs_info=self.cs_info,
+                                            dst_basename=dst_basename,
+                                            verbose=self.verbose)
+                self.catalog_call("mark_uploaded")
                 # Pop the log file up to main dir before deleting tmp dir
                 if delete_jpg_dir:
                     shutil.move(
@@ -433,10 +867,15 @@ class SnapshotCSIP:
                  images,
                  best_effort=True,
                  microscope=None,
-                 verbose=False):
+                 verbose=False,
+                 priority="interactive",
+                 job=None):
         self.csip = csip
         self.log = csip.log
         self.images = images
+        # Someone is usually waiting on the result
+        self.priority = priority
+        self.job = job
         self.best_effort = best_effort
         self.verbose = verbose
         self.microscope = microscope
@@ -458,19 +897,13 @@ class SnapshotCSIP:
             # or something like that
             assert 0, "FIXME: hdr, stack, or ...?"
 
-            tb = TaskBarrier()
-            data_out = self.csip.queue_hdr_enfuse(im_in=current_images,
-                                                  want_im_out=True,
-                                                  tb=tb)
-            tb.wait()
-            current_images = data_out["image"].get_im()
+            future = self.csip.queue_hdr_enfuse(im_in=current_images,
+                                                want_im_out=True)
+            current_images = future.result()["image"].get_im()
 
-            tb = TaskBarrier()
-            data_out = self.csip.queue_hdr_stack(im_in=current_images,
-                                                 want_im_out=True,
-                                                 tb=tb)
-            tb.wait()
-            current_images = data_out["image"].get_im()
+            future = self.csip.queue_hdr_stack(im_in=current_images,
+                                               want_im_out=True)
+            current_images = future.result()["image"].get_im()
 
         assert len(current_images) == 1
         current_image = current_images[0]
@@ -486,183 +919,320 @@ class SnapshotCSIP:
             for pipeline_this in ipp:
                 plugin = pipeline_this["plugin"]
                 self.verbose and self.log(f"{plugin}: start")
-                tb = TaskBarrier()
-                data_out = self.csip.queue_1_to_1_plugin(plugin=plugin,
-                                                         im_in=current_image,
-                                                         want_im_out=True,
-                                                         tb=tb,
-                                                         options=options)
-                tb.wait()
-                current_image = data_out["image"].get_im()
+                future = self.csip.queue_1_to_1_plugin(plugin=plugin,
+                                                       im_in=current_image,
+                                                       want_im_out=True,
+                                                       options=options,
+                                                       priority=self.priority,
+                                                       job=self.job)
+                current_image = future.result()["image"].get_im()
 
         if not config.get_usc().imager.has_ff_cal():
             self.verbose and self.log("FF correction: skip")
         else:
             self.verbose and self.log("FF correction: start")
-            tb = TaskBarrier()
-            data_out = self.csip.queue_correct_ff1(im_in=current_image,
-                                                   want_im_out=True,
-                                                   tb=tb)
-            tb.wait()
-            current_image = data_out["image"].get_im()
+            future = self.csip.queue_correct_ff1(im_in=current_image,
+                                                 want_im_out=True,
+                                                 priority=self.priority,
+                                                 job=self.job)
+            current_image = future.result()["image"].get_im()
 
         return current_image
 
 
 """
-WIP, not tested / used currently
+Second generation image processing orchestrator
 See https://github.com/Labsmore/pyuscope/issues/190
 
-Second generation image processing orchestrator
-Constructs a pipeline based on expected input data
-Expects all images to be present
-If it fails you'll need to fall back to DirCSIP
+Processes a scan while it is still being captured
+Images are bucketed as they arrive and a bucket is sent to the workers
+as soon as it is full (ex: all HDR exposures of a stack slice)
+Outputs feed the next stage the same way
+When the last image lands only the last few buckets remain
+
+Output layout is identical to DirCSIP
+Once the stream is done a lazy DirCSIP pass picks up anything left over
+(ex: partial buckets from an aborted scan) and writes summaries / uploads
 """
 
 
 class StreamCSIP:
-    def __init__(self, csip, image_stream, microscope=None, upload=False):
-        assert 0, "WIP"
+    def __init__(self,
+                 csip,
+                 image_stream,
+                 cs_info=None,
+                 upload=False,
+                 fix=False,
+                 best_effort=True,
+                 configj={},
+                 finish=True,
+                 dir_csip=None,
+                 window=None,
+                 microscope=None,
+                 verbose=True):
         self.csip = csip
+        self.log = csip.log
         self.image_stream = image_stream
         self.microscope = microscope
-
-        # TODO: auto figure this out
-        # Might also want to move these to be objects
-        self.pipeline = []
+        self.verbose = verbose
+        self.finish = finish
+        # Same policy / layout as a completed scan
+        # Created here => job / trace end with the stream
+        self.own_dir_csip = dir_csip is None
+        if dir_csip is None:
+            dir_csip = DirCSIP(csip,
+                               image_stream.working_dir(),
+                               cs_info=cs_info,
+                               upload=upload,
+                               lazy=True,
+                               fix=fix,
+                               best_effort=best_effort,
+                               configj=configj,
+                               microscope=microscope,
+                               verbose=verbose)
+        self.dir_csip = dir_csip
+        self.pipeline = self.make_pipeline()
+        # ("image", fn), ("done", ok), ("complete", (stagei, fn_out, ok))
+        self.events = queue.Queue()
+        # Full buckets waiting for a slot, deepest stage first
+        # (-statei, sequence, statei, bucketk)
+        self.ready = []
+        self.ready_seq = 0
+        # Max tasks handed to the workers at once
+        # Small enough that a finished tile's next stage doesn't queue
+        # behind the rest of the scan's current stage
+        if window is None:
+            window = 2 * len(self.csip.workers)
+        self.window = max(1, window)
+        self.pending = 0
+        # fn_out: CSIPFuture of tasks handed to the workers
+        self.futures = {}
+        self.errors = 0
+
+    def correction_stages(self, pipelines):
+        if len(pipelines) == 0:
+            return []
+        if self.dir_csip.want_correct_chain(pipelines):
+            return [{
+                "plugin": "correct-chain",
+                "dir": self.dir_csip.correct_chain_dir(pipelines),
+                "options": {
+                    "plugins":
+                    [pipeline_this["plugin"] for pipeline_this in pipelines]
+                },
+            }]
+        return [{
+            "plugin": pipeline_this["plugin"],
+            "dir": pipeline_this["dir"],
+        } for pipeline_this in pipelines]
+
+    def make_pipeline(self):
+        """
+        Same stages, in the same order, as DirCSIP.run()
+        bucket: index key merged by the stage (None => 1 to 1)
+        """
+        ret = self.correction_stages(self.dir_csip.pre_corrections())
+        if self.image_stream.has_stabilization():
+            ret.append({
+                "plugin": "stabilization",
+                "dir": "stabilization",
+                "bucket": "stabilization",
+            })
         if self.image_stream.has_hdr():
-            self.pipeline.append({"plugin": "hdr-enfuse"})
+            ret.append({
+                "plugin": self.dir_csip.hdr_plugin(),
+                "dir": "hdr",
+                "bucket": "hdr",
+            })
         if self.image_stream.has_stack():
-            self.pipeline.append({"plugin": "stack-enfuse"})
-        # Should this be before or after other steps?
-        # Currently expensive so put at the end
-        if config.get_usc().imager.has_ff_cal():
-            self.pipeline.append({"plugin": "correct-illumination"})
-
-        next_directory = self.image_stream.working_dir()
-        for pipe in self.pipeline:
-            """
-            keys are the next file basename w/o extension
-            ex: 
-            """
-            plugin = pipe["plugin"]
-
-            if plugin == "hdr-enfuse":
-                ptype = "hdr"
-            elif plugin == "stack-enfuse":
-                ptype = "stack"
-            elif plugin == "correct-illumination":
-                ptype = "correct"
+            ret.append({
+                "plugin": self.dir_csip.stack_plugin(),
+                "dir": "stack",
+                "bucket": "stack",
+            })
+        ret += self.correction_stages(self.dir_csip.post_corrections())
+        """
+        Nest directories like .../mz_mit20x/hdr/stack/
+        """
+        dir_in = os.path.realpath(self.image_stream.working_dir())
+        for pipe in ret:
+            pipe.setdefault("bucket", None)
+            pipe.setdefault("options", {})
+            if pipe["bucket"]:
+                pipe["bucket_size"] = self.image_stream.bucket_size(
+                    pipe["bucket"])
             else:
-                assert 0, plugin
-
+                pipe["bucket_size"] = 1
             pipe["buckets"] = {}
-            pipe["type"] = ptype
-            pipe["remove_key"] = ptype
-            pipe["dir_in"] = next_directory
-            """
-            Nest directories like .../mz_mit20x/hdr/stack/
-            """
-            next_directory = os.path.join(next_directory, ptype)
-            pipe["dir_out"] = next_directory
-
-        self.tb = TaskBarrier()
-
-    def bucket_images(self, pipe, images):
-        """
-        Place new images into given pipeline stage
-        Don't trigger any processing, even if it could be done now
-        """
-        for image in images:
-            # iindex_filename_key[image.get_filename]
-            fn = image.get_filename()
-            bucketk = reduce_iindex_filename(fn, remove_key=pipe["remove_key"])
-            pipe.buckets.setdefault(bucketk, set()).add(os.path.basename(fn))
-
-    def bucket_full(self, statei, bucketk):
-        plugin = self.pipeline[statei]
-        if plugin == "hdr-enfuse":
-            expected = self.image_stream.bucket_size("hdr")
-        elif plugin == "stack-enfuse":
-            expected = self.image_stream.bucket_size("stack")
-        elif plugin == "correct-illumination":
-            expected = 1
+            # (basename, parsed) of outputs on disk
+            pipe["produced"] = []
+            # Tasks that failed or were cancelled
+            pipe["incomplete"] = 0
+            pipe["dir_in"] = dir_in
+            pipe["dir_out"] = os.path.join(dir_in, pipe["dir"])
+            dir_in = pipe["dir_out"]
+        return ret
+
+    def completed_stages(self):
+        """
+        Return {dir_out: [(basename, parsed)]} of stages that processed
+        every image they were given, stopping at the first one that didn't
+        (downstream stages never saw the missing images)
+        """
+        ret = {}
+        for pipe in self.pipeline:
+            if pipe["buckets"] or pipe["incomplete"]:
+                break
+            ret[pipe["dir_out"]] = pipe["produced"]
+        return ret
+
+    def bucket_image(self, statei, fn):
+        """
+        Place an image into given pipeline stage
+        Return the bucket key if the bucket is now full
+        """
+        pipe = self.pipeline[statei]
+        basename = os.path.basename(fn)
+        if not pipe["bucket"]:
+            pipe["buckets"][basename] = {0: fn}
+            return basename
+        filev = iindex_parse_fn(basename)
+        if pipe["bucket"] not in filev:
+            raise ValueError(f"{basename}: missing {pipe['bucket']} index")
+        bucketk = unkey_fn_prefix(filev, pipe["bucket"])
+        bucket = pipe["buckets"].setdefault(bucketk, {})
+        bucket[filev[pipe["bucket"]]] = fn
+        if len(bucket) >= pipe["bucket_size"]:
+            return bucketk
+        return None
+
+    def process_bucket(self, statei, bucketk):
+        pipe = self.pipeline[statei]
+        fns_in = [
+            fn for _i, fn in sorted(pipe["buckets"].pop(bucketk).items())
+        ]
+        if pipe["bucket"]:
+            _prefix, suffix = os.path.splitext(fns_in[0])
+            fn_out = os.path.join(pipe["dir_out"], bucketk + suffix)
+        else:
+            fn_out = os.path.join(pipe["dir_out"], bucketk)
+
+        def callback(_ip_params, result, _info):
+            self.events.put(("complete", (statei, fn_out, result)))
+
+        self.pending += 1
+        future = self.dir_csip.queue_task(pipe["plugin"],
+                                          fns_in,
+                                          fn_out,
+                                          n_to_1=bool(pipe["bucket"]),
+                                          lazy=self.dir_csip.lazy,
+                                          options=pipe["options"],
+                                          callback=callback,
+                                          priority=self.image_stream.priority)
+        if future is None:
+            self.events.put(("complete", (statei, fn_out, "ok")))
         else:
-            assert 0, f"bad plugin {plugin}"
-        return len(self.state[statei][bucketk]) >= expected
+            self.futures[fn_out] = future
+
+    def abort(self):
+        """
+        Stream aborted: drop work that hasn't started
+        Tasks already on a worker run to completion
+        """
+        self.ready = []
+        for future in list(self.futures.values()):
+            future.cancel()
 
-    def process_bucket(self, pipe, bucketk):
-        if not self.bucket_full(pipe, bucketk):
+    def add_image(self, statei, fn):
+        """
+        Move an image into the given stage, processing if ready
+        Images past the last stage are final
+        """
+        if statei >= len(self.pipeline):
             return
-        plugin = pipe["plugin"]
-        if plugin == "hdr-enfuse":
-            fn_out = os.path.join(pipe["dir_out"], bucketk + ".tif")
-            self.csip.queue_hdr_enfuse(fns_in=pipe["buckets"][bucketk],
-                                       fn_out=fn_out)
-        elif plugin == "stack-enfuse":
-            fn_out = os.path.join(pipe["dir_out"], bucketk + ".tif")
-            self.csip.queue_stack_enfuse(fns_in=pipe["buckets"][bucketk],
-                                         fn_out=fn_out)
-        elif plugin == "correct-illumination":
-            fn_out = os.path.join(pipe["dir_out"], bucketk + ".tif")
-            fns_in = list(pipe["buckets"][bucketk])
-            assert len(fns_in) == 1
-            self.csip.queue_correct_illumination(fn_in=fns_in[0],
-                                                 fn_out=fn_out)
-        elif plugin == "save-jpg":
-            fns_in = list(pipe["buckets"][bucketk])
-            assert len(fns_in) == 1
-            fn_out = os.path.join(pipe["dir_out"], bucketk + ".jpg")
-            self.csip.queue_convert_jpg(fn_in=fns_in[0], fn_out=fn_out)
-        else:
-            assert 0, f"bad plugin {plugin}"
-        del self.pipe["buckets"][bucketk]
+        bucketk = self.bucket_image(statei, fn)
+        if bucketk is not None:
+            heapq.heappush(self.ready,
+                           (-statei, self.ready_seq, statei, bucketk))
+            self.ready_seq += 1
+
+    def dispatch(self):
+        """
+        Hand ready buckets to the workers, up to the window
+        Later stages go first so tiles finish in order they started
+        """
+        if self.dir_csip.job.cancelled():
+            self.abort()
+        while self.ready and self.pending < self.window:
+            _prio, _seq, statei, bucketk = heapq.heappop(self.ready)
+            self.process_bucket(statei, bucketk)
 
     def run(self):
         """
         Stream images (ie from an in progress capture)
-        Two steams of data:
-        -Raw images
-        -Completed intermediate steps
-        Could also just grab from a filesystem hmm
-        """
-        """
-        Keep track of images at each state of the pipeline
-        Key them based on file basenames / assume they are written to the filesystem
-        """
-        self.states = []
-        for _element in self.pipeline:
-            # Buckets
-            self.states.append({})
-
-        # Done when all images have been put into pipeline and all pipeline tasks are processed
-        while not self.image_stream.done() or not self.tb.idle():
-            # New images for the pipeline?
-            new_images = self.image_stream.new_images()
-            self.bucket_images(self.pipeline[0], new_images)
-
-            # In progress images
-            for statei, new_images in self.pop_completed_images():
-                # Move to next pipeline stage if not done
-                if statei != len(self.pipeline) - 1:
-                    self.bucket_images(self.pipeline[statei + 1], new_images)
-
-            # Since images move down the pipeline, any newly completed images will move to next state
-            # Since we check earlier pipeline stages first bias towards BFS
-            # Could reorder if wanted DFS
-            for statei, pipe in enumerate(self.pipeline):
-                for bucketk in list(pipe["state"].keys()):
-                    self.process_bucket(pipe, bucketk)
-        # Finish all remaining allocated tasks
-        self.tb.wait()
-
-        # Last step after all processed
-        if self.upload:
-            assert 0, "fixme"
-            """
-            self.log("Ready to stitch " + working_iindex["dir"])
-            cloud_stitch.upload_dir(working_iindex["dir"],
-                                    cs_info=cs_info,
-                                    dst_basename=dst_basename,
-                                    verbose=verbose)
-            """
+        Two sources of events:
+        -Raw images from the stream
+        -Completed tasks from the workers
+        """
+        self.log("Streaming pipeline: %s" %
+                 (" => ".join(pipe["plugin"] for pipe in self.pipeline), ))
+        for pipe in self.pipeline:
+            if not os.path.exists(pipe["dir_out"]):
+                os.mkdir(pipe["dir_out"])
+
+        self.dir_csip.trace_begin()
+        self.image_stream.listen(self.events.put)
+        stream_ok = None
+        # Done when stream is finished and all queued tasks are processed
+        while stream_ok is None or self.pending or self.ready:
+            self.dispatch()
+            kind, val = self.events.get()
+            if kind == "image":
+                self.add_image(0, val)
+            elif kind == "done":
+                stream_ok = val
+                if not stream_ok:
+                    self.abort()
+            elif kind == "complete":
+                self.pending -= 1
+                statei, fn_out, result = val
+                self.futures.pop(fn_out, None)
+                pipe = self.pipeline[statei]
+                if result == "ok":
+                    basename = os.path.basename(fn_out)
+                    pipe["produced"].append(
+                        (basename, iindex_parse_fn(basename)))
+                    # Aborted => don't start the next stage
+                    if stream_ok is not False:
+                        self.add_image(statei + 1, fn_out)
+                elif result == "cancelled":
+                    pipe["incomplete"] += 1
+                    self.verbose and self.log(f"cancelled: {fn_out}")
+                else:
+                    pipe["incomplete"] += 1
+                    self.errors += 1
+                    self.log(f"WARNING: failed to generate {fn_out}")
+            else:
+                assert 0, f"Unexpected event {kind}"
+
+        self.dir_csip.manifest.save()
+        for pipe in self.pipeline:
+            if pipe["buckets"]:
+                self.log("%s: %u incomplete buckets" %
+                         (pipe["plugin"], len(pipe["buckets"])))
+        job = self.dir_csip.job
+        if not stream_ok or job.cancelled():
+            self.log("Stream aborted: skipping final processing")
+            # Otherwise the caller's DirCSIP.run() cleans up
+            if self.finish or self.own_dir_csip:
+                self.dir_csip.trace_end()
+                self.dir_csip.job_end()
+            job.raise_if_cancelled()
+            return
+        if self.finish:
+            # Everything that streamed through is already in the manifest
+            self.dir_csip.run(dag=False)
+        elif self.own_dir_csip:
+            # Caller finishes the scan later (ex: Argus running cs_auto)
+            self.dir_csip.trace_end()
+            self.dir_csip.job_end()
@@ -1,9 +1,13 @@
 from uscope.util import add_bool_arg
-from uscope.scan_util import index_scan_images, is_tif_scan
+from uscope.scan_util import index_scan_images, iindex_is_tif
 import os
 from PIL import Image
-import struct
 from uscope.util import readj
+from uscope.imagep.band_writer import JPEGBandWriter, BigTIFFWriter
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import cv2
+import numpy as np
 import math
 
 # /usr/local/lib/python2.7/dist-packages/PIL/Image.py:2210: DecompressionBombWarning: Image size (941782785 pixels) exceeds limit of 89478485 pixels, could be decompression bomb DOS attack.
@@ -70,7 +74,7 @@ def write_html_viewer(iindex, output_filename=None):
 <body>
     <h2><center>Labsmore Grid Viewer</center></h2>
 """
-    if is_tif_scan(iindex["dir"]):
+    if iindex_is_tif(iindex):
         out += "WARNING: HTML viewer only works reliably with .jpg (have .tif)<br>\n"
     out += """
     <table>
@@ -100,60 +104,196 @@ def write_html_viewer(iindex, output_filename=None):
         f.write(out)
 
 
-def write_snapshot_grid(iindex, output_filename=None):
-    if output_filename is None:
-        d = os.path.join(iindex["dir"], "summary")
-        if not os.path.exists(d):
-            os.mkdir(d)
-        output_filename = os.path.join(iindex["dir"], "summary", "tiles.jpg")
+def too_big_for_jpeg(width, height):
+    return width >= 2**16 or height >= 2**16 or width * height >= 2**32
+
+
+def new_band_writer(fn, width, height, mode, executor=None, threads=1):
+    """
+    Return (filename, BandWriter) for a summary image
+    JPEG requested but too big => BigTIFF with the same base name
+    """
+    fn_lower = fn.lower()
+    if fn_lower.endswith((".jpg", ".jpeg")):
+        if not too_big_for_jpeg(width, height):
+            writer = JPEGBandWriter(fn,
+                                    width,
+                                    height,
+                                    mode=mode,
+                                    executor=executor,
+                                    max_inflight=2 * threads)
+            return fn, writer
+        fn = os.path.splitext(fn)[0] + ".tif"
+        print(f"{width}w x {height}h too big for JPEG, writing {fn}")
+    elif not fn_lower.endswith((".tif", ".tiff")):
+        raise ValueError(f"Unsupported summary image format {fn}")
+    return fn, BigTIFFWriter(fn, width, height, mode=mode, executor=executor)
+
+
+class SnapshotGrid:
+    """
+    Tiles side by side in capture order with a gutter between them
+    Written one row of tiles ("band") at a time:
+    -the tiles of a band are decoded in parallel, reduced by scale
+        JPEGs are downscaled by the decoder (DCT scaling) => much faster
+    -the next band is decoded while the current one is written
+    -bands are encoded in chunks (see band_writer.py) as they come in
+        so memory stays at about two bands regardless of grid size
+    JPEG maxes out at 65535 pixels per side
+    Bigger grids are written as a tiled BigTIFF instead
+    """
+    def __init__(self,
+                 iindex,
+                 output_filename=None,
+                 scale=1,
+                 threads=None,
+                 verbose=True):
+        assert iindex[
+            "flat"], "Single image only supported on final level image set"
+        if scale < 1:
+            raise ValueError(f"Invalid snapshot grid scale {scale}")
+        self.iindex = iindex
+        if output_filename is None:
+            d = os.path.join(iindex["dir"], "summary")
+            if not os.path.exists(d):
+                os.mkdir(d)
+            output_filename = os.path.join(d, "tiles.jpg")
+        self.output_filename = output_filename
+        self.scale = scale
+        self.threads = threads or os.cpu_count() or 1
+        self.verbose = verbose
 
-    assert iindex[
-        "flat"], "Single image only supported on final level image set"
-
-    print('Calculating dimensions...')
-
-    #with Image.open(fns_in[0]) as im0:
-    this0 = iindex["crs"][(0, 0)]
-    im0 = Image.open(os.path.join(iindex["dir"], this0["basename"]))
-    spacing = int(im0.height * 0.05)
-    w = im0.size[0] * iindex["cols"] + spacing * (iindex["cols"] - 1)
-    h = im0.size[1] * iindex["rows"] + spacing * (iindex["rows"] - 1)
-    dst = Image.new(im0.mode, (w, h))
-
-    if output_filename.find('.jpg') >= 0:
-        if w >= 2**16 or h >= 2**16:
-            raise HugeJPEG('Image exceeds maximum JPEG w/h')
-        # think this was tiff, not jpg...?
-        if w * h >= 2**32:
-            raise HugeJPEG('Image exceeds maximum JPEG size')
-
-    for this in iindex["images"].values():
-        x = im0.width * this["col"] + spacing * this["col"]
+    def calc_dimensions(self):
+        this0 = self.iindex["crs"][(0, 0)]
+        # Only reads the header
+        with Image.open(os.path.join(self.iindex["dir"],
+                                     this0["basename"])) as im0:
+            width, height = im0.size
+            self.mode = im0.mode if im0.mode in ("L", "RGB") else "RGB"
+        self.tile_w = max(1, int(round(width / self.scale)))
+        self.tile_h = max(1, int(round(height / self.scale)))
+        self.spacing = int(self.tile_h * 0.05)
+        cols = self.iindex["cols"]
+        rows = self.iindex["rows"]
+        self.width = self.tile_w * cols + self.spacing * (cols - 1)
+        self.height = self.tile_h * rows + self.spacing * (rows - 1)
+
+    def new_writer(self, executor):
+        self.output_filename, writer = new_band_writer(self.output_filename,
+                                                       self.width,
+                                                       self.height,
+                                                       self.mode,
+                                                       executor=executor,
+                                                       threads=self.threads)
+        return writer
+
+    def load_tile(self, fn):
+        """
+        Return the tile as an array at output size
+        """
+        size = (self.tile_w, self.tile_h)
+        with Image.open(fn) as im:
+            # JPEG: decode at the smallest DCT scale at least this big
+            im.draft(self.mode, size)
+            if im.mode != self.mode:
+                im = im.convert(self.mode)
+            if im.size != size:
+                im = im.resize(size, Image.BILINEAR)
+            return np.asarray(im)
+
+    def queue_band(self, executor, band):
+        """
+        Return {col: future} for an output band (top to bottom)
+        """
         # lower left vs uppper left coordinate systems
-        row0 = iindex["rows"] - this["row"] - 1
-        y = im0.height * row0 + spacing * row0
-        im = Image.open(os.path.join(iindex["dir"], this["basename"]))
-        dst.paste(im, (x, y))
-
-    print(('Saving %s...' % (output_filename, )))
-    try:
-        dst.save(output_filename, quality=95)
-    # File "/usr/lib/python2.7/dist-packages/PIL/TiffImagePlugin.py", line 550, in _pack
-    #   return struct.pack(self._endian + fmt, *values)
-    # struct.error: 'L' format requires 0 <= number <= 4294967295
-    except struct.error:
+        row = self.iindex["rows"] - band - 1
+        ret = {}
+        for col in range(self.iindex["cols"]):
+            this = self.iindex["crs"].get((col, row))
+            # Missing tiles are left black
+            if this is None:
+                continue
+            fn = os.path.join(self.iindex["dir"], this["basename"])
+            ret[col] = executor.submit(self.load_tile, fn)
+        return ret
+
+    def iter_rows(self, executor):
+        """
+        Yield the grid top to bottom as arrays of rows (bands and gutters)
+        calc_dimensions() must have been called
+        """
+        samples = len(self.mode)
+        gutter = np.zeros((self.spacing, self.width, samples), dtype=np.uint8)
+        rows = self.iindex["rows"]
+        pending = self.queue_band(executor, 0)
         try:
-            os.remove(output_filename)
-        except OSError:
-            pass
-        raise HugeTIF("Failed to save image of size %uw x %uh" % (w, h))
-    print('Done!')
+            for band in range(rows):
+                tiles = pending
+                # Decode ahead while this band is assembled / written
+                if band + 1 < rows:
+                    pending = self.queue_band(executor, band + 1)
+                out = np.zeros((self.tile_h, self.width, samples),
+                               dtype=np.uint8)
+                for col, future in tiles.items():
+                    x = (self.tile_w + self.spacing) * col
+                    tile = future.result()
+                    out[:, x:x + self.tile_w] = tile.reshape(
+                        self.tile_h, self.tile_w, samples)
+                yield out
+                if band + 1 < rows and self.spacing:
+                    yield gutter
+        finally:
+            for future in pending.values():
+                future.cancel()
+
+    def run(self):
+        """
+        Return the filename written
+        """
+        self.verbose and print('Calculating dimensions...')
+        self.calc_dimensions()
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            writer = self.new_writer(executor)
+            self.verbose and print(
+                'Writing %s (%uw x %uh)...' %
+                (self.output_filename, self.width, self.height))
+            try:
+                for rows in self.iter_rows(executor):
+                    writer.write_rows(rows)
+                writer.close()
+            except BaseException:
+                writer.abort()
+                try:
+                    os.remove(self.output_filename)
+                except OSError:
+                    pass
+                raise
+        self.verbose and print('Done!')
+        return self.output_filename
+
+
+def write_snapshot_grid(*args, **kwargs):
+    return SnapshotGrid(*args, **kwargs).run()
 
 
 class QuickPano:
-    def __init__(self, iindex, output_filename=None):
+    """
+    Tiles plastered together based on their stage positions
+    If the camera is rotated relative to the stage
+    tiles are rotated to match and their overlap is trimmed
+
+    Each tile gets one affine warp (rotate + scale + translate) straight into
+    its spot in the output. Tiles are decoded / warped in parallel
+    and composited in a fixed order so that the upper left is on top
+    scale: shrink the output by this factor (ex: 8 => quick preview)
+    """
+    def __init__(self, iindex, output_filename=None, scale=1, threads=None):
         self.iindex = iindex
         self.verbose = False
+        if scale < 1:
+            raise ValueError(f"Invalid quick pano scale {scale}")
+        self.scale = scale
+        self.threads = threads or os.cpu_count() or 1
 
         if output_filename is None:
             d = os.path.join(iindex["dir"], "summary")
@@ -196,11 +336,13 @@ class QuickPano:
     def new_dst(self):
         self.verbose and print('Calculating dimensions...')
 
-        #with Image.open(fns_in[0]) as im0:
         this0 = self.iindex["crs"][(0, 0)]
-        self.im0 = Image.open(
-            os.path.join(self.iindex["dir"], this0["basename"]))
-        im0 = self.im0
+        # Only reads the header
+        with Image.open(os.path.join(self.iindex["dir"],
+                                     this0["basename"])) as im0:
+            self.tile_size = im0.size
+            self.mode = im0.mode if im0.mode in ("L", "RGB") else "RGB"
+        tile_w, tile_h = self.tile_size
 
         # Calculate max width, height
         # Note: there are some coordinate flips here, but since relative doesn't matter
@@ -210,12 +352,12 @@ class QuickPano:
         self.y1 = float("-inf")
         self.pixel_per_mm = 1000 / (
             self.uscan["pconfig"]["app"]["objective"]["um_per_pixel"])
-        width_mm = im0.width / self.pixel_per_mm
-        self.height_mm = im0.height / self.pixel_per_mm
+        width_mm = tile_w / self.pixel_per_mm
+        self.height_mm = tile_h / self.pixel_per_mm
         for info in self.cr2info.values():
             self.verbose and print(info)
             self.x0 = min(info["position"]["x"], self.x0)
-            self.verbose and print('width', im0.width, im0.height)
+            self.verbose and print('width', tile_w, tile_h)
             self.x1 = max(info["position"]["x"] + width_mm, self.x1)
             self.y0 = min(info["position"]["y"], self.y0)
             self.y1 = max(info["position"]["y"] + self.height_mm, self.y1)
@@ -229,14 +371,13 @@ class QuickPano:
             f"Calculate image size: {global_width}w x {global_height}h")
         assert global_width > 0 and global_height > 0
 
-        if self.output_filename.find('.jpg') >= 0:
-            if global_width >= 2**16 or global_height >= 2**16:
-                raise HugeJPEG('Image exceeds maximum JPEG w/h')
-            # think this was tiff, not jpg...?
-            if global_width * global_height >= 2**32:
-                raise HugeJPEG('Image exceeds maximum JPEG size')
-
-        self.dst = Image.new(im0.mode, (global_width, global_height))
+        # Output pixels are 1 / scale of a capture pixel
+        self.width = max(1, int(math.ceil(global_width / self.scale)))
+        self.height = max(1, int(math.ceil(global_height / self.scale)))
+        shape = (self.height, self.width)
+        if self.mode != "L":
+            shape += (len(self.mode), )
+        self.dst = np.zeros(shape, dtype=np.uint8)
 
     def image_coordinate(self, col, row):
         """
@@ -276,115 +417,166 @@ class QuickPano:
                                          {}).get("optics",
                                                  {}).get("rotation_cw")
 
-    def fill_dst_simple(self):
+    def get_trims(self):
         """
-        Paste images in simplified manner
-        Directly at coordinates, no rotation / alpha required
+        Return (x, y) pixels to trim off each interior tile edge
         """
-        print('"Quick pano": fast w/o rotation')
-        # Fill from bottom up such that upper left is on top
-        for row in range(self.iindex["rows"]):
-            row = self.iindex["rows"] - row - 1
-            for col in range(self.iindex["cols"]):
-                col = self.iindex["cols"] - col - 1
-                #for this in self.iindex["images"].values():
-                # col, row = this["col"], this["row"]
-                info = self.cr2info[(col, row)]
-                x, y = self.image_coordinate(col, row)
-                self.verbose and print(f"{row}r {col}c => {x} x {y} y")
-                im = Image.open(
-                    os.path.join(self.iindex["dir"], info["filename"]))
-                self.dst.paste(im, (x, y))
-
-    def fill_dst_rotate(self):
+        if not self.get_rotation_cw():
+            return (0, 0)
         overlaps = self.get_overlaps()
-        rotation_cw = self.get_rotation_cw()
-        # print("overlaps", overlaps)
+        if not overlaps:
+            return (0, 0)
         # Half each side of image
         # Need a few percent of overlap to ensure no gaps
         # TODO: calculate this based on rotation
-        trim_x = int(overlaps["x"]["overlap_pixels"] * 0.48)
-        trim_y = int(overlaps["y"]["overlap_pixels"] * 0.48)
-        # print("x y", trim_x, trim_y)
-        # print("rotation_cw", rotation_cw)
-        orig_mode = self.dst.mode
-        # self.dst.putalpha(255)
-        self.dst = self.dst.convert('RGBA')
-        print('"Quick pano": slower w/ rotation')
-
-        # assert 0
-
-        # Fill from bottom up such that upper left is on top
+        return (int(overlaps["x"]["overlap_pixels"] * 0.48),
+                int(overlaps["y"]["overlap_pixels"] * 0.48))
+
+    def tile_order(self):
+        """
+        Composite order: from bottom up such that upper left is on top
+        """
         for row in range(self.iindex["rows"]):
-            print("  Row %u / %u" % (row + 1, self.iindex["rows"]))
             row = self.iindex["rows"] - row - 1
             for col in range(self.iindex["cols"]):
                 col = self.iindex["cols"] - col - 1
-                # print("col", col, row)
-                #for this in self.iindex["images"].values():
-                # col, row = this["col"], this["row"]
-                info = self.cr2info[(col, row)]
-                x, y = self.image_coordinate(col, row)
-                self.verbose and print(f"{row}r {col}c => {x} x {y} y")
-                im_orig = Image.open(
-                    os.path.join(self.iindex["dir"], info["filename"]))
-
-                im = im_orig.convert('RGBA')
-                # im.putalpha(255)
-                im = im.rotate(rotation_cw, Image.BICUBIC, expand=True)
-                offset_x = 0
-                offset_y = 0
-                """
-                if rotation_cw > 0:
-                    offset_x = -int(math.sin(rotation_cw * 3.14 / 180) * im_orig.height)
-                else:
-                    offset_y = -int(math.sin(-rotation_cw * 3.14 / 180) * im_orig.width)
-                print("offsets", offset_x, offset_y)
-                """
-
-                crop_x0 = 0
-                crop_x1 = im.width
-                crop_y0 = 0
-                crop_y1 = im.height
-                if col > 0:
-                    crop_x0 = trim_x
-                    offset_x += crop_x0
-                if row > 0:
-                    crop_y0 = trim_y
-                    offset_y += crop_y0
-                if col < self.iindex["cols"] - 1:
-                    crop_x1 -= trim_x
-                if row < self.iindex["rows"] - 1:
-                    crop_y1 -= trim_y
-                # print("crop", crop_x0, crop_y0, crop_x1, crop_y1)
-                im = im.crop((crop_x0, crop_y0, crop_x1, crop_y1))
-                # print("paste", (x, y), (x + offset_x, y + offset_y))
-
-                self.dst.paste(im, (x + offset_x, y + offset_y), im)
-        self.dst = self.dst.convert(orig_mode)
+                yield col, row
+
+    def warp_tile(self, col, row):
+        """
+        Return (x, y, image, mask) to composite at output (x, y)
+        mask None => whole image
+        or None if the tile lands outside of the output
+        """
+        info = self.cr2info[(col, row)]
+        x, y = self.image_coordinate(col, row)
+        w, h = self.tile_size
+        trim_x, trim_y = self.trims
+        # Source region this tile is responsible for
+        crop_x0 = trim_x if col > 0 else 0
+        crop_x1 = w - trim_x if col < self.iindex["cols"] - 1 else w
+        crop_y0 = trim_y if row > 0 else 0
+        crop_y1 = h - trim_y if row < self.iindex["rows"] - 1 else h
+
+        with Image.open(os.path.join(self.iindex["dir"],
+                                     info["filename"])) as im:
+            # JPEG: let the decoder do most of the downscale
+            im.draft(self.mode, (int(w / self.scale), int(h / self.scale)))
+            if im.mode != self.mode:
+                im = im.convert(self.mode)
+            src = np.asarray(im)
+        # Decoded pixels per capture pixel
+        fx = src.shape[1] / w
+        fy = src.shape[0] / h
+        dec_x0 = int(crop_x0 * fx)
+        dec_y0 = int(crop_y0 * fy)
+        src = src[dec_y0:int(math.ceil(crop_y1 * fy)),
+                  dec_x0:int(math.ceil(crop_x1 * fx))]
+
+        if not self.rotation and self.scale == 1:
+            # Plain paste
+            return x + crop_x0, y + crop_y0, src, None
+
+        # Transforms below are in continuous coordinates
+        # (pixel i spans [i, i + 1)) so that scaling doesn't shift things
+        # Cropped, decoded pixels => capture pixels
+        m = np.array([[1 / fx, 0, dec_x0 / fx], [0, 1 / fy, dec_y0 / fy],
+                      [0, 0, 1]])
+        # Capture pixels => output pixels:
+        # rotate about the tile center, shift to its position, scale
+        s = 1.0 / self.scale
+        center = (w / 2, h / 2)
+        rotate = np.vstack((cv2.getRotationMatrix2D(center, self.rotation,
+                                                    s), [0, 0, 1]))
+        rotate[0, 2] += s * x + (s - 1) * center[0]
+        rotate[1, 2] += s * y + (s - 1) * center[1]
+        m = rotate @ m
+
+        # Output bounding box
+        corners = np.array([[0, 0, 1], [src.shape[1], 0, 1],
+                            [0, src.shape[0], 1],
+                            [src.shape[1], src.shape[0], 1]]).T
+        xs, ys, _ones = m @ corners
+        roi_x0 = max(0, int(math.floor(xs.min())))
+        roi_y0 = max(0, int(math.floor(ys.min())))
+        roi_x1 = min(self.width, int(math.ceil(xs.max())))
+        roi_y1 = min(self.height, int(math.ceil(ys.max())))
+        if roi_x1 <= roi_x0 or roi_y1 <= roi_y0:
+            return None
+        # warpAffine works on pixel centers, relative to the ROI
+        from_centers = np.array([[1, 0, 0.5], [0, 1, 0.5], [0, 0, 1]])
+        to_centers = np.array([[1, 0, -0.5 - roi_x0], [0, 1, -0.5 - roi_y0],
+                               [0, 0, 1]])
+        m = (to_centers @ m @ from_centers)[:2]
+        size = (roi_x1 - roi_x0, roi_y1 - roi_y0)
+        # Replicate: edge pixels shouldn't fade into black
+        image = cv2.warpAffine(src,
+                               m,
+                               size,
+                               flags=cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_REPLICATE)
+        mask = cv2.warpAffine(np.full(src.shape[:2], 255, dtype=np.uint8),
+                              m,
+                              size,
+                              flags=cv2.INTER_NEAREST)
+        return roi_x0, roi_y0, image, mask
+
+    def composite(self, warped):
+        if warped is None:
+            return
+        x, y, image, mask = warped
+        if mask is None:
+            h, w = image.shape[:2]
+            h = min(h, self.height - y)
+            w = min(w, self.width - x)
+            self.dst[y:y + h, x:x + w] = image[:h, :w]
+        else:
+            h, w = mask.shape
+            # In place on the view
+            cv2.copyTo(image, mask, self.dst[y:y + h, x:x + w])
 
     def fill_dst(self):
-        if self.get_rotation_cw():
-            self.fill_dst_rotate()
+        self.rotation = self.get_rotation_cw() or 0.0
+        self.trims = self.get_trims()
+        if self.rotation:
+            print('"Quick pano": w/ rotation')
         else:
-            self.fill_dst_simple()
+            print('"Quick pano": w/o rotation')
+        order = list(self.tile_order())
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            # Warp ahead, but keep a bounded number of tiles in memory
+            pending = deque()
+            for col, row in order:
+                pending.append(executor.submit(self.warp_tile, col, row))
+                if len(pending) > 2 * self.threads:
+                    self.composite(pending.popleft().result())
+            while pending:
+                self.composite(pending.popleft().result())
 
     def save(self):
         self.verbose and print(('Saving %s...' % (self.output_filename, )))
+        self.output_filename, writer = new_band_writer(self.output_filename,
+                                                       self.width,
+                                                       self.height,
+                                                       self.mode,
+                                                       threads=self.threads)
         try:
-            self.dst.save(self.output_filename, quality=95)
-        # File "/usr/lib/python2.7/dist-packages/PIL/TiffImagePlugin.py", line 550, in _pack
-        #   return struct.pack(self._endian + fmt, *values)
-        # struct.error: 'L' format requires 0 <= number <= 4294967295
-        except struct.error:
+            # Band at a time keeps the encoder from copying the whole image
+            for y in range(0, self.height, 256):
+                writer.write_rows(self.dst[y:y + 256])
+            writer.close()
+        except BaseException:
+            writer.abort()
             try:
                 os.remove(self.output_filename)
             except OSError:
                 pass
-            raise HugeTIF("Failed to save image of size %uw x %uh" %
-                          (self.dst.width, self.dst.height))
+            raise
 
     def run(self):
+        """
+        Return the filename written
+        """
         assert self.iindex[
             "flat"], "Single image only supported on final level image set"
         self.load_scan_json()
@@ -392,10 +584,11 @@ class QuickPano:
         self.fill_dst()
         self.save()
         self.verbose and print('Done!')
+        return self.output_filename
 
 
 def write_quick_pano(*args, **kwargs):
-    QuickPano(*args, **kwargs).run()
+    return QuickPano(*args, **kwargs).run()
 
 
 def main():
@@ -405,6 +598,15 @@ def main():
     add_bool_arg(parser, "--html", default=True)
     add_bool_arg(parser, "--snapshot-grid", default=True)
     add_bool_arg(parser, "--quick-pano", default=True)
+    add_bool_arg(parser, "--pyramid", default=False)
+    parser.add_argument("--snapshot-grid-scale",
+                        type=float,
+                        default=1,
+                        help="Shrink snapshot grid tiles by this factor")
+    parser.add_argument("--quick-pano-scale",
+                        type=float,
+                        default=1,
+                        help="Shrink quick pano by this factor")
     parser.add_argument("dir_in")
     args = parser.parse_args()
 
@@ -414,10 +616,15 @@ def main():
         write_html_viewer(iindex)
 
     if args.snapshot_grid:
-        write_snapshot_grid(iindex)
+        write_snapshot_grid(iindex, scale=args.snapshot_grid_scale)
+
+    if args.quick_pano:
+        write_quick_pano(iindex, scale=args.quick_pano_scale)
 
-    if args.tile_image:
-        write_quick_pano(iindex)
+    if args.pyramid:
+        # Builds on SnapshotGrid
+        from uscope.imagep.pyramid import write_pyramid
+        write_pyramid(iindex)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,347 @@
+"""
+Synthetic scan generator
+
+Writes a scan directory shaped like one captured by the planner
+(c%03u_r%03u_z%02u_h%02u.jpg naming, uscan.json) so that the processing
+engine can be exercised without a microscope
+
+Tiles are cut from one continuous procedural "die" texture
+so neighboring tiles really overlap and can be stitched
+-Focus stacks: a tilted focal plane puts a different slice in focus per tile
+    blur grows with distance from the focal plane
+-HDR: brackets are scaled exposures of the same tile
+-Stage error: optional random offset between commanded and actual position
+    uscan.json records the commanded position like a real scan
+"""
+
+from uscope.util import writej
+import cv2
+import numpy as np
+import os
+
+
+def hash_cells(cx, cy, seed, channel):
+    """
+    Deterministic pseudo random uint8 per (cell x, cell y)
+    Same value no matter which tile asks for it
+    """
+    h = (cx.astype(np.uint64) * np.uint64(73856093)) ^ (
+        cy.astype(np.uint64) * np.uint64(19349663)) ^ np.uint64(
+            (seed * 83492791 + channel * 2654435761) & 0xFFFFFFFF)
+    h ^= h >> np.uint64(13)
+    h *= np.uint64(0x5BD1E995)
+    h ^= h >> np.uint64(15)
+    return (h & np.uint64(0xFF)).astype(np.uint8)
+
+
+class SyntheticScan:
+    def __init__(self,
+                 cols=4,
+                 rows=3,
+                 width=1024,
+                 height=768,
+                 stack=1,
+                 hdr=1,
+                 overlap=0.3,
+                 defocus=1.5,
+                 jitter=0,
+                 noise=2.0,
+                 extension=".jpg",
+                 quality=90,
+                 um_per_pixel=0.5,
+                 microscope="mock",
+                 seed=0):
+        """
+        stack / hdr: images per tile. 1 => not used (no _z / _h in names)
+        defocus: blur sigma (pixels) per slice away from the focal plane
+        jitter: max stage error in pixels
+        """
+        self.cols = cols
+        self.rows = rows
+        self.width = width
+        self.height = height
+        self.stack = stack
+        self.hdr = hdr
+        self.overlap = overlap
+        self.defocus = defocus
+        self.jitter = jitter
+        self.noise = noise
+        self.extension = extension
+        self.quality = quality
+        self.um_per_pixel = um_per_pixel
+        self.microscope = microscope
+        self.seed = seed
+        self.step_x = int(round(width * (1 - overlap)))
+        self.step_y = int(round(height * (1 - overlap)))
+        rng = np.random.default_rng(seed)
+        self.offsets = {}
+        for col in range(cols):
+            for row in range(rows):
+                self.offsets[(col, row)] = tuple(
+                    int(v) for v in rng.integers(-jitter, jitter + 1, size=2))
+
+    def mosaic_size(self):
+        """
+        Return (width, height) of the full scanned area in pixels
+        """
+        return (self.step_x * (self.cols - 1) + self.width,
+                self.step_y * (self.rows - 1) + self.height)
+
+    def tile_origin(self, col, row):
+        """
+        Actual (x, y) mosaic pixel of the tile upper left (includes stage error)
+        """
+        dx, dy = self.offsets[(col, row)]
+        return col * self.step_x + dx, row * self.step_y + dy
+
+    def texture(self, x0, y0, width, height):
+        """
+        Return an in focus RGB uint8 region of the mosaic
+        Blocky "cells" of various sizes plus thin traces, lightly smoothed
+        """
+        margin = 4
+        xs = np.arange(x0 - margin, x0 + width + margin, dtype=np.int64)
+        ys = np.arange(y0 - margin, y0 + height + margin, dtype=np.int64)
+        # Keep hashes positive for tiles with negative stage error
+        xs += 1 << 20
+        ys += 1 << 20
+        ret = np.zeros((len(ys), len(xs), 3), dtype=np.float32)
+        for level, cell in enumerate((64, 16, 4)):
+            # Hash once per cell and then expand to pixels
+            cxs = xs // cell
+            cys = ys // cell
+            cx, cy = np.meshgrid(np.arange(cxs[0], cxs[-1] + 1),
+                                 np.arange(cys[0], cys[-1] + 1))
+            ix = cxs - cxs[0]
+            iy = cys - cys[0]
+            gray = hash_cells(cx, cy, self.seed + level, 3).astype(np.float32)
+            for channel in range(3):
+                tint = hash_cells(cx, cy, self.seed + level, channel)
+                v = 0.75 * gray + 0.25 * tint.astype(np.float32)
+                ret[:, :, channel] += (v / (2 << level))[iy][:, ix]
+        # Metal traces: horizontal / vertical lines on a coarse grid
+        trace_x = (xs % 48) < 3
+        trace_y = (ys % 40) < 2
+        ret[:, trace_x] = 230
+        ret[trace_y, :] = 230
+        ret = cv2.GaussianBlur(ret, (0, 0), 1.0)
+        ret = ret[margin:margin + height, margin:margin + width]
+        return np.clip(ret, 0, 255).astype(np.uint8)
+
+    def focus_slice(self, col, row):
+        """
+        Stack slice that is in focus for this tile
+        Focal plane tilts diagonally across the scan
+        """
+        if self.stack <= 1:
+            return 0
+        span = max(1, self.cols + self.rows - 2)
+        return (self.stack - 1) * (col + row) / span
+
+    def sharp_tile(self, col, row):
+        x0, y0 = self.tile_origin(col, row)
+        return self.texture(x0, y0, self.width, self.height)
+
+    def tile(self, col, row, stacki=0, hdri=0, rng=None, sharp=None):
+        """
+        Return RGB uint8 image as captured
+        sharp: sharp_tile(col, row) if already computed
+        """
+        if sharp is None:
+            sharp = self.sharp_tile(col, row)
+        im = sharp.astype(np.float32)
+        sigma = self.defocus * abs(stacki - self.focus_slice(col, row))
+        if sigma > 0.3:
+            im = cv2.GaussianBlur(im, (0, 0), sigma)
+        if self.hdr > 1:
+            # Brackets centered on the nominal exposure
+            im *= 2.0**(hdri - (self.hdr - 1) / 2)
+        if self.noise and rng is not None:
+            im += rng.standard_normal(im.shape, dtype=np.float32) * self.noise
+        return np.clip(im, 0, 255).astype(np.uint8)
+
+    def basename(self, col, row, stacki=None, hdri=None):
+        ret = "c%03u_r%03u" % (col, row)
+        if self.stack > 1:
+            ret += "_z%02u" % stacki
+        if self.hdr > 1:
+            ret += "_h%02u" % hdri
+        return ret + self.extension
+
+    def position(self, col, row, stacki=0):
+        """
+        Commanded stage position in mm
+        Stage y increases upwards while image rows increase downwards
+        """
+        mm_per_pixel = self.um_per_pixel / 1000
+        return {
+            "x": col * self.step_x * mm_per_pixel,
+            "y": (self.rows - 1 - row) * self.step_y * mm_per_pixel,
+            "z": stacki * 0.001,
+        }
+
+    def axis_meta(self, view_pixels, step_pixels, n):
+        view_mm = view_pixels * self.um_per_pixel / 1000
+        step_mm = step_pixels * self.um_per_pixel / 1000
+        return {
+            "step_mm": step_mm,
+            "start_mm": 0.0,
+            "end_mm": step_mm * (n - 1) + view_mm,
+            "view_pixels": view_pixels,
+            "view_mm": view_mm,
+            "delta_mm": step_mm * (n - 1) + view_mm,
+            "delta_pixels": step_pixels * (n - 1) + view_pixels,
+            "pixels_per_mm": 1000 / self.um_per_pixel,
+            "overlap_fraction": 1 - step_pixels / view_pixels,
+        }
+
+    def uscan(self, files):
+        points = {}
+        for row in range(self.rows):
+            for col in range(self.cols):
+                v = self.position(col, row)
+                v.update({"col": col, "row": row})
+                points["c%03u_r%03u" % (col, row)] = v
+        pconfig = {
+            "app": {
+                "microscope": self.microscope,
+                "objective": {
+                    "um_per_pixel": self.um_per_pixel,
+                },
+            },
+        }
+        ret = {
+            "version": "2.0.0",
+            "synthetic": {
+                "seed": self.seed,
+                "jitter": self.jitter,
+                "defocus": self.defocus,
+                # Ground truth for stitch tests
+                "offsets": {
+                    "c%03u_r%03u" % k: v
+                    for k, v in self.offsets.items()
+                },
+            },
+            "pconfig": pconfig,
+            "points-xy2p": {
+                "points_to_generate": self.cols * self.rows,
+                "points_generated": self.cols * self.rows,
+                "points": points,
+                "axes": {
+                    "x": self.axis_meta(self.width, self.step_x, self.cols),
+                    "y": self.axis_meta(self.height, self.step_y, self.rows),
+                },
+            },
+            "image-save": {
+                "extension": self.extension,
+                "quality": self.quality,
+                "saved": len(files),
+            },
+            "files": files,
+            "microscope": {
+                "name": self.microscope,
+                "serial": None,
+            },
+        }
+        if self.stack > 1:
+            pconfig["points-stacker"] = {"number": self.stack}
+            ret["points-stacker"] = {"per_stack": self.stack}
+        if self.hdr > 1:
+            properties_list = [{} for _i in range(self.hdr)]
+            pconfig["imager"] = {"hdr": {"properties_list": properties_list}}
+            ret["image-hdr"] = {"properties_list": properties_list}
+        return ret
+
+    def images(self):
+        """
+        Yield (col, row, stacki, hdri) in capture order (serpentine)
+        """
+        for row in range(self.rows):
+            cols = range(self.cols)
+            if row % 2:
+                cols = reversed(cols)
+            for col in cols:
+                for stacki in range(self.stack):
+                    for hdri in range(self.hdr):
+                        yield col, row, stacki, hdri
+
+    def write(self, directory, callback=None):
+        """
+        Write the scan to directory (created if needed)
+        callback(fn): called after each image is saved (ex: to emulate a stream)
+        Return number of images written
+        """
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+        rng = np.random.default_rng(self.seed + 1)
+        files = {}
+        sharp = None
+        sharp_cr = None
+        for col, row, stacki, hdri in self.images():
+            # All images of a tile are captured back to back
+            if sharp_cr != (col, row):
+                sharp = self.sharp_tile(col, row)
+                sharp_cr = (col, row)
+            basename = self.basename(col, row, stacki, hdri)
+            fn = os.path.join(directory, basename)
+            array = self.tile(col, row, stacki, hdri, rng=rng, sharp=sharp)
+            bgr = cv2.cvtColor(array, cv2.COLOR_RGB2BGR)
+            cv2.imwrite(fn, bgr, [int(cv2.IMWRITE_JPEG_QUALITY), self.quality])
+            meta = {
+                "position": self.position(col, row, stacki),
+                "col": col,
+                "row": row,
+            }
+            if self.stack > 1:
+                meta["stacki"] = stacki
+            if self.hdr > 1:
+                meta["hdri"] = hdri
+            files[basename] = meta
+            callback and callback(fn)
+        writej(os.path.join(directory, "uscan.json"), self.uscan(files))
+        return len(files)
+
+
+def add_scan_args(parser, stack=1, hdr=1):
+    """
+    Command line options describing a SyntheticScan
+    stack / hdr: defaults for the scan shape
+    """
+    parser.add_argument("--cols", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=3)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--stack",
+                        type=int,
+                        default=stack,
+                        help="Focus stack depth (1: no stacking)")
+    parser.add_argument("--hdr",
+                        type=int,
+                        default=hdr,
+                        help="HDR brackets (1: no HDR)")
+    parser.add_argument("--overlap", type=float, default=0.3)
+    parser.add_argument("--defocus",
+                        type=float,
+                        default=1.5,
+                        help="Blur sigma per slice away from focus")
+    parser.add_argument("--jitter",
+                        type=int,
+                        default=0,
+                        help="Max stage error in pixels")
+    parser.add_argument("--extension", default=".jpg")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def scan_from_args(args, microscope="mock"):
+    return SyntheticScan(cols=args.cols,
+                         rows=args.rows,
+                         width=args.width,
+                         height=args.height,
+                         stack=args.stack,
+                         hdr=args.hdr,
+                         overlap=args.overlap,
+                         defocus=args.defocus,
+                         jitter=args.jitter,
+                         extension=args.extension,
+                         microscope=microscope,
+                         seed=args.seed)
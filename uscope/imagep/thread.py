@@ -26,6 +26,13 @@ class ImageProcessingThreadBase(CommandThreadBase):
         self.ip.start()
         # nothing to process => can try to shutdown before it starts
         self.ip.ready.wait(1.0)
+        if microscope:
+            microscope.statistics.add_getj(self.statistics_getj)
+
+    def statistics_getj(self, statj):
+        j = statj.setdefault("image_processing", {})
+        j["queue_wait"] = self.ip.queue_wait_stats()
+        j["jobs"] = self.ip.jobs_progress()
 
     def shutdown_request(self):
         # Stop requests first
@@ -70,6 +77,26 @@ class ImageProcessingThreadBase(CommandThreadBase):
         }
         self.command("process_image", j, block=block, callback=callback)
 
+    def process_stream(self, image_stream, configj={}):
+        """
+        Process HDR / stack buckets while the scan is still capturing
+        Runs on its own thread so snapshots and autofocus aren't held up
+        The caller does the final processing (ex: cs_auto)
+        Return the thread: join() it before processing the directory
+        """
+        def run():
+            try:
+                self.ip.process_stream(image_stream,
+                                       configj=configj,
+                                       finish=False)
+            except Exception as e:
+                traceback.print_exc()
+                self.log(f"WARNING: stream processing crashed: {e}")
+
+        thread = threading.Thread(target=run, name="stream-csip", daemon=True)
+        thread.start()
+        return thread
+
     # TODO: move more of this to the image processing thread
     # rotate, scaling
     def _do_process_image(self, j):
@@ -91,7 +118,10 @@ class ImageProcessingThreadBase(CommandThreadBase):
             image = image.rotate(180)
 
         try:
-            image = self.ip.process_snapshots([image], options=options)
+            priority = options.get("priority", "interactive")
+            image = self.ip.process_snapshots([image],
+                                              options=options,
+                                              priority=priority)
         except Exception as e:
             traceback.print_exc()
             self.log(f"WARNING; snapshot processing crashed: {e}")
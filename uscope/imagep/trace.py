@@ -0,0 +1,285 @@
+"""
+Task tracing for the image processing engine
+
+Every task executed by a CSImageProcessor worker gets a TaskTrace
+recording where its time went:
+-queue_wait: queued until a worker picked it up
+-decode: reading input images (EtherealImageR.to_im())
+-compute: everything else in the plugin
+-encode: compressing the output (EtherealImageW.set_im())
+-write: writing the output file
+Queue wait is also broken down by task priority class
+
+Phases are attributed through a per thread "current task"
+so plugins and EtherealImage's don't need to pass anything around
+
+Nothing is kept unless a TraceSession is active
+(ex: DirCSIP opens one per scan and saves the summary to processing.json)
+A session can be limited to one job so concurrent jobs don't mix
+"""
+
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+PHASES = ("queue_wait", "decode", "compute", "encode", "write")
+
+_local = threading.local()
+
+
+def current_task():
+    return getattr(_local, "task", None)
+
+
+def set_current_task(task):
+    _local.task = task
+
+
+@contextmanager
+def trace_phase(name):
+    """
+    Attribute time spent in the block to the current task (if any)
+    """
+    task = current_task()
+    if task is None:
+        yield
+        return
+    tstart = time.time()
+    try:
+        yield
+    finally:
+        task.spans.append((name, tstart, time.time()))
+
+
+class TaskTrace:
+    def __init__(self,
+                 task_name,
+                 worker,
+                 t_queued=None,
+                 priority=None,
+                 job=None):
+        self.task_name = task_name
+        self.worker = worker
+        self.priority = priority
+        # CSIPJob id
+        self.job = job
+        self.t_start = time.time()
+        self.t_queued = t_queued if t_queued is not None else self.t_start
+        self.t_end = None
+        # (phase, start, end)
+        self.spans = []
+        self.result = None
+
+    def finish(self, result):
+        self.t_end = time.time()
+        self.result = result
+
+    def phase_times(self):
+        """
+        Return {phase: seconds}
+        compute is whatever the explicit phases don't cover
+        """
+        ret = {phase: 0.0 for phase in PHASES}
+        ret["queue_wait"] = self.t_start - self.t_queued
+        for name, tstart, tend in self.spans:
+            ret[name] += tend - tstart
+        ret["compute"] = max(
+            0.0,
+            self.duration() - ret["decode"] - ret["encode"] - ret["write"])
+        return ret
+
+    def duration(self):
+        return self.t_end - self.t_start
+
+
+def stats(values):
+    if not values:
+        return {"total": 0.0, "mean": 0.0, "p50": 0.0, "max": 0.0}
+    values = sorted(values)
+    return {
+        "total": round(sum(values), 6),
+        "mean": round(sum(values) / len(values), 6),
+        "p50": round(values[len(values) // 2], 6),
+        "max": round(values[-1], 6),
+    }
+
+
+class TraceSession:
+    """
+    Tasks completed while the session was open
+    job: only tasks of this CSIPJob id (None => all)
+    """
+    def __init__(self, job=None):
+        self.job = job
+        self.t_start = time.time()
+        self.t_end = None
+        self.tasks = []
+        self.lock = threading.Lock()
+
+    def add(self, task):
+        with self.lock:
+            self.tasks.append(task)
+
+    def wall_time(self):
+        t_end = self.t_end if self.t_end is not None else time.time()
+        return t_end - self.t_start
+
+    def summary(self):
+        """
+        Return JSON serializable per plugin stats and per worker utilization
+        Times are in seconds
+        """
+        with self.lock:
+            tasks = list(self.tasks)
+        wall = self.wall_time()
+        plugins = {}
+        workers = {}
+        queue_waits = {}
+        for task in tasks:
+            times = task.phase_times()
+            queue_waits.setdefault(task.priority,
+                                   []).append(times["queue_wait"])
+            plugin = plugins.get(task.task_name)
+            if plugin is None:
+                phases = {phase: [] for phase in PHASES}
+                plugin = {"count": 0, "failed": 0, "phases": phases}
+                plugins[task.task_name] = plugin
+            plugin["count"] += 1
+            if task.result != "ok":
+                plugin["failed"] += 1
+            for phase in PHASES:
+                plugin["phases"][phase].append(times[phase])
+            worker = workers.setdefault(task.worker, {"tasks": 0, "busy": 0.0})
+            worker["tasks"] += 1
+            worker["busy"] += task.duration()
+        for plugin in plugins.values():
+            plugin["phases"] = {
+                phase: stats(values)
+                for phase, values in plugin["phases"].items()
+            }
+        for worker in workers.values():
+            worker["busy"] = round(worker["busy"], 6)
+            utilization = worker["busy"] / wall if wall else 0.0
+            worker["utilization"] = round(utilization, 4)
+        return {
+            "wall": round(wall, 6),
+            "tasks": len(tasks),
+            "plugins": plugins,
+            "workers": workers,
+            # Queue wait per priority class
+            "priorities": {
+                str(priority): stats(values)
+                for priority, values in queue_waits.items()
+            },
+        }
+
+    def chrome_trace(self):
+        """
+        Return a Chrome trace (chrome://tracing, ui.perfetto.dev) JSON object
+        One track per worker, phases nested under their task
+        """
+        with self.lock:
+            tasks = list(self.tasks)
+        pid = os.getpid()
+        tids = {}
+        events = []
+
+        def us(t):
+            return int((t - self.t_start) * 1e6)
+
+        for task in tasks:
+            tid = tids.get(task.worker)
+            if tid is None:
+                tid = len(tids) + 1
+                tids[task.worker] = tid
+                events.append({
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {
+                        "name": task.worker
+                    },
+                })
+            times = task.phase_times()
+            events.append({
+                "name": task.task_name,
+                "cat": "task",
+                "ph": "X",
+                "ts": us(task.t_start),
+                "dur": us(task.t_end) - us(task.t_start),
+                "pid": pid,
+                "tid": tid,
+                "args": {
+                    "result": task.result,
+                    "priority": task.priority,
+                    "job": task.job,
+                    "queue_wait_ms": round(times["queue_wait"] * 1000, 3),
+                },
+            })
+            for name, tstart, tend in task.spans:
+                events.append({
+                    "name": name,
+                    "cat": "phase",
+                    "ph": "X",
+                    "ts": us(tstart),
+                    "dur": us(tend) - us(tstart),
+                    "pid": pid,
+                    "tid": tid,
+                })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+class Tracer:
+    """
+    Owned by CSImageProcessor
+    Workers record every finished task
+    which is handed to all currently open sessions
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = []
+        # Always on, constant size: {priority: [count, total, max]}
+        self.queue_waits = {}
+
+    def begin(self, job=None):
+        session = TraceSession(job=job)
+        with self.lock:
+            self.sessions.append(session)
+        return session
+
+    def end(self, session):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+        if session.t_end is None:
+            session.t_end = time.time()
+        return session
+
+    def record(self, task):
+        wait = task.t_start - task.t_queued
+        with self.lock:
+            sessions = list(self.sessions)
+            this = self.queue_waits.setdefault(task.priority, [0, 0.0, 0.0])
+            this[0] += 1
+            this[1] += wait
+            this[2] = max(this[2], wait)
+        for session in sessions:
+            if session.job is None or session.job == task.job:
+                session.add(task)
+
+    def queue_wait_stats(self):
+        """
+        Return {priority: {count, mean, max}} over the Tracer lifetime
+        """
+        with self.lock:
+            items = [(k, list(v)) for k, v in self.queue_waits.items()]
+        ret = {}
+        for priority, (count, total, max_wait) in items:
+            ret[str(priority)] = {
+                "count": count,
+                "mean": round(total / count, 6),
+                "max": round(max_wait, 6),
+            }
+        return ret
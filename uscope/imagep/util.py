@@ -1,17 +1,32 @@
-import time
+import concurrent.futures
 import os
+import threading
 from PIL import Image
 import subprocess
 import tempfile
 import shutil
 import re
+import cv2
 from pyzbar.pyzbar import decode as pyzbar_decode
+from uscope.imagep.trace import trace_phase
+import io
 
 # Rayleigh criterion
 # https://oeis.org/A245461
 RC_CONST = 1.21966989
 
 
+def pil_format(fn):
+    """
+    Return the PIL format PIL.Image.save() would pick for fn
+    """
+    ext = os.path.splitext(fn)[1].lower()
+    ret = Image.registered_extensions().get(ext)
+    if ret is None:
+        raise ValueError(f"Unknown image extension {fn}")
+    return ret
+
+
 class EtherealImageR:
     """
     An image that may be on filesystem or in memory
@@ -23,6 +38,8 @@ class EtherealImageR:
         self.fn = fn
         self.tmp_files = set()
         self.meta = meta
+        # In memory image written out for a plugin that needs a file
+        self.tmp_fn = None
 
     def __del__(self):
         self.flush()
@@ -32,17 +49,35 @@ class EtherealImageR:
         Remove all temporary files
         """
         for fn in self.tmp_files:
-            os.unlink(fn)
+            # Plugin may have already cleaned up its tmp dir
+            if os.path.exists(fn):
+                os.unlink(fn)
         self.tmp_files.clear()
+        self.tmp_fn = None
 
-    def get_filename(self):
+    def get_filename(self, tmp_dir=None):
         """
         Return any valid filename
+        In memory images are written to a temporary .tif on demand
+        (ex: for plugins that shell out)
         """
         if self.fn:
             return self.fn
-        else:
-            assert 0, "FIXME"
+        assert self.im is not None, "Image has no data"
+        # A plugin clearing its tmp_dir may have removed an earlier one
+        if self.tmp_fn is not None and not os.path.exists(self.tmp_fn):
+            self.tmp_files.discard(self.tmp_fn)
+            self.tmp_fn = None
+        if self.tmp_fn is None:
+            fd, fn = tempfile.mkstemp(prefix="ethereal_",
+                                      suffix=".tif",
+                                      dir=tmp_dir)
+            os.close(fd)
+            with trace_phase("write"):
+                self.im.save(fn)
+            self.tmp_files.add(fn)
+            self.tmp_fn = fn
+        return self.tmp_fn
 
     def to_filename(self, fn):
         """
@@ -51,8 +86,8 @@ class EtherealImageR:
         Image may be written or symlinked to
         """
         assert fn not in self.tmp_files
-        if self.im:
-            self.im.write(fn)
+        if self.im is not None:
+            self.im.save(fn)
         else:
             os.symlink(self.fn, fn)
         self.tmp_files.add(fn)
@@ -61,11 +96,11 @@ class EtherealImageR:
         """
         Ensure resulting file is a .tif, converting if necessary
         """
-        if self.fn:
+        if self.im is not None:
+            self.im.save(fn)
+        elif self.fn:
             subprocess.check_call(["convert", self.fn, fn])
             assert os.path.exists(fn)
-        elif self.im:
-            self.im.write(fn)
         else:
             assert 0
 
@@ -79,38 +114,44 @@ class EtherealImageR:
         """
         Return a read only PIL image
         """
-        if self.im:
+        if self.im is not None:
             return self.im
         else:
-            return Image.open(self.fn)
+            return self.decode()
 
     def to_mutable_im(self):
         """
         Return a writable PIL image
         """
-        if self.im:
+        if self.im is not None:
             return self.im.copy()
         else:
-            return Image.open(self.fn)
+            return self.decode()
+
+    def decode(self):
+        with trace_phase("decode"):
+            im = Image.open(self.fn)
+            im.load()
+        return im
 
 
 class EtherealImageW:
     """
     An image that will be written to output
     User gives some hints as to how it would like the image to be output
-    FIXME: filename centric. Allow setting an Image
-    This mostly works as we currently write all intermediate images anyway
+    want_fn: plugin output goes straight to the given file
+    want_im: plugin output is kept in memory
+        Plugins that can only write a file (ex: enfuse) get a temporary file on demand
     """
 
     temp_images = 0
+    temp_images_lock = threading.Lock()
 
-    # NOTE: this is thread safe because EtherealImageW()s are constructed in the queing process
-    # from the controller
-    # However it would be ideal to make this thread safe
     @staticmethod
     def get_image_id():
-        EtherealImageW.temp_images += 1
-        return EtherealImageW.temp_images
+        with EtherealImageW.temp_images_lock:
+            EtherealImageW.temp_images += 1
+            return EtherealImageW.temp_images
 
     def __init__(self,
                  want_dir=None,
@@ -125,8 +166,6 @@ class EtherealImageW:
         self.temp_filename = None
         self.want_im = False
 
-        tempfile.TemporaryDirectory()
-
         if want_fn:
             self.want_fn = want_fn
         elif want_dir and want_basename:
@@ -134,45 +173,157 @@ class EtherealImageW:
         elif want_im:
             self.want_im = True
             assert temp_dir
+            # Only reserve the name
+            # Nothing is written unless a plugin asks for a filename
             self.temp_filename = os.path.join(
-                temp_dir, "ethereal_%u04u.tif" % EtherealImageW.get_image_id())
-            self.want_fn = self.temp_filename
+                temp_dir, "ethereal_%04u.tif" % EtherealImageW.get_image_id())
         else:
             assert 0, "Unknown operating mode"
         self.meta = meta
 
     def get_filename(self):
+        """
+        Return the filename the plugin should write its output to
+        """
+        if self.want_im:
+            return self.temp_filename
         return self.want_fn
 
+    def set_im(self, im, quality=90):
+        """
+        Output a PIL image
+        Only touches disk if a file output was requested
+        """
+        if self.want_im:
+            self.im = im
+        else:
+            # Encode separately so the write is accounted for on its own
+            with trace_phase("encode"):
+                buf = io.BytesIO()
+                im.save(buf, format=pil_format(self.want_fn), quality=quality)
+            self.write(buf.getbuffer())
+
+    def set_cv_im(self, cv_im, quality=90):
+        """
+        Output an OpenCV style BGR numpy array
+        """
+        if self.want_im:
+            self.im = Image.fromarray(cv2.cvtColor(cv_im, cv2.COLOR_BGR2RGB))
+        else:
+            with trace_phase("encode"):
+                ext = os.path.splitext(self.want_fn)[1]
+                ok, buf = cv2.imencode(
+                    ext, cv_im, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+                assert ok, f"Failed to encode {self.want_fn}"
+            self.write(buf)
+
+    def write(self, buf):
+        with trace_phase("write"):
+            with open(self.want_fn, "wb") as f:
+                f.write(buf)
+
     def get_im(self):
-        return Image.open(self.want_fn)
+        """
+        Return the output as a PIL image
+        """
+        if self.im is None:
+            if self.want_im:
+                # Plugin wrote a file instead
+                self.im = Image.open(self.temp_filename)
+                self.im.load()
+                os.unlink(self.temp_filename)
+            else:
+                return Image.open(self.want_fn)
+        return self.im
 
 
 class TaskBarrier:
     """
     Track when all allocated tasks are complete
-    TODO: consider an event to wake up for faster response
+    Waiters are woken as soon as the last task completes
     """
     def __init__(self):
         self.ntasks_allocated = 0
         self.ntasks_completed = 0
+        self.cv = threading.Condition()
 
     def callback(self):
-        self.ntasks_completed += 1
+        with self.cv:
+            self.ntasks_completed += 1
+            self.cv.notify_all()
 
     def allocate_callback(self):
-        self.ntasks_allocated += 1
+        with self.cv:
+            self.ntasks_allocated += 1
         return self.callback
 
     def wait(self, timeout=None):
-        tstart = time.time()
-        while self.ntasks_allocated > self.ntasks_completed:
-            if timeout and time.time() - tstart > timeout:
+        with self.cv:
+            if not self.cv.wait_for(self.idle_locked, timeout=timeout):
                 raise Exception("Timed out")
-            time.sleep(0.1)
+
+    def idle_locked(self):
+        return self.ntasks_allocated <= self.ntasks_completed
 
     def idle(self):
-        return self.ntasks_allocated == self.ntasks_completed
+        with self.cv:
+            return self.idle_locked()
+
+
+def ethereal_fns(data):
+    """
+    Return filenames referenced by a data_in / data_out dict
+    """
+    ret = []
+    for v in data.values():
+        for image in v if isinstance(v, list) else [v]:
+            fn = getattr(image, "fn", None) or getattr(image, "want_fn", None)
+            if fn:
+                ret.append(fn)
+    return ret
+
+
+class CSIPTaskError(Exception):
+    """
+    A CSImageProcessor task failed
+    The original exception (if any) is chained as __cause__
+    """
+    def __init__(self,
+                 task_name,
+                 message,
+                 worker=None,
+                 fns_in=(),
+                 fns_out=(),
+                 formatted_traceback=None):
+        super().__init__(f"{task_name}: {message}")
+        self.task_name = task_name
+        self.worker = worker
+        self.fns_in = list(fns_in)
+        self.fns_out = list(fns_out)
+        self.formatted_traceback = formatted_traceback
+
+
+class CSIPFuture(concurrent.futures.Future):
+    """
+    Returned by CSImageProcessor.queue_*()
+    result() is the task's data_out (ex: result()["image"].get_im())
+    info is whatever the plugin returned
+    cancel() succeeds while the task is still queued
+    Failures raise CSIPTaskError
+    """
+    def __init__(self, ip_params):
+        super().__init__()
+        self.task_name = ip_params.task_name
+        self.priority = ip_params.priority
+        self.info = None
+
+
+def file_identity(fn):
+    """
+    Cheap stand in for a content hash: [size, mtime in ns]
+    """
+    st = os.stat(fn)
+    return [st.st_size, st.st_mtime_ns]
 
 
 def remove_intermediate_directories(top_dir, nested_dir):
@@ -238,4 +389,4 @@ def find_qr_code_match(image, expr):
             return None
 
     # No detected match
-    return None
\ No newline at end of file
+    return None
@@ -1137,7 +1137,7 @@ class PlannerCaptureImage(PlannerPlugin):
                 self.planner.imager.take()
             else:
                 tstart = time.time()
-                im = self.planner.imager.get_processed()
+                im = self.planner.imager.get_processed(priority="planner")
                 tend = time.time()
                 self.verbose and self.log(
                     "FIXME TMP: actual capture took %0.3f" % (tend - tstart, ))
@@ -0,0 +1,312 @@
+"""
+Scan catalog: what has happened to each scan directory
+
+Originally "was this scan uploaded?" was answered by crawling the scan
+for a cloud_stitch.json, which gets slow once the data dir holds
+hundreds of scans with tens of thousands of images each
+Instead keep a small SQLite database (data/scan_catalog.sqlite) that is
+updated as scans move through their life:
+captured => processing => processed => uploaded
+with failed in place of processed if processing didn't complete
+
+Each scan also gets per stage timing (ex: hdr, hdr/stack, upload)
+
+Writers: StitcherThread (captured), DirCSIP (processing / stages / upload)
+Readers: cs_auto batch mode
+
+Scans the catalog doesn't know about (ex: captured before the catalog
+existed, copied in from elsewhere) are added by sync()
+which crawls each one once
+
+Each operation uses its own short lived connection
+so the catalog can be used from any thread
+and from several processes (ex: GUI + cs_auto subprocess) at once
+The default rollback journal is used as WAL doesn't work on network filesystems
+"""
+
+from uscope import config
+from contextlib import contextmanager, closing
+import glob
+import os
+import sqlite3
+import threading
+import time
+
+SCAN_STATES = ("captured", "processing", "processed", "uploaded", "failed")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    directory TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    captured REAL,
+    processing_start REAL,
+    processing_end REAL,
+    uploaded REAL,
+    updated REAL NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS scans_uploaded ON scans(uploaded);
+CREATE TABLE IF NOT EXISTS stages (
+    directory TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    state TEXT NOT NULL,
+    t_start REAL,
+    t_end REAL,
+    error TEXT,
+    PRIMARY KEY (directory, stage)
+);
+"""
+
+
+def catalog_key(directory):
+    return os.path.realpath(directory)
+
+
+def uploaded_on_disk(directory):
+    """
+    Return the time of the upload or None if not uploaded
+    upload metadata file cloud_stitch.json => uploaded
+    Slow: crawls the whole scan
+    """
+    fns = glob.glob(f'{glob.escape(directory)}/**/cloud_stitch.json',
+                    recursive=True)
+    if not fns:
+        return None
+    return min(os.path.getmtime(fn) for fn in fns)
+
+
+class ScanCatalog:
+    def __init__(self, fn, timeout=30.0):
+        self.fn = fn
+        # Seconds to wait for another process holding the lock
+        self.timeout = timeout
+        self.schema_lock = threading.Lock()
+        self.schema_ready = False
+
+    @contextmanager
+    def connect(self):
+        """
+        Yield a connection. Committed on success, rolled back on exception
+        """
+        with closing(sqlite3.connect(self.fn, timeout=self.timeout)) as conn:
+            conn.row_factory = sqlite3.Row
+            with self.schema_lock:
+                if not self.schema_ready:
+                    conn.executescript(SCHEMA)
+                    self.schema_ready = True
+            with conn:
+                yield conn
+
+    def _ensure(self, conn, directory, t=None):
+        t = time.time() if t is None else t
+        conn.execute(
+            "INSERT OR IGNORE INTO scans (directory, state, captured, updated)"
+            " VALUES (?, 'captured', ?, ?)", (directory, t, t))
+
+    def scan_captured(self, directory):
+        """
+        A new scan. No-op if already known
+        """
+        with self.connect() as conn:
+            self._ensure(conn, catalog_key(directory))
+
+    def processing_begin(self, directory):
+        key = catalog_key(directory)
+        now = time.time()
+        with self.connect() as conn:
+            self._ensure(conn, key, now)
+            conn.execute(
+                "UPDATE scans SET state = 'processing', processing_start = ?,"
+                " processing_end = NULL, updated = ?, error = NULL"
+                " WHERE directory = ?", (now, now, key))
+
+    def processing_end(self, directory, error=None):
+        """
+        error: why processing didn't complete, None => ok
+        An upload during processing keeps the scan as uploaded
+        """
+        key = catalog_key(directory)
+        state = "failed" if error else "processed"
+        now = time.time()
+        with self.connect() as conn:
+            self._ensure(conn, key, now)
+            conn.execute(
+                "UPDATE scans SET processing_end = ?, updated = ?, error = ?,"
+                " state = CASE WHEN ? = 'processed' AND state = 'uploaded'"
+                " THEN state ELSE ? END"
+                " WHERE directory = ?", (now, now, error, state, state, key))
+
+    def failed(self, directory, error):
+        key = catalog_key(directory)
+        now = time.time()
+        with self.connect() as conn:
+            self._ensure(conn, key, now)
+            conn.execute(
+                "UPDATE scans SET state = 'failed', updated = ?, error = ?"
+                " WHERE directory = ?", (now, error, key))
+
+    def mark_uploaded(self, directory, t=None):
+        key = catalog_key(directory)
+        now = time.time()
+        t = now if t is None else t
+        with self.connect() as conn:
+            self._ensure(conn, key, now)
+            conn.execute(
+                "UPDATE scans SET state = 'uploaded', uploaded = ?, updated = ?"
+                " WHERE directory = ?", (t, now, key))
+
+    def stage_begin(self, directory, stage):
+        key = catalog_key(directory)
+        now = time.time()
+        with self.connect() as conn:
+            self._ensure(conn, key, now)
+            conn.execute(
+                "INSERT OR REPLACE INTO stages"
+                " (directory, stage, state, t_start) VALUES (?, ?, 'running', ?)",
+                (key, stage, now))
+
+    def stage_end(self, directory, stage, error=None):
+        key = catalog_key(directory)
+        state = "failed" if error else "done"
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE stages SET state = ?, t_end = ?, error = ?"
+                " WHERE directory = ? AND stage = ?",
+                (state, time.time(), error, key, stage))
+
+    def rename(self, directory, new_directory):
+        """
+        Scan directory was moved (ex: QR code match)
+        """
+        key = catalog_key(directory)
+        new_key = catalog_key(new_directory)
+        with self.connect() as conn:
+            conn.execute("DELETE FROM scans WHERE directory = ?", (new_key, ))
+            conn.execute("DELETE FROM stages WHERE directory = ?", (new_key, ))
+            conn.execute("UPDATE scans SET directory = ? WHERE directory = ?",
+                         (new_key, key))
+            conn.execute("UPDATE stages SET directory = ? WHERE directory = ?",
+                         (new_key, key))
+
+    def get(self, directory):
+        """
+        Return the scan as a dict with its stages or None if unknown
+        """
+        key = catalog_key(directory)
+        with self.connect() as conn:
+            row = conn.execute("SELECT * FROM scans WHERE directory = ?",
+                               (key, )).fetchone()
+            if row is None:
+                return None
+            ret = dict(row)
+            stages = conn.execute(
+                "SELECT * FROM stages WHERE directory = ? ORDER BY t_start",
+                (key, ))
+            ret["stages"] = {row["stage"]: dict(row) for row in stages}
+        return ret
+
+    def is_uploaded(self, directory):
+        """
+        Return True / False or None if the scan isn't in the catalog
+        """
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT uploaded FROM scans WHERE directory = ?",
+                (catalog_key(directory), )).fetchone()
+        if row is None:
+            return None
+        return row["uploaded"] is not None
+
+    def scans(self, uploaded=None, state=None):
+        """
+        Return scan dicts (without stages), oldest capture first
+        uploaded: True / False => filter on upload status
+        state: only scans in this state
+        """
+        where = []
+        args = []
+        if uploaded is not None:
+            where.append(
+                "uploaded IS NOT NULL" if uploaded else "uploaded IS NULL")
+        if state is not None:
+            if state not in SCAN_STATES:
+                raise ValueError(f"Invalid scan state {state}")
+            where.append("state = ?")
+            args.append(state)
+        query = "SELECT * FROM scans"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY captured, directory"
+        with self.connect() as conn:
+            return [dict(row) for row in conn.execute(query, args)]
+
+    def sync(self, scan_dir, log=None):
+        """
+        Add scans in scan_dir the catalog doesn't know about yet
+        Only reads the top level listing for known scans
+        Unknown scans are crawled once to see if they were already uploaded
+        Return number of scans added
+        """
+        scan_dir = catalog_key(scan_dir)
+        with os.scandir(scan_dir) as it:
+            directories = sorted(entry.path for entry in it if entry.is_dir())
+        with self.connect() as conn:
+            known = set(row["directory"]
+                        for row in conn.execute("SELECT directory FROM scans"))
+        new = []
+        for directory in directories:
+            if directory in known:
+                continue
+            uploaded = uploaded_on_disk(directory)
+            if log:
+                status = "uploaded" if uploaded else "not uploaded"
+                log(f"Scan catalog: adding {directory} ({status})")
+            new.append((directory, os.path.getmtime(directory), uploaded))
+        # One transaction: a commit per scan adds up on a large data dir
+        with self.connect() as conn:
+            for directory, captured, uploaded in new:
+                self._ensure(conn, directory, captured)
+                if uploaded is not None:
+                    conn.execute(
+                        "UPDATE scans SET state = 'uploaded', uploaded = ?"
+                        " WHERE directory = ?", (uploaded, directory))
+        return len(new)
+
+    def pending_uploads(self, scan_dir):
+        """
+        Return directories in scan_dir that still exist and aren't uploaded
+        Call sync() first to pick up scans the catalog doesn't know about
+        """
+        scan_dir = catalog_key(scan_dir)
+        ret = []
+        for scan in self.scans(uploaded=False):
+            directory = scan["directory"]
+            if os.path.dirname(directory) != scan_dir:
+                continue
+            if os.path.isdir(directory):
+                ret.append(directory)
+        return ret
+
+
+def error_str(e):
+    return f"{type(e).__name__}: {e}"
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_scan_catalog(fn=None):
+    """
+    Return the catalog for fn (default: the data dir's)
+    Nothing is created on disk until it is first used
+    """
+    if fn is None:
+        fn = config.get_bc().scan_catalog_fn()
+    fn = os.path.realpath(fn)
+    with _catalogs_lock:
+        ret = _catalogs.get(fn)
+        if ret is None:
+            ret = ScanCatalog(fn)
+            _catalogs[fn] = ret
+        return ret
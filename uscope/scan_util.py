@@ -1,7 +1,11 @@
 from collections import OrderedDict
-import glob
+import functools
 import os
 import re
+import threading
+import time
+
+IMAGE_EXTENSIONS = (".jpg", ".tif")
 
 
 def iindex_filename_key(filename):
@@ -10,8 +14,18 @@ def iindex_filename_key(filename):
 
 
 def is_tif_scan(working_dir):
-    fns = glob.glob(working_dir + "/*.tif")
-    return bool(fns)
+    with os.scandir(working_dir) as it:
+        for entry in it:
+            if entry.name.endswith(".tif") and not entry.name.startswith("."):
+                return True
+    return False
+
+
+def iindex_is_tif(iindex):
+    """
+    Same as is_tif_scan() without touching the filesystem
+    """
+    return any(v["extension"] == ".tif" for v in iindex["images"].values())
 
 
 def reduce_iindex_filename(filename, remove_key):
@@ -48,51 +62,47 @@ def bucket_group(iindex_in, bucket_key):
     return fns
 
 
+# Filename part prefix => (key, key of the part string)
+IINDEX_PARTS = {
+    "c": ("col", "col_str"),
+    "r": ("row", "row_str"),
+    "h": ("hdr", "hdr_str"),
+    "z": ("stack", "stack_str"),
+    "is": ("stabilization", "stabilization_str"),
+}
+IINDEX_PART_RE = re.compile(r"(c|r|h|z|is)([0-9]+)")
+
+
+@functools.lru_cache(maxsize=65536)
+def iindex_parse_part(part):
+    """
+    Return (key, key_str, value) or None if not recognized
+    A scan only has a few hundred distinct parts (c000, z02, ...)
+    """
+    m = IINDEX_PART_RE.match(part)
+    if not m:
+        return None
+    k, k_str = IINDEX_PARTS[m.group(1)]
+    return k, k_str, int(m.group(2))
+
+
 def iindex_parse_fn(basename):
     """
-    Nobody is going to be impressed with my regular expression skills
-    but this should work...for now
-    2023-10-23: collapsing under its own weight
-    Rewrite this to be more proper
+    Parse a basename like c001_r000_z01_h02.tif
+    Parts may come in any order
     """
     ret = {}
     ret["basename"] = basename
     parts, extension = basename.split(".")
     ret["extension"] = "." + extension
     for part in parts.split("_"):
-        m = re.match(r"c([0-9]+)", part)
-        if m:
-            ret["col"] = int(m.group(1))
-            ret["col_str"] = part
-            continue
-
-        m = re.match(r"r([0-9]+)", part)
-        if m:
-            ret["row"] = int(m.group(1))
-            ret["row_str"] = part
-            continue
-
-        m = re.match(r"h([0-9]+)", part)
-        if m:
-            ret["hdr"] = int(m.group(1))
-            ret["hdr_str"] = part
-            continue
-
-        m = re.match(r"z([0-9]+)", part)
-        if m:
-            ret["stack"] = int(m.group(1))
-            ret["stack_str"] = part
-            continue
-
-        m = re.match(r"is([0-9]+)", part)
-        if m:
-            ret["stabilization"] = int(m.group(1))
-            ret["stabilization_str"] = part
-            continue
-
+        parsed = iindex_parse_part(part)
         # Should we allow non-confirming files?
         # return None
-        assert 0, f"Unrecognized part {part} in basename {basename}"
+        assert parsed, f"Unrecognized part {part} in basename {basename}"
+        k, k_str, val = parsed
+        ret[k] = val
+        ret[k_str] = part
 
     assert "row" in ret, basename
     assert "col" in ret, basename
@@ -100,6 +110,116 @@ def iindex_parse_fn(basename):
     return ret
 
 
+def iindex_from_images(dir_in, images):
+    """
+    Build an image index from already parsed {basename: iindex_parse_fn()}
+    ex: a processing stage knows what it wrote and doesn't need to rescan
+    """
+    sorted_images = OrderedDict(
+        (basename, images[basename]) for basename in sorted(images))
+    values = list(sorted_images.values())
+    crs = OrderedDict(((v["col"], v["row"]), v) for v in values)
+
+    def extent(k):
+        return max((v.get(k, -1) for v in values), default=-1) + 1
+
+    stabilization = extent("stabilization")
+    hdrs = extent("hdr")
+    stacks = extent("stack")
+    # Much fewer tiles than images
+    cols = max((col for col, _row in crs), default=-1) + 1
+    rows = max((row for _col, row in crs), default=-1) + 1
+
+    # xxx: maybe this removes /
+    # yes
+    working_dir = os.path.realpath(dir_in)
+    # while working_dir[-1] == "/":
+    #    working_dir = working_dir[0:len(working_dir) - 1]
+
+    ret = OrderedDict()
+    ret["dir"] = working_dir
+    ret["images"] = sorted_images
+    ret["crs"] = crs
+    ret["stabilization"] = stabilization
+    ret["hdrs"] = hdrs
+    ret["stacks"] = stacks
+    ret["flat"] = stacks == 0 and hdrs == 0 and stabilization == 0
+    ret["cols"] = cols
+    ret["rows"] = rows
+    return ret
+
+
+def iindex_from_basenames(dir_in, basenames):
+    return iindex_from_images(
+        dir_in,
+        {basename: iindex_parse_fn(basename)
+         for basename in basenames})
+
+
+def list_scan_images(dir_in):
+    return [
+        entry.name for entry in os.scandir(dir_in)
+        if entry.name.endswith(IMAGE_EXTENSIONS)
+        and not entry.name.startswith(".")
+    ]
+
+
+class IIndexCache:
+    """
+    Index per directory, kept across index_scan_images() calls
+    -Directory mtime unchanged: reuse without listing the directory
+    -Otherwise: list the directory and only parse new filenames
+        The index is only rebuilt if the image names changed
+
+    An entry added in the same timestamp tick as the previous listing
+    wouldn't change the mtime so recently modified directories are
+    always listed (same idea as git's "racy" index entries)
+    """
+    # seconds
+    racy_window = 2.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # realpath: (mtime_ns, listed at, {basename: parsed}, iindex)
+        self.entries = {}
+
+    def index(self, dir_in):
+        """
+        Return a copy of the cached index
+        Only the top level dict is copied: don't modify images / crs
+        """
+        key = os.path.realpath(dir_in)
+        mtime_ns = os.stat(key).st_mtime_ns
+        with self.lock:
+            entry = self.entries.get(key)
+        images = {}
+        if entry is not None:
+            cached_mtime_ns, listed_at, images, iindex = entry
+            racy = listed_at - mtime_ns / 1e9 < self.racy_window
+            if cached_mtime_ns == mtime_ns and not racy:
+                return OrderedDict(iindex)
+        # Listing starts after the stat => changes from here on bump mtime
+        listed_at = time.time()
+        new_images = {}
+        for basename in list_scan_images(key):
+            v = images.get(basename)
+            if v is None:
+                v = iindex_parse_fn(basename)
+            new_images[basename] = v
+        if entry is None or new_images.keys() != images.keys():
+            iindex = iindex_from_images(key, new_images)
+        with self.lock:
+            self.entries[key] = (mtime_ns, listed_at, new_images, iindex)
+        return OrderedDict(iindex)
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+
+iindex_cache = IIndexCache()
+
+
 def index_scan_images(dir_in):
     """
     Return dict of image_name to
@@ -125,43 +245,4 @@ def index_scan_images(dir_in):
         },
     }
     """
-    ret = OrderedDict()
-    images = OrderedDict()
-    cols = 0
-    rows = 0
-    hdrs = 0
-    stacks = 0
-    stabilization = 0
-    crs = OrderedDict()
-    for fn_full in sorted(
-            list(glob.glob(dir_in + "/*.jpg")) +
-            list(glob.glob(dir_in + "/*.tif"))):
-        basename = os.path.basename(fn_full)
-
-        v = iindex_parse_fn(basename)
-        if not v:
-            continue
-        images[basename] = v
-        crs[(v.get("col"), v.get("row"))] = v
-        stabilization = max(stabilization, v.get("stabilization", -1) + 1)
-        hdrs = max(hdrs, v.get("hdr", -1) + 1)
-        stacks = max(stacks, v.get("stack", -1) + 1)
-        rows = max(rows, v.get("row") + 1)
-        cols = max(cols, v.get("col") + 1)
-
-    # xxx: maybe this removes /
-    # yes
-    working_dir = os.path.realpath(dir_in)
-    # while working_dir[-1] == "/":
-    #    working_dir = working_dir[0:len(working_dir) - 1]
-
-    ret["dir"] = working_dir
-    ret["images"] = images
-    ret["crs"] = crs
-    ret["stabilization"] = stabilization
-    ret["hdrs"] = hdrs
-    ret["stacks"] = stacks
-    ret["flat"] = stacks == 0 and hdrs == 0 and stabilization == 0
-    ret["cols"] = cols
-    ret["rows"] = rows
-    return ret
+    return iindex_cache.index(dir_in)
@@ -4,10 +4,14 @@ Pre-process files for cloud stitch
 CloudStitch only operates on .jpg right now (bandwidth etc)
 So pre-process files / tifs individually first
 
-TODO: parallel
+--jobs N processes up to N of the given scans at once on one worker pool
+
+Without directories: batch mode, process everything in the scan dir
+that the scan catalog says hasn't been uploaded yet
 """
 
-from uscope.imagep.pipeline import process_dir, already_uploaded
+from uscope.imagep.pipeline import process_dir, process_dirs
+from uscope.scan_catalog import get_scan_catalog
 from uscope.cloud_stitch import CSInfo
 from uscope.util import add_bool_arg
 from uscope import config
@@ -17,8 +21,19 @@ import time
 import json
 
 
-def run(directories, batch_sleep=2400, microscope_name=None, *args, **kwargs):
-    if directories:
+def run(directories,
+        batch_sleep=2400,
+        microscope_name=None,
+        jobs=1,
+        *args,
+        **kwargs):
+    if directories and jobs > 1:
+        process_dirs(directories,
+                     *args,
+                     microscope_name=microscope_name,
+                     max_jobs=jobs,
+                     **kwargs)
+    elif directories:
         for directory in directories:
             process_dir(directory,
                         microscope_name=microscope_name,
@@ -29,15 +44,13 @@ def run(directories, batch_sleep=2400, microscope_name=None, *args, **kwargs):
         burst_size = 2
         uploads = 0
         print("Scanning data dir for new scans")
-        # Only take the top directory listing
-        for root, directories, _files in os.walk(
-                config.get_bc().get_scan_dir()):
-            break
-        for basename in directories:
-            directory = os.path.join(root, basename)
-            if already_uploaded(directory):
-                print(f"{basename}: skip, already uploaded")
-                continue
+        scan_dir = config.get_bc().get_scan_dir()
+        catalog = get_scan_catalog()
+        catalog.sync(scan_dir, log=print)
+        directories = catalog.pending_uploads(scan_dir)
+        print(f"{len(directories)} scans not uploaded")
+        for directory in directories:
+            basename = os.path.basename(directory)
             print("")
             print("")
             print("")
@@ -51,6 +64,7 @@ def run(directories, batch_sleep=2400, microscope_name=None, *args, **kwargs):
             process_dir(directory,
                         *args,
                         microscope_name=microscope_name,
+                        catalog=catalog,
                         **kwargs)
             uploads += 1
 
@@ -76,7 +90,37 @@ def main():
         default=True,
         help="Best effort in lieu of crashing on error (ex: stack failure)")
     add_bool_arg(parser, "--quick-pano", default=None, help="")
+    parser.add_argument("--quick-pano-scale",
+                        type=float,
+                        default=None,
+                        help="Shrink quick pano by this factor (ex: 8)")
+    add_bool_arg(parser,
+                 "--local-stitch",
+                 default=None,
+                 help="Stitch in process (pair with --no-upload)")
+    add_bool_arg(parser,
+                 "--pyramid",
+                 default=None,
+                 help="Write a multi resolution tile pyramid + viewer")
+    add_bool_arg(parser,
+                 "--fuse-corrections",
+                 default=None,
+                 help="Apply correction plugins in a single pass per image")
+    add_bool_arg(parser,
+                 "--dag-schedule",
+                 default=None,
+                 help="Start each tile's next stage as soon as it is ready")
+    add_bool_arg(
+        parser,
+        "--trace",
+        default=None,
+        help="Write processing_trace.json (chrome://tracing, Perfetto)")
     parser.add_argument("--threads", default=None)
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Process up to this many scans at once sharing the workers")
     parser.add_argument("--access-key")
     parser.add_argument("--secret-key")
     parser.add_argument("--id-key")
@@ -104,6 +148,18 @@ def main():
         j = json.loads(args.json)
     if args.quick_pano is not None:
         j["write_quick_pano"] = args.quick_pano
+    if args.quick_pano_scale is not None:
+        j["quick_pano_scale"] = args.quick_pano_scale
+    if args.local_stitch is not None:
+        j["local_stitch"] = args.local_stitch
+    if args.pyramid is not None:
+        j["write_pyramid"] = args.pyramid
+    if args.fuse_corrections is not None:
+        j["fuse_corrections"] = args.fuse_corrections
+    if args.dag_schedule is not None:
+        j["dag_schedule"] = args.dag_schedule
+    if args.trace is not None:
+        j["write_trace"] = args.trace
 
     run(args.dirs_in,
         cs_info=cs_info,
@@ -113,6 +169,7 @@ def main():
         best_effort=args.best_effort,
         lazy=args.lazy,
         batch_sleep=args.batch_sleep,
+        jobs=args.jobs,
         nthreads=args.threads,
         microscope_name=args.microscope,
         configj=j,